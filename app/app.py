@@ -1,15 +1,55 @@
-from flask import Flask, request, render_template, redirect, url_for, session, flash
-from functools import wraps
+from flask import Flask, Response, request, render_template, redirect, url_for, session, flash, abort, jsonify, g
+from flask import before_render_template, template_rendered, stream_template, get_flashed_messages
+from functools import lru_cache, partial, wraps
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
 import vobject
 import logging
+import re
 import sys
 import requests
-from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse, urlunparse
 import base64
 import uuid
 import secrets
+import threading
+import time
+import json
+import sqlite3
+import hashlib
+import bisect
+import contextvars
+import csv
+import gzip
+import zlib
+import heapq
+import itertools
+import unicodedata
+import multiprocessing
+import operator
+import random
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Dict
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape as xml_escape
+from io import BytesIO, StringIO
+
+import metrics
+from carddav_async import AsyncCardDAVClient, CardDAVClient
+from profiler import SamplingProfiler
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional: photos are then stored as uploaded
+    Image = ImageOps = None
+
+try:
+    import brotli
+except ImportError:  # brotli is optional: responses are then gzip-compressed only
+    brotli = None
 
 logging.basicConfig(
     stream=sys.stdout,
@@ -57,7 +97,6 @@ def _sanitize_username(username: str) -> str:
     Only alphanumeric, hyphen, underscore and dot are allowed in a Radicale username.
     Raises ValueError for invalid usernames.
     """
-    import re
     if not re.match(r'^[A-Za-z0-9._-]+$', username):
         raise ValueError("Username contains invalid characters.")
     return username
@@ -78,7 +117,6 @@ def build_user_url(username: str) -> str:
         path = _FIXED_PATH_TMPL
 
     # Re-assemble from fixed server-side parts — user input only in `path`.
-    from urllib.parse import urlunparse
     return urlunparse((_FIXED_SCHEME, _FIXED_NETLOC, path, '', _FIXED_QUERY, _FIXED_FRAGMENT))
 
 
@@ -93,7 +131,8 @@ def generate_csrf_token():
 
 
 def validate_csrf():
-    token = request.form.get('csrf_token')
+    # Forms post the token as a field; JSON requests send it in a header.
+    token = request.form.get('csrf_token') or request.headers.get('X-CSRF-Token')
     if not token or token != session.get('csrf_token'):
         logger.warning("CSRF validation failed")
         return False
@@ -103,6 +142,109 @@ def validate_csrf():
 app.jinja_env.globals['csrf_token'] = generate_csrf_token
 
 
+# ---------------------------------------------------------------------------
+# Upstream HTTP sessions
+# One keep-alive requests.Session per (user, password) is shared by every
+# request of that user in this worker, so page views and edits reuse warm
+# TCP/TLS connections to the CardDAV server instead of reconnecting.
+# The sync and the streamed import/export run on it; single-card reads and
+# writes, batches and the health check use a carddav_async client, pooled
+# the same way, whose calls overlap on the worker's event loop.
+# ---------------------------------------------------------------------------
+
+SESSION_POOL_MAX = int(os.environ.get('SESSION_POOL_MAX', '64'))
+SESSION_POOL_CONNECTIONS = int(os.environ.get('SESSION_POOL_CONNECTIONS', '4'))
+SESSION_IDLE_TIMEOUT = int(os.environ.get('SESSION_IDLE_TIMEOUT', '300'))
+
+
+class MeteredSession(requests.Session):
+    """requests.Session recording every CardDAV round trip in metrics."""
+
+    def request(self, method, url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            resp = super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            metrics.observe_upstream(method, 'error', started)
+            raise
+        metrics.observe_upstream(method, resp.status_code, started)
+        return resp
+
+
+class SessionPool:
+    """Bounded LRU of per-user sessions with idle-timeout eviction."""
+
+    metric_name = 'sessions'
+
+    def __init__(self, max_sessions: int, connections: int, idle_timeout: int):
+        self.max_sessions = max_sessions
+        self.connections = connections
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()  # (username, password digest) -> [session, last_used]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(username: str, password: str) -> tuple:
+        return username, hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+    def _new_session(self, username: str, password: str) -> requests.Session:
+        s = MeteredSession()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.connections)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        # Credentials are stored in the signed Flask session (not logged anywhere).
+        s.auth = (username, password)
+        s.headers.update({'User-Agent': 'GUIVCard/2.0'})
+        return s
+
+    def get(self, username: str, password: str) -> requests.Session:
+        key = self._key(username, password)
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            # Entries are kept in last-used order, so idle ones are at the front.
+            for k, (s, last_used) in list(self._sessions.items()):
+                if now - last_used < self.idle_timeout:
+                    break
+                expired.append(self._sessions.pop(k)[0])
+            entry = self._sessions.get(key)
+            metrics.cache_lookup(self.metric_name, hits=entry is not None, misses=entry is None)
+            if entry is None:
+                while len(self._sessions) >= self.max_sessions:
+                    expired.append(self._sessions.popitem(last=False)[1][0])
+                entry = self._sessions[key] = [self._new_session(username, password), now]
+            entry[1] = now
+            self._sessions.move_to_end(key)
+        for s in expired:
+            s.close()
+        return entry[0]
+
+    def discard(self, username: str, password: str = None) -> None:
+        """Close the sessions of `username` (only the one for `password` if given)."""
+        with self._lock:
+            keys = [k for k in self._sessions if k[0] == username]
+            if password is not None:
+                keys = [k for k in keys if k == self._key(username, password)]
+            closing = [self._sessions.pop(k)[0] for k in keys]
+        for s in closing:
+            s.close()
+
+
+session_pool = SessionPool(SESSION_POOL_MAX, SESSION_POOL_CONNECTIONS, SESSION_IDLE_TIMEOUT)
+
+
+class ClientPool(SessionPool):
+    """The same LRU, holding carddav_async clients."""
+
+    metric_name = 'clients'
+
+    def _new_session(self, username: str, password: str) -> CardDAVClient:
+        return CardDAVClient(username, password, connections=self.connections)
+
+
+client_pool = ClientPool(SESSION_POOL_MAX, SESSION_POOL_CONNECTIONS, SESSION_IDLE_TIMEOUT)
+
+
 # ---------------------------------------------------------------------------
 # Auth — verified against Radicale via PROPFIND
 # ---------------------------------------------------------------------------
@@ -119,38 +261,56 @@ def check_auth(username: str, password: str) -> bool:
     except ValueError as e:
         logger.error(f"Auth rejected — invalid username format: {e}")
         return False
+    # The pooled session is kept on success, so the first page view after
+    # login reuses the connection opened here.
     try:
-        resp = requests.request(
+        resp = session_pool.get(username, password).request(
             'PROPFIND', user_url,
-            auth=(username, password),
-            headers={'Depth': '0', 'User-Agent': 'GUIVCard/2.0'},
+            headers={'Depth': '0'},
             timeout=10
         )
         success = resp.status_code == 207
         logger.info(f"Auth attempt: CardDAV returned {resp.status_code}")
-        return success
     except Exception as e:
         logger.error(f"Auth error: {e}")
-        return False
+        success = False
+    if not success:
+        session_pool.discard(username, password)
+    return success
 
 
 def get_user_session() -> requests.Session:
-    s = requests.Session()
-    # Credentials are stored in the signed Flask session (not logged anywhere).
-    s.auth = (session['username'], session['password'])
-    s.headers.update({'User-Agent': 'GUIVCard/2.0'})
-    return s
+    return session_pool.get(session['username'], session['password'])
+
+
+def get_user_client() -> CardDAVClient:
+    return client_pool.get(session['username'], session['password'])
 
 
 def get_user_carddav_url() -> str:
     return build_user_url(session['username'])
 
 
+def contact_id_for(href: str) -> str:
+    """A contact's id is its server-relative href without the leading slash,
+    so ids stay unique across the user's address books."""
+    return urlparse(href).path.lstrip('/')
+
+
+def contact_href(contact_id: str) -> str:
+    """Server-relative href of a card, as it appears in multistatus responses."""
+    return '/' + contact_id
+
+
 def check_login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'username' not in session:
+            if request.path.startswith('/api/'):
+                return jsonify({'error': 'Not authenticated.'}), 401
             return redirect(url_for('login'))
+        apply_logouts()
+        refresher.track(session['username'], session['password'])
         return f(*args, **kwargs)
     return decorated_function
 
@@ -159,6 +319,9 @@ def check_login_required(f):
 # vCard helpers
 # ---------------------------------------------------------------------------
 
+DAV_NS = {'D': 'DAV:', 'C': 'urn:ietf:params:xml:ns:carddav'}
+
+
 def escape_vcard_value(value: str) -> str:
     if not value:
         return ''
@@ -208,7 +371,8 @@ def generate_vcard(data: Dict) -> str:
     if photo := data.get('PHOTO'):
         if isinstance(photo, bytes):
             photo_b64 = base64.b64encode(photo).decode('utf-8')
-            lines.append(f"PHOTO;ENCODING=b;TYPE=JPEG:{photo_b64}")
+            photo_type = _sniff_image_type(photo).split('/')[1].upper()
+            lines.append(f"PHOTO;ENCODING=b;TYPE={photo_type}:{photo_b64}")
 
     if bday := data.get('BDAY'):
         lines.append(f"BDAY:{escape_vcard_value(bday)}")
@@ -242,130 +406,501 @@ def normalize_birthday_to_display(bday: str) -> str:
     return bday
 
 
+DavResponse = namedtuple('DavResponse', 'href status etag address_data')
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _response_status(elem) -> int:
+    """Status of a D:response: its own D:status, else the first propstat's."""
+    text = elem.findtext('D:status', None, DAV_NS) or elem.findtext('.//D:propstat/D:status', '', DAV_NS)
+    parts = text.split()
+    return int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 200
+
+
+class MultistatusStream:
+    """Incremental reader for a multistatus body fed as byte chunks.
+
+    Iterating yields one DavResponse per D:response as soon as its closing
+    tag arrives, then drops the element, so memory is bounded by the largest
+    single response rather than the whole body. A top-level D:sync-token is
+    available in `sync_token` once iteration is over.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.sync_token = None
+        self._root = None
+        self._depth = 0
+
+    def __iter__(self):
+        parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        for chunk in self.chunks:
+            with metrics.phase('xml', count=0):
+                parser.feed(chunk)
+            yield from self._drain(parser)
+        with metrics.phase('xml', count=0):
+            parser.close()
+        yield from self._drain(parser)
+
+    def _drain(self, parser):
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if self._root is None:
+                    self._root = elem
+                self._depth += 1
+                continue
+            self._depth -= 1
+            if self._depth != 1:
+                continue
+            if elem.tag == '{DAV:}response':
+                yield DavResponse(
+                    href=elem.findtext('D:href', '', DAV_NS),
+                    status=_response_status(elem),
+                    etag=elem.findtext('.//D:getetag', '', DAV_NS),
+                    address_data=elem.findtext('.//C:address-data', None, DAV_NS),
+                )
+            elif elem.tag == '{DAV:}sync-token':
+                self.sync_token = (elem.text or '').strip() or None
+            self._root.remove(elem)
+
+
+def iter_report_cards(chunks):
+    """Yield (href, etag, vcard text) per card of a CardDAV multistatus
+    (addressbook-query, multiget or sync-collection REPORT) as the body
+    streams in. Responses without address-data are skipped."""
+    for r in MultistatusStream(chunks):
+        if not r.href.endswith('.vcf'):
+            continue
+        if not r.address_data:
+            logger.debug(f"No address-data for {r.href}")
+            continue
+        yield r.href, r.etag, r.address_data
+
+
+def iter_contacts_from_report(chunks, parallel: bool = False):
+    """Yield a contact dict per card of a multistatus body fed as byte chunks."""
+    return parse_cards(iter_report_cards(chunks), parallel)
+
+
 def parse_contacts_from_report(response_content: bytes) -> list:
-    from xml.etree import ElementTree
+    """Parse a buffered multistatus body into contact dicts."""
     contacts = []
-
     try:
-        root = ElementTree.fromstring(response_content)
+        contacts.extend(iter_contacts_from_report([response_content]))
     except ElementTree.ParseError as e:
         logger.error(f"Failed to parse REPORT XML: {e}")
-        return contacts
+    return contacts
 
-    ns = {'D': 'DAV:', 'C': 'urn:ietf:params:xml:ns:carddav'}
 
-    for elem in root.findall('.//D:response', ns):
-        href_el = elem.find('.//D:href', ns)
-        if href_el is None:
-            continue
-        href = href_el.text or ''
-        if not href.endswith('.vcf'):
-            continue
+# Fast path for the list view. Most cards are plain vCard 3.0/4.0, and the
+# list only needs a handful of properties, so a line tokenizer that mirrors
+# vobject's unescaping and component splitting is several times cheaper than
+# building the full object model. Anything it is unsure about (vCard 2.1,
+# quoted-printable, charsets, nested cards, malformed lines) goes to vobject.
+FAST_VCARD_PARSER = os.environ.get('FAST_VCARD_PARSER', '1') != '0'
 
-        address_data = elem.find('.//C:address-data', ns)
-        if address_data is None or not address_data.text:
-            logger.debug(f"No address-data for {href}")
-            continue
+_FAST_PROPS = frozenset(('UID', 'FN', 'N', 'EMAIL', 'TEL', 'ORG', 'URL', 'BDAY', 'NOTE', 'ADR', 'PHOTO'))
+_UNFOLD_RE = re.compile(r'\r?\n[ \t]')
+_ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
 
-        try:
-            vcard_data = vobject.readOne(address_data.text)
-        except Exception as e:
-            logger.warning(f"Could not parse vCard {href}: {e}")
-            continue
 
-        fn_val = ''
-        try:
-            fn_val = vcard_data.fn.value
-        except Exception:
-            pass
+class _FastPathUnsupported(Exception):
+    pass
+
+
+def _unescape_text(value: str) -> str:
+    if '\\' not in value:
+        return value
+    return _ESCAPE_RE.sub(lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
 
-        contact = {
-            'id': href.split('/')[-1],
-            'name': fn_val or 'No Name',
-            'first_name': '', 'last_name': '',
-            'email': '', 'phone': '', 'org': '',
-            'url': '', 'birthday': '', 'note': '',
-            'photo': None, 'address': None
+
+def _split_unescaped(value: str, sep: str) -> list:
+    """Split on `sep` where it is not backslash-escaped; escapes are kept."""
+    if '\\' not in value:
+        return value.split(sep)
+    parts, current, i = [], [], 0
+    while i < len(value):
+        ch = value[i]
+        if ch == '\\' and i + 1 < len(value):
+            current.append(value[i:i + 2])
+            i += 2
+            continue
+        if ch == sep:
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(ch)
+        i += 1
+    parts.append(''.join(current))
+    return parts
+
+
+def _text_value(value: str) -> str:
+    """A single text value the way vobject reads it: an unescaped comma ends
+    the value (vobject keeps only the first of a comma-separated list)."""
+    if ',' in value:
+        value = _split_unescaped(value, ',')[0]
+    return _unescape_text(value)
+
+
+def _structured_value(value: str) -> list:
+    """Components of N/ADR/ORG as vobject returns them: each component is a
+    string, or a list of strings when it holds comma-separated values."""
+    components = []
+    for component in _split_unescaped(value, ';'):
+        items = [_unescape_text(v) for v in _split_unescaped(component, ',')]
+        if len(items) > 1 and not items[-1]:
+            items.pop()  # like vobject, a trailing comma adds no empty item
+        components.append(items[0] if len(items) == 1 else items)
+    return components
+
+
+def _split_content_line(line: str) -> tuple:
+    """Split `[group.]NAME;PARAM=x;...:value` into (NAME, {PARAM: value}, value)."""
+    if '"' in line:
+        in_quotes, colon = False, -1
+        for i, ch in enumerate(line):
+            if ch == '"':
+                in_quotes = not in_quotes
+            elif ch == ':' and not in_quotes:
+                colon = i
+                break
+    else:
+        colon = line.find(':')
+    if colon < 1:
+        raise _FastPathUnsupported(f"malformed line {line[:40]!r}")
+
+    head, value = line[:colon], line[colon + 1:]
+    if '"' in head:
+        raw_params, current, in_quotes = [], [], False
+        for ch in head:
+            if ch == '"':
+                in_quotes = not in_quotes
+            elif ch == ';' and not in_quotes:
+                raw_params.append(''.join(current))
+                current = []
+            else:
+                current.append(ch)
+        raw_params.append(''.join(current))
+        name, *raw_params = raw_params
+    else:
+        name, *raw_params = head.split(';')
+    name = name.rsplit('.', 1)[-1].upper()
+    params = {}
+    for raw in raw_params:
+        key, _, val = raw.partition('=')
+        # vCard 2.1 allows bare parameters such as TEL;WORK:...
+        params[key.upper() if val else 'TYPE'] = (val or key).upper()
+    return name, params, value
+
+
+def fast_parse_vcard(href: str, text: str, photo_novalue: bool = False):
+    """Build the list-view contact dict without vobject. Returns None when the
+    card needs the full parser. With `photo_novalue`, the card comes from a
+    partial retrieval that lists PHOTO without its value."""
+    props = {}
+    try:
+        lines = _UNFOLD_RE.sub('', text).splitlines()
+        depth = cards = 0
+        for line in lines:
+            if not line:
+                continue
+            upper = line[:12].upper()
+            if upper.startswith('BEGIN:'):
+                depth += 1
+                cards += 1
+                if depth > 1 or cards > 1 or upper.strip() != 'BEGIN:VCARD':
+                    raise _FastPathUnsupported("nested or multiple components")
+                continue
+            if upper.startswith('END:'):
+                depth -= 1
+                continue
+            if depth != 1:
+                continue
+            name, params, value = _split_content_line(line)
+            if name == 'VERSION' and value.strip() not in ('3.0', '4.0'):
+                raise _FastPathUnsupported(f"vCard {value.strip()}")
+            if name not in _FAST_PROPS or name in props:
+                continue
+            if 'CHARSET' in params or params.get('ENCODING', 'B') not in ('B', 'BASE64'):
+                raise _FastPathUnsupported("legacy encoding")
+            props[name] = (params, value)
+        if cards != 1 or depth != 0:
+            raise _FastPathUnsupported("unbalanced BEGIN/END")
+    except _FastPathUnsupported as e:
+        logger.debug(f"Fast vCard path declined {href}: {e}")
+        return None
+
+    def text_prop(name: str) -> str:
+        return _text_value(props[name][1]) if name in props else ''
+
+    contact = {
+        'id': contact_id_for(href),
+        'href': href, 'etag': '', 'uid': text_prop('UID'),
+        'name': text_prop('FN') or 'No Name',
+        'first_name': '', 'last_name': '',
+        'email': text_prop('EMAIL'), 'phone': text_prop('TEL'), 'org': '',
+        'url': text_prop('URL').strip('<>'), 'birthday': '', 'note': text_prop('NOTE'),
+        'has_photo': False, 'address': None
+    }
+
+    if 'N' in props:
+        n = _structured_value(props['N'][1]) + [''] * 5
+        contact['first_name'] = n[1] or ''
+        contact['last_name'] = n[0] or ''
+
+    if 'ORG' in props:
+        val = _structured_value(props['ORG'][1])
+        val = val[0] if val else ''
+        if isinstance(val, list):
+            val = val[0] if val else ''
+        contact['org'] = str(val) if val else ''
+
+    if 'BDAY' in props:
+        contact['birthday'] = normalize_birthday_to_display(text_prop('BDAY'))
+
+    if 'PHOTO' in props:
+        params, value = props['PHOTO']
+        if photo_novalue:
+            contact['has_photo'] = True
+        elif 'ENCODING' in params:
+            contact['has_photo'] = bool(value.strip())
+        elif value.startswith('data:'):
+            contact['has_photo'] = bool(value.partition(',')[2])
+
+    if 'ADR' in props:
+        adr = _structured_value(props['ADR'][1]) + [''] * 7
+        contact['address'] = {
+            'street': adr[2] or '',
+            'city': adr[3] or '',
+            'postal': adr[5] or '',
+            'country': adr[6] or ''
         }
 
-        try:
-            if 'n' in vcard_data.contents:
-                contact['first_name'] = vcard_data.n.value.given or ''
-                contact['last_name'] = vcard_data.n.value.family or ''
-        except Exception:
-            pass
+    _set_initials(contact)
+    return contact
 
-        try:
-            if 'email' in vcard_data.contents:
-                contact['email'] = vcard_data.email.value
-        except Exception:
-            pass
 
-        try:
-            if 'tel' in vcard_data.contents:
-                contact['phone'] = vcard_data.tel.value
-        except Exception:
-            pass
+def parse_vcard(href: str, text: str, photo_novalue: bool = False):
+    """Normalise one vCard into the contact dict used by the templates.
+    Returns None if the card cannot be parsed."""
+    if FAST_VCARD_PARSER:
+        contact = fast_parse_vcard(href, text, photo_novalue)
+        if contact is not None:
+            return contact
+    return parse_vcard_vobject(href, text, photo_novalue)
 
-        try:
-            if 'org' in vcard_data.contents:
-                val = vcard_data.org.value
-                # vobject encodes ORG as list-of-lists e.g. [['Acme','Dept']]
-                if isinstance(val, list):
-                    val = val[0] if val else ''
-                if isinstance(val, list):
-                    val = val[0] if val else ''
-                contact['org'] = str(val) if val else ''
-        except Exception:
-            pass
 
-        try:
-            if 'url' in vcard_data.contents:
-                contact['url'] = vcard_data.url.value.strip('<>')
-        except Exception:
-            pass
+def parse_vcard_vobject(href: str, text: str, photo_novalue: bool = False):
+    """Full vobject parse; handles every card the fast path declines."""
+    try:
+        vcard_data = vobject.readOne(text)
+    except Exception as e:
+        logger.warning(f"Could not parse vCard {href}: {e}")
+        return None
 
-        try:
-            if 'bday' in vcard_data.contents:
-                contact['birthday'] = normalize_birthday_to_display(vcard_data.bday.value)
-        except Exception:
-            pass
+    fn_val = ''
+    try:
+        fn_val = vcard_data.fn.value
+    except Exception:
+        pass
+
+    contact = {
+        'id': contact_id_for(href),
+        'href': href, 'etag': '', 'uid': '',
+        'name': fn_val or 'No Name',
+        'first_name': '', 'last_name': '',
+        'email': '', 'phone': '', 'org': '',
+        'url': '', 'birthday': '', 'note': '',
+        'has_photo': False, 'address': None
+    }
 
-        try:
-            if 'note' in vcard_data.contents:
-                contact['note'] = vcard_data.note.value
-        except Exception:
-            pass
+    try:
+        if 'uid' in vcard_data.contents:
+            contact['uid'] = vcard_data.uid.value
+    except Exception:
+        pass
 
-        try:
-            if 'photo' in vcard_data.contents:
-                photo = vcard_data.photo.value
-                if isinstance(photo, bytes):
-                    contact['photo'] = base64.b64encode(photo).decode('utf-8')
-        except Exception:
-            pass
+    try:
+        if 'n' in vcard_data.contents:
+            contact['first_name'] = vcard_data.n.value.given or ''
+            contact['last_name'] = vcard_data.n.value.family or ''
+    except Exception:
+        pass
+
+    try:
+        if 'email' in vcard_data.contents:
+            contact['email'] = vcard_data.email.value
+    except Exception:
+        pass
+
+    try:
+        if 'tel' in vcard_data.contents:
+            contact['phone'] = vcard_data.tel.value
+    except Exception:
+        pass
+
+    try:
+        if 'org' in vcard_data.contents:
+            val = vcard_data.org.value
+            # vobject encodes ORG as list-of-lists e.g. [['Acme','Dept']]
+            if isinstance(val, list):
+                val = val[0] if val else ''
+            if isinstance(val, list):
+                val = val[0] if val else ''
+            contact['org'] = str(val) if val else ''
+    except Exception:
+        pass
+
+    try:
+        if 'url' in vcard_data.contents:
+            contact['url'] = vcard_data.url.value.strip('<>')
+    except Exception:
+        pass
+
+    try:
+        if 'bday' in vcard_data.contents:
+            contact['birthday'] = normalize_birthday_to_display(vcard_data.bday.value)
+    except Exception:
+        pass
 
+    try:
+        if 'note' in vcard_data.contents:
+            contact['note'] = vcard_data.note.value
+    except Exception:
+        pass
+
+    # Photo bytes are served by /contacts/<id>/photo, not carried in the dict.
+    # vobject cuts a data: URI at its first comma, so read it from the text.
+    try:
+        if 'photo' in vcard_data.contents:
+            contact['has_photo'] = photo_novalue or extract_photo(text)[0] is not None
+    except Exception:
+        pass
+
+    try:
+        if 'adr' in vcard_data.contents:
+            adr = vcard_data.adr.value
+            contact['address'] = {
+                'street': adr.street or '',
+                'city': adr.city or '',
+                'postal': adr.code or '',
+                'country': adr.country or ''
+            }
+    except Exception:
+        pass
+
+    _set_initials(contact)
+    return contact
+
+
+def _set_initials(contact: dict) -> None:
+    # Compute initials from already-normalised string fields
+    fi = _as_str(contact['first_name'])[:1]
+    li = _as_str(contact['last_name'])[:1]
+    contact['initials'] = (fi + li).upper() or _as_str(contact['name'])[:1].upper() or '?'
+
+
+def _sniff_image_type(data: bytes) -> str:
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/jpeg'
+
+
+def _decode_photo(prop) -> tuple:
+    """Return (bytes, mimetype) for a vobject PHOTO property, or (None, None)
+    when it is missing or only an external URL."""
+    value = prop.value
+    if isinstance(value, str) and value.startswith('data:'):
+        header, _, payload = value.partition(',')
         try:
-            if 'adr' in vcard_data.contents:
-                adr = vcard_data.adr.value
-                contact['address'] = {
-                    'street': adr.street or '',
-                    'city': adr.city or '',
-                    'postal': adr.code or '',
-                    'country': adr.country or ''
-                }
-        except Exception:
-            pass
+            value = base64.b64decode(payload) if ';base64' in header else payload.encode('utf-8')
+        except ValueError:
+            return None, None
+    if not isinstance(value, bytes) or not value:
+        return None, None
+    return value, _sniff_image_type(value)
+
 
-        # Compute initials from already-normalised string fields
-        fi = _as_str(contact['first_name'])[:1]
-        li = _as_str(contact['last_name'])[:1]
-        contact['initials'] = (fi + li).upper() or _as_str(contact['name'])[:1].upper() or '?'
+def extract_photo(vcard_text: str) -> tuple:
+    """Return (bytes, mimetype) of the PHOTO in a raw vCard, or (None, None)."""
+    try:
+        for line in _UNFOLD_RE.sub('', vcard_text).splitlines():
+            head = line.split(':', 1)[0].split(';', 1)[0]
+            if head.rsplit('.', 1)[-1].upper() != 'PHOTO':
+                continue
+            _, params, value = _split_content_line(line)
+            if 'ENCODING' in params:
+                if params['ENCODING'] not in ('B', 'BASE64'):
+                    raise _FastPathUnsupported("legacy encoding")
+                data = base64.b64decode(value)
+            elif value.startswith('data:'):
+                header, _, payload = value.partition(',')
+                data = base64.b64decode(payload) if ';base64' in header else payload.encode('utf-8')
+            else:
+                return None, None
+            return (data, _sniff_image_type(data)) if data else (None, None)
+        return None, None
+    except (_FastPathUnsupported, ValueError):
+        pass
+    # Unusual encodings: let vobject decode it
+    try:
+        vcard_data = vobject.readOne(vcard_text)
+        if 'photo' in vcard_data.contents:
+            return _decode_photo(vcard_data.photo)
+    except Exception as e:
+        logger.warning(f"Could not read photo: {e}")
+    return None, None
 
-        contacts.append(contact)
-        logger.debug(f"Parsed contact: {contact['name']} ({href})")
 
-    return contacts
+# Uploads are downscaled to PHOTO_MAX_DIMENSION and recompressed until they fit
+# PHOTO_MAX_BYTES, so that every later REPORT does not carry a raw camera shot.
+PHOTO_MAX_DIMENSION = int(os.environ.get('PHOTO_MAX_DIMENSION', '512'))
+PHOTO_MAX_BYTES = int(os.environ.get('PHOTO_MAX_BYTES', str(150 * 1024)))
+
+
+def prepare_photo(data: bytes) -> bytes:
+    """Downscale and recompress an uploaded photo. Returned unchanged if
+    Pillow is unavailable, the image cannot be decoded, or it already fits."""
+    if Image is None or not data:
+        return data
+    try:
+        img = Image.open(BytesIO(data))
+        img.load()
+    except Exception as e:
+        logger.warning(f"Could not decode uploaded photo, storing as-is: {e}")
+        return data
+    if (len(data) <= PHOTO_MAX_BYTES and max(img.size) <= PHOTO_MAX_DIMENSION
+            and _sniff_image_type(data) in ('image/jpeg', 'image/png')):
+        return data
+
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((PHOTO_MAX_DIMENSION, PHOTO_MAX_DIMENSION), Image.LANCZOS)
+
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    if has_alpha:
+        out = BytesIO()
+        img.save(out, format='PNG', optimize=True)
+        if out.tell() <= PHOTO_MAX_BYTES:
+            return out.getvalue()
+        # Too big as PNG: flatten onto white and fall through to JPEG
+        rgba = img.convert('RGBA')
+        img = Image.new('RGB', rgba.size, (255, 255, 255))
+        img.paste(rgba, mask=rgba.getchannel('A'))
+    img = img.convert('RGB')
+
+    for quality in (85, 75, 65, 55, 45, 35):
+        out = BytesIO()
+        img.save(out, format='JPEG', quality=quality, optimize=True, progressive=True)
+        if out.tell() <= PHOTO_MAX_BYTES:
+            break
+    logger.info(f"Photo recompressed: {len(data)} → {out.tell()} bytes, {img.size[0]}x{img.size[1]}")
+    return out.getvalue()
 
 
 def _as_str(value) -> str:
@@ -378,35 +913,101 @@ def _as_str(value) -> str:
     return str(value)
 
 
-def _sort_key(value) -> tuple:
-    """Return (0, normalized) for non-empty values, (1, '') for empty.
-    Pushes blank fields to the end. Accepts str, list, or None."""
-    v = _as_str(value).strip().lower()
-    return (0, v) if v else (1, '')
+_COMBINING_RE = re.compile('[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]')
+
 
+def fold_text(value) -> str:
+    """Lowercase and strip accents: 'Ézéchiel' -> 'ezechiel'."""
+    text = _as_str(value)
+    if text.isascii():
+        return text.lower()
+    return _COMBINING_RE.sub('', unicodedata.normalize('NFKD', text)).casefold()
 
-def sort_contacts(contacts: list, sort_by: str = 'first_name') -> list:
-    """Sort contacts. Empty fields are always pushed to the end."""
+
+def _sort_key(value) -> tuple:
+    """Collation key: (0, accent-folded, normalized) for non-empty values,
+    (1, '', '') for empty. Accents only break ties, so 'Émile' sorts with
+    the E's rather than after 'Z'. Pushes blank fields to the end.
+    Accepts str, list, or None."""
+    v = _as_str(value).strip()
+    if not v:
+        return (1, '', '')
+    return (0, fold_text(v), unicodedata.normalize('NFC', v).casefold())
+
+
+def contact_sort_key(c: dict, sort_by: str = 'first_name') -> tuple:
+    """Total order for one sort mode. The id comes last as a tie-breaker, so
+    the key of a row is a stable pagination cursor."""
     if sort_by == 'last_name':
-        key = lambda c: (
+        return (
             _sort_key(c['last_name'] or c['name']),
             _sort_key(c['first_name']),
+            c['id'],
         )
-    elif sort_by == 'org':
-        key = lambda c: (
+    if sort_by == 'org':
+        return (
             _sort_key(c['org']),
             _sort_key(c['first_name'] or c['name']),
+            c['id'],
         )
-    else:  # first_name (default)
-        key = lambda c: (
-            _sort_key(c['first_name'] or c['name']),
-            _sort_key(c['last_name']),
-        )
-    try:
-        return sorted(contacts, key=key)
-    except Exception as e:
-        logger.error(f"Sort error: {e}")
-        return contacts
+    # first_name (default)
+    return (
+        _sort_key(c['first_name'] or c['name']),
+        _sort_key(c['last_name']),
+        c['id'],
+    )
+
+
+class SortOrder:
+    """One address book's contacts kept in one sort mode's order.
+
+    Each contact's collation key is computed once, when it is added; after
+    the initial sort, adding or removing a contact is a bisect plus a list
+    insert, so edits and sort switches never re-sort the whole book.
+    """
+
+    def __init__(self, sort_by: str, contacts=()):
+        self.sort_by = sort_by
+        self.key_of = {c['href']: contact_sort_key(c, sort_by) for c in contacts}  # href -> key
+        self.entries = sorted((key, href) for href, key in self.key_of.items())
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, contact: dict) -> None:
+        href = contact['href']
+        self.remove(href)
+        key = self.key_of[href] = contact_sort_key(contact, self.sort_by)
+        bisect.insort(self.entries, (key, href))
+
+    def remove(self, href: str) -> None:
+        key = self.key_of.pop(href, None)
+        if key is not None:
+            del self.entries[bisect.bisect_left(self.entries, (key, href))]
+
+    def subset(self, hrefs) -> list:
+        """Entries of `hrefs` only, in this order."""
+        if len(hrefs) * 16 < len(self.entries):
+            return sorted((self.key_of[href], href) for href in hrefs)
+        # Most of the book (a one-letter search): filtering the sorted entries
+        # is linear, where sorting the nested key tuples again is not
+        return [entry for entry in self.entries if entry[1] in hrefs]
+
+    def best(self, scores: dict, limit: int) -> list:
+        """Entries of the `limit` highest-scoring hrefs of `scores`, ties in
+        this order."""
+        if len(scores) * 16 < len(self.entries):
+            return heapq.nsmallest(limit, ((self.key_of[href], href) for href in scores),
+                                   key=lambda entry: (-scores[entry[1]], entry[0]))
+        # Most of the book: walk the entries once per score, best first,
+        # instead of comparing the nested keys of every match
+        best = []
+        for level in sorted(set(scores.values()), reverse=True):
+            matching = (entry for entry in self.entries if scores.get(entry[1]) == level)
+            best.extend(itertools.islice(matching, limit - len(best)))
+            if len(best) >= limit:
+                break
+        return best
 
 
 def collect_vcard_data_from_form(form, files=None) -> dict:
@@ -443,11 +1044,2421 @@ def collect_vcard_data_from_form(form, files=None) -> dict:
     if files and 'photo' in files:
         photo_file = files['photo']
         if photo_file and photo_file.filename:
-            data['PHOTO'] = photo_file.read()
+            data['PHOTO'] = prepare_photo(photo_file.read())
 
     return data
 
 
+# ---------------------------------------------------------------------------
+# Card parsing, optionally spread over a process pool
+# Parsing is pure CPU work; a sync that brings in PARSE_POOL_THRESHOLD cards
+# or more is cut into chunks parsed by PARSE_WORKERS processes, with results
+# merged back in order. Smaller syncs stay in-process to avoid the IPC cost.
+# ---------------------------------------------------------------------------
+
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', str(min(4, os.cpu_count() or 1))))
+PARSE_POOL_THRESHOLD = int(os.environ.get('PARSE_POOL_THRESHOLD', '2000'))
+PARSE_CHUNK_SIZE = int(os.environ.get('PARSE_CHUNK_SIZE', '250'))
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def _parse_card(href: str, etag: str, text: str, photo_novalue: bool = False):
+    started = time.perf_counter()
+    contact = parse_vcard(href, text, photo_novalue)
+    seconds = time.perf_counter() - started
+    metrics.PARSE_SECONDS.observe(seconds)
+    metrics.add_phase('vcard', seconds)
+    metrics.PARSED.inc()
+    if contact is None:
+        metrics.PARSE_FAILURES.inc()
+        return None
+    contact['etag'] = etag
+    logger.debug(f"Parsed contact: {contact['name']} ({href})")
+    return contact
+
+
+def _parse_card_chunk(cards: list) -> list:
+    """Pool entry point: parse a list of (href, etag, text[, photo_novalue])."""
+    return [_parse_card(*card) for card in cards]
+
+
+def get_parse_pool():
+    """Lazily start the pool in the process that uses it. Children come from
+    a forkserver rather than fork(), which is unsafe in a threaded worker."""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS,
+                mp_context=multiprocessing.get_context('forkserver'),
+            )
+        return _parse_pool
+
+
+def _reset_parse_pool() -> None:
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
+
+
+def parse_cards(cards, parallel: bool = False):
+    """Yield contact dicts for an iterable of (href, etag, text), in order.
+    With `parallel`, chunks are parsed in the process pool while the rest of
+    the input is still streaming in."""
+    if not parallel or PARSE_WORKERS < 2:
+        for card in cards:
+            contact = _parse_card(*card)
+            if contact is not None:
+                yield contact
+        return
+
+    pending = deque()  # (future, chunk) in submission order
+    max_pending = PARSE_WORKERS * 2
+    broken = False
+
+    def submit(chunk: list):
+        nonlocal broken
+        if not broken:
+            try:
+                pending.append((get_parse_pool().submit(_parse_card_chunk, chunk), chunk))
+                return
+            except BrokenProcessPool as e:
+                logger.error(f"Parse pool failed, parsing in-process: {e}")
+                _reset_parse_pool()
+                broken = True
+        pending.append((None, chunk))
+
+    def drain(until: int):
+        nonlocal broken
+        while len(pending) > until:
+            future, chunk = pending.popleft()
+            results = None
+            if future is not None:
+                try:
+                    # Pool processes record their metrics, the wait counts here
+                    with metrics.phase('vcard', count=len(chunk)):
+                        results = future.result()
+                except BrokenProcessPool as e:
+                    logger.error(f"Parse pool failed, parsing in-process: {e}")
+                    _reset_parse_pool()
+                    broken = True
+            if results is None:
+                results = _parse_card_chunk(chunk)
+            yield from (c for c in results if c is not None)
+
+    chunk = []
+    for card in cards:
+        chunk.append(card)
+        if len(chunk) >= PARSE_CHUNK_SIZE:
+            submit(chunk)
+            chunk = []
+            yield from drain(max_pending)
+    if chunk:
+        submit(chunk)
+    yield from drain(0)
+
+
+# ---------------------------------------------------------------------------
+# Parsed-contact cache
+# Normalised contact dicts keyed by (user, href, etag) in a SQLite file, so
+# every gunicorn worker shares the result of parsing a given card revision.
+# Least-recently-used rows are evicted once CONTACT_CACHE_MAX is exceeded.
+# ---------------------------------------------------------------------------
+
+CACHE_DIR = os.environ.get('CACHE_DIR', '/tmp/guivcard')
+CONTACT_CACHE_MAX = int(os.environ.get('CONTACT_CACHE_MAX', '100000'))
+PHOTO_CACHE_MAX = int(os.environ.get('PHOTO_CACHE_MAX', '5000'))
+# Bump whenever the shape of the contact dict changes: older rows are dropped.
+CACHE_SCHEMA_VERSION = 5
+
+
+class ContactCache:
+    def __init__(self, path: str, max_entries: int, max_photos: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_photos = max_photos
+        self.enabled = True
+        self._local = threading.local()
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            with self._connect() as db:
+                if db.execute('PRAGMA user_version').fetchone()[0] != CACHE_SCHEMA_VERSION:
+                    db.execute('DROP TABLE IF EXISTS contacts')
+                    db.execute('DROP TABLE IF EXISTS photos')
+                    db.execute(f'PRAGMA user_version = {CACHE_SCHEMA_VERSION}')
+                db.execute('''CREATE TABLE IF NOT EXISTS contacts (
+                    username  TEXT NOT NULL,
+                    href      TEXT NOT NULL,
+                    etag      TEXT NOT NULL,
+                    data      TEXT NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (username, href)
+                )''')
+                db.execute('CREATE INDEX IF NOT EXISTS contacts_lru ON contacts (last_used)')
+                db.execute('''CREATE TABLE IF NOT EXISTS photos (
+                    username  TEXT NOT NULL,
+                    href      TEXT NOT NULL,
+                    tag       TEXT NOT NULL,
+                    mimetype  TEXT NOT NULL,
+                    data      BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (username, href)
+                )''')
+                db.execute('CREATE INDEX IF NOT EXISTS photos_lru ON photos (last_used)')
+                # One row per user, renumbered at each logout, so that every
+                # worker can tell which logouts it has not acted on yet
+                db.execute('''CREATE TABLE IF NOT EXISTS logouts (
+                    seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT NOT NULL UNIQUE
+                )''')
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Contact cache disabled ({path}): {e}")
+            self.enabled = False
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread and per process: gunicorn forks workers
+        # after import, and SQLite handles must not cross a fork.
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def get_many(self, username: str, etags: Dict[str, str]) -> Dict[str, dict]:
+        """Return {href: contact} for every href whose cached etag still matches."""
+        if not self.enabled or not etags:
+            return {}
+        hits = {}
+        try:
+            db = self._connect()
+            hrefs = list(etags)
+            for i in range(0, len(hrefs), 500):
+                chunk = hrefs[i:i + 500]
+                rows = db.execute(
+                    f"SELECT href, etag, data FROM contacts WHERE username = ? "
+                    f"AND href IN ({','.join('?' * len(chunk))})",
+                    [username, *chunk]
+                ).fetchall()
+                for href, etag, data in rows:
+                    if etag and etag == etags[href]:
+                        hits[href] = json.loads(data)
+            if hits:
+                with db:
+                    db.executemany(
+                        'UPDATE contacts SET last_used = ? WHERE username = ? AND href = ?',
+                        [(time.time(), username, href) for href in hits]
+                    )
+        except sqlite3.Error as e:
+            logger.warning(f"Contact cache read failed: {e}")
+        metrics.cache_lookup('contacts', hits=len(hits), misses=len(etags) - len(hits))
+        return hits
+
+    def put_many(self, username: str, contacts: list) -> None:
+        if not self.enabled or not contacts:
+            return
+        now = time.time()
+        try:
+            db = self._connect()
+            with db:
+                db.executemany(
+                    'INSERT OR REPLACE INTO contacts (username, href, etag, data, last_used) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    [(username, c['href'], c['etag'], json.dumps(c), now) for c in contacts if c.get('etag')]
+                )
+                self._evict(db, 'contacts', self.max_entries)
+        except sqlite3.Error as e:
+            logger.warning(f"Contact cache write failed: {e}")
+
+    def get_photo(self, username: str, href: str, tag: str):
+        """Return (bytes, mimetype) if the cached photo carries `tag`, else None."""
+        if not self.enabled or not tag:
+            return None
+        try:
+            db = self._connect()
+            row = db.execute(
+                'SELECT mimetype, data FROM photos WHERE username = ? AND href = ? AND tag = ?',
+                (username, href, tag)
+            ).fetchone()
+            if row:
+                with db:
+                    db.execute(
+                        'UPDATE photos SET last_used = ? WHERE username = ? AND href = ?',
+                        (time.time(), username, href)
+                    )
+                metrics.cache_lookup('photos', hits=1)
+                return row[1], row[0]
+        except sqlite3.Error as e:
+            logger.warning(f"Photo cache read failed: {e}")
+        metrics.cache_lookup('photos', misses=1)
+        return None
+
+    def put_photo(self, username: str, href: str, tag: str, data: bytes, mimetype: str) -> None:
+        if not self.enabled:
+            return
+        try:
+            db = self._connect()
+            with db:
+                db.execute(
+                    'INSERT OR REPLACE INTO photos (username, href, tag, mimetype, data, last_used) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (username, href, tag, mimetype, data, time.time())
+                )
+                self._evict(db, 'photos', self.max_photos)
+        except sqlite3.Error as e:
+            logger.warning(f"Photo cache write failed: {e}")
+
+    @staticmethod
+    def _evict(db: sqlite3.Connection, table: str, max_rows: int) -> None:
+        excess = db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] - max_rows
+        if excess > 0:
+            db.execute(
+                f'DELETE FROM {table} WHERE rowid IN '
+                f'(SELECT rowid FROM {table} ORDER BY last_used LIMIT ?)',
+                (excess,)
+            )
+
+    def invalidate(self, username: str, href: str) -> None:
+        if not self.enabled:
+            return
+        try:
+            with self._connect() as db:
+                db.execute('DELETE FROM contacts WHERE username = ? AND href = ?', (username, href))
+                db.execute('DELETE FROM photos WHERE username = ? AND href = ?', (username, href))
+        except sqlite3.Error as e:
+            logger.warning(f"Contact cache invalidation failed: {e}")
+
+    def record_logout(self, username: str) -> None:
+        if not self.enabled:
+            return
+        try:
+            with self._connect() as db:
+                db.execute('INSERT OR REPLACE INTO logouts (username) VALUES (?)', (username,))
+        except sqlite3.Error as e:
+            logger.warning(f"Logout marker write failed: {e}")
+
+    def logouts_after(self, seq: int) -> tuple:
+        """(usernames, last seq) of the logouts recorded after `seq`."""
+        if not self.enabled:
+            return [], seq
+        try:
+            rows = self._connect().execute(
+                'SELECT seq, username FROM logouts WHERE seq > ? ORDER BY seq', (seq,)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Logout marker read failed: {e}")
+            return [], seq
+        return [username for _, username in rows], rows[-1][0] if rows else seq
+
+
+contact_cache = ContactCache(os.path.join(CACHE_DIR, 'contacts.sqlite3'), CONTACT_CACHE_MAX, PHOTO_CACHE_MAX)
+
+
+# ---------------------------------------------------------------------------
+# Search index
+# Each synced address book gets an inverted index from accent- and
+# case-folded tokens to card hrefs. It is built on the first search and then
+# kept current by the sync as cards are added, changed or removed. Terms
+# match token prefixes, digit runs match anywhere in the phone number, and a
+# term with no hit falls back to trigram candidates within a small edit
+# distance, so "jonh" still finds "John".
+# ---------------------------------------------------------------------------
+
+_SEARCH_FIELDS = ('name', 'first_name', 'last_name', 'email', 'phone', 'org', 'url', 'birthday', 'note')
+_SEARCH_ADDRESS_FIELDS = ('street', 'city', 'postal', 'country')
+_TOKEN_RE = re.compile(r'\w+')
+
+# Scores of one query term; a contact's score is the sum over all terms.
+_SCORE_EXACT, _SCORE_PREFIX, _SCORE_FUZZY = 3, 2, 1
+# A prefix shorter than this is not expanded over the vocabulary once an
+# earlier term has narrowed the matches: the contacts left are checked instead.
+_PREFIX_EXPAND_MIN = 3
+
+
+def _trigrams(token: str) -> set:
+    padded = f"${token}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _fuzzy_indexable(token: str) -> bool:
+    return len(token) >= 3 and not token.isdigit()
+
+
+def _within_edits(a: str, b: str, max_edits: int) -> bool:
+    """Optimal string alignment distance of a and b is at most max_edits."""
+    if abs(len(a) - len(b)) > max_edits:
+        return False
+    prev2, prev = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > max_edits:
+            return False
+        prev2, prev = prev, cur
+    return prev[-1] <= max_edits
+
+
+def contact_search_terms(contact: dict) -> tuple:
+    """(folded tokens, phone digits) of a contact, as indexed."""
+    values = [contact.get(f) for f in _SEARCH_FIELDS]
+    if contact.get('address'):
+        values += [contact['address'].get(f) for f in _SEARCH_ADDRESS_FIELDS]
+    tokens = frozenset(_TOKEN_RE.findall(fold_text(' '.join(_as_str(v) for v in values))))
+    digits = re.sub(r'\D', '', _as_str(contact.get('phone')))
+    return tokens, digits
+
+
+class SearchIndex:
+    """Inverted index over the contacts of one address book.
+
+    Not thread-safe on its own: callers hold the owning AddressBookState lock.
+    """
+
+    def __init__(self, contacts=()):
+        self.postings = {}    # token -> {href}
+        self.doc_tokens = {}  # href -> tokens, to unindex a card
+        self.digits = {}      # href -> phone digits
+        self.trigrams = {}    # trigram -> {token}, for typo tolerance
+        for contact in contacts:
+            tokens, digits = contact_search_terms(contact)
+            self.doc_tokens[contact['href']] = tokens
+            self.digits[contact['href']] = digits
+            for token in tokens:
+                self.postings.setdefault(token, set()).add(contact['href'])
+        # Sorted once here; later additions are insorted one token at a time.
+        self.vocabulary = sorted(self.postings)
+        for token in self.vocabulary:
+            if _fuzzy_indexable(token):
+                for gram in _trigrams(token):
+                    self.trigrams.setdefault(gram, set()).add(token)
+
+    def __len__(self) -> int:
+        return len(self.doc_tokens)
+
+    def add(self, contact: dict) -> None:
+        href = contact['href']
+        self.remove(href)
+        tokens, digits = contact_search_terms(contact)
+        self.doc_tokens[href] = tokens
+        self.digits[href] = digits
+        for token in tokens:
+            docs = self.postings.get(token)
+            if docs is None:
+                docs = self.postings[token] = set()
+                bisect.insort(self.vocabulary, token)
+                if _fuzzy_indexable(token):
+                    for gram in _trigrams(token):
+                        self.trigrams.setdefault(gram, set()).add(token)
+            docs.add(href)
+
+    def remove(self, href: str) -> None:
+        self.digits.pop(href, None)
+        for token in self.doc_tokens.pop(href, ()):
+            docs = self.postings[token]
+            docs.discard(href)
+            if docs:
+                continue
+            del self.postings[token]
+            del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+            if _fuzzy_indexable(token):
+                for gram in _trigrams(token):
+                    grams = self.trigrams[gram]
+                    grams.discard(token)
+                    if not grams:
+                        del self.trigrams[gram]
+
+    def search(self, q: str):
+        """{href: score} of the contacts matching every term of `q`, or None
+        when `q` has no searchable term."""
+        terms = _TOKEN_RE.findall(fold_text(q))
+        if not terms:
+            return None
+        result = None
+        # Rarest-looking (longest) terms first keeps the intersection small.
+        for term in sorted(set(terms), key=len, reverse=True):
+            if result is not None and len(term) < _PREFIX_EXPAND_MIN:
+                scores = self._match_within(term, result)
+            else:
+                scores = self._match_term(term)
+            if result is None:
+                result = scores
+            else:
+                result = {href: score + scores[href] for href, score in result.items() if href in scores}
+            if not result:
+                return {}
+        return result
+
+    def _match_term(self, term: str) -> dict:
+        scores = {}
+        start = bisect.bisect_left(self.vocabulary, term)
+        for token in itertools.islice(self.vocabulary, start, None):
+            if not token.startswith(term):
+                break
+            score = _SCORE_EXACT if token == term else _SCORE_PREFIX
+            for href in self.postings[token]:
+                scores.setdefault(href, score)
+        if term.isdigit() and len(term) >= 3:
+            for href, digits in self.digits.items():
+                if term in digits:
+                    scores.setdefault(href, _SCORE_PREFIX)
+        if not scores and _fuzzy_indexable(term):
+            for token in self._fuzzy_tokens(term):
+                for href in self.postings[token]:
+                    scores[href] = _SCORE_FUZZY
+        return scores
+
+    def _match_within(self, term: str, hrefs) -> dict:
+        """_match_term() of a short term, restricted to `hrefs`."""
+        start = bisect.bisect_left(self.vocabulary, term)
+        end = bisect.bisect_left(self.vocabulary, term + '\U0010ffff', start)
+        prefixed = set(self.vocabulary[start:end])
+        scores = {}
+        for href in hrefs:
+            tokens = self.doc_tokens[href]
+            if term in tokens:
+                scores[href] = _SCORE_EXACT
+            elif not prefixed.isdisjoint(tokens):
+                scores[href] = _SCORE_PREFIX
+        return scores
+
+    def _fuzzy_tokens(self, term: str) -> list:
+        """Indexed tokens within 1 edit (2 for long terms) of `term`, or of
+        the same-length prefix of the token for a term still being typed."""
+        max_edits = 1 if len(term) <= 5 else 2
+        grams = _trigrams(term)
+        shared = {}
+        for gram in grams:
+            for token in self.trigrams.get(gram, ()):
+                shared[token] = shared.get(token, 0) + 1
+        # Each edit destroys at most three trigrams.
+        needed = max(1, len(grams) - 3 * max_edits)
+        # Many tokens share a prefix (muller1, muller2, ...): compare each
+        # distinct string once.
+        close = {}
+
+        def is_close(candidate: str) -> bool:
+            if candidate not in close:
+                close[candidate] = _within_edits(term, candidate, max_edits)
+            return close[candidate]
+
+        return [
+            token for token, count in shared.items()
+            if count >= needed and (is_close(token[:len(term)]) or is_close(token))
+        ]
+
+
+# ---------------------------------------------------------------------------
+# Address-book sync
+# Each worker keeps, per user and collection, the last sync-token and the
+# getetag of every card. A page load asks the server only for what changed
+# (RFC 6578 sync-collection) and multigets just those cards. Servers without
+# sync-collection get a Depth-1 PROPFIND of ETags diffed against the cache.
+# ---------------------------------------------------------------------------
+
+MULTIGET_BATCH = int(os.environ.get('MULTIGET_BATCH', '200'))
+PARTIAL_ADDRESS_DATA = os.environ.get('PARTIAL_ADDRESS_DATA', '1') != '0'
+
+# RFC 6352 §10.4 partial retrieval: the list view only needs these properties.
+# PHOTO is asked for with novalue so the server reports that a photo exists
+# without sending it; the bytes come from the photo endpoint on demand.
+LIST_VIEW_PROPS = ('VERSION', 'UID', 'FN', 'N', 'EMAIL', 'TEL', 'ORG', 'URL', 'BDAY', 'NOTE', 'ADR')
+_PARTIAL_ALLOWED = frozenset(LIST_VIEW_PROPS + ('PHOTO', 'BEGIN', 'END'))
+_PROP_NAME_RE = re.compile(r'^(?:[A-Za-z0-9-]+\.)?([A-Za-z0-9-]+)[;:]', re.MULTILINE)
+_PHOTO_LINE_RE = re.compile(r'^(?:[A-Za-z0-9-]+\.)?PHOTO(?:;[^:]*)?:(.*)$', re.MULTILINE | re.IGNORECASE)
+_ADDRESS_DATA_PARTIAL = '\n'.join(
+    ['<C:address-data>']
+    + [f'            <C:prop name="{name}"/>' for name in LIST_VIEW_PROPS]
+    + ['            <C:prop name="PHOTO" novalue="yes"/>', '        </C:address-data>']
+)
+
+
+class CardDAVError(Exception):
+    """Unexpected status from the CardDAV server."""
+
+    def __init__(self, status_code: int, message: str = ''):
+        super().__init__(message or f"Status {status_code}")
+        self.status_code = status_code
+
+
+class InvalidSyncToken(Exception):
+    """The server no longer accepts our sync-token; a full resync is needed."""
+
+
+class SyncUnsupported(Exception):
+    """The server does not implement the sync-collection REPORT."""
+
+
+def _card_digest(contact: dict) -> int:
+    key = f"{contact['href']}\0{contact['etag']}".encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+
+class AddressBookState:
+    """What one worker knows about one user's collection."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.sync_token = None
+        self.supports_sync = True
+        self.partial_data = None if PARTIAL_ADDRESS_DATA else False  # None until probed
+        self.synced = False
+        self.contacts = {}  # href -> contact dict (carries its etag)
+        self.digest = 0  # XOR of _card_digest over contacts, a local CTag
+        self.index = None  # SearchIndex, built on first search
+        self.orders = {}  # sort_by -> SortOrder, built on first use
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.sync_token = None
+        self.synced = False
+        self.contacts = {}
+        self.digest = 0
+        self.index = None
+        self.orders = {}
+
+    def put(self, contact: dict) -> None:
+        previous = self.contacts.get(contact['href'])
+        if previous is not None:
+            self.digest ^= _card_digest(previous)
+        self.contacts[contact['href']] = contact
+        self.digest ^= _card_digest(contact)
+        if self.index is not None:
+            self.index.add(contact)
+        for order in self.orders.values():
+            order.add(contact)
+
+    def discard(self, href: str) -> None:
+        contact = self.contacts.pop(href, None)
+        if contact is None:
+            return
+        self.digest ^= _card_digest(contact)
+        if self.index is not None:
+            self.index.remove(href)
+        for order in self.orders.values():
+            order.remove(href)
+
+    def sort_order(self, sort_by: str) -> SortOrder:
+        order = self.orders.get(sort_by)
+        metrics.cache_lookup('sort_orders', hits=order is not None, misses=order is None)
+        if order is None:
+            order = self.orders[sort_by] = SortOrder(sort_by, self.contacts.values())
+        return order
+
+    def search_index(self) -> SearchIndex:
+        metrics.cache_lookup('search_indexes', hits=self.index is not None, misses=self.index is None)
+        if self.index is None:
+            started = time.monotonic()
+            self.index = SearchIndex(self.contacts.values())
+            logger.info(
+                f"Built search index of {len(self.index)} contacts "
+                f"in {(time.monotonic() - started) * 1000:.0f} ms."
+            )
+        return self.index
+
+
+_sync_states: Dict[tuple, AddressBookState] = {}
+_sync_states_lock = threading.Lock()
+
+
+def get_sync_state(username: str, url: str) -> AddressBookState:
+    key = (username, url)
+    with _sync_states_lock:
+        state = _sync_states.get(key)
+        if state is None:
+            state = _sync_states[key] = AddressBookState(url)
+        return state
+
+
+def books_synced(username: str) -> bool:
+    """Whether this worker holds a synced copy of every address book of
+    `username` it knows of."""
+    with _sync_states_lock:
+        states = [state for (user, _), state in _sync_states.items() if user == username]
+    return bool(states) and all(state.synced for state in states)
+
+
+def drop_sync_states(username: str) -> None:
+    with _sync_states_lock:
+        for key in [k for k in _sync_states if k[0] == username]:
+            del _sync_states[key]
+    count_synced_contacts()
+
+
+def count_synced_contacts() -> None:
+    with _sync_states_lock:
+        states = list(_sync_states.values())
+    metrics.CONTACTS.set(sum(len(state.contacts) for state in states))
+
+
+def _dav_request(s: requests.Session, method: str, url: str, body: str, depth: str,
+                 timeout: int = 30, stream: bool = False):
+    return s.request(
+        method, url,
+        headers={
+            'Depth': depth,
+            'Content-Type': 'application/xml; charset=utf-8',
+        },
+        data=body.encode('utf-8'),
+        timeout=timeout,
+        stream=stream
+    )
+
+
+def _card_etags_from_multistatus(responses) -> tuple:
+    """Split multistatus responses into ({href: etag} for live cards, {removed hrefs})."""
+    changed, removed = {}, set()
+    for r in responses:
+        if not r.href.endswith('.vcf'):
+            continue
+        if r.status == 404:
+            removed.add(r.href)
+        else:
+            changed[r.href] = r.etag
+    return changed, removed
+
+
+def _sync_collection(s: requests.Session, url: str, token) -> tuple:
+    """Run sync-collection from `token` until the server reports no truncation.
+    Returns ({href: etag} changed, {href} removed, new token)."""
+    changed, removed = {}, set()
+    for _ in range(50):
+        body = f'''<?xml version="1.0" encoding="utf-8" ?>
+<D:sync-collection xmlns:D="DAV:">
+    <D:sync-token>{xml_escape(token or '')}</D:sync-token>
+    <D:sync-level>1</D:sync-level>
+    <D:prop>
+        <D:getetag/>
+    </D:prop>
+</D:sync-collection>'''
+        with _dav_request(s, 'REPORT', url, body, depth='0', stream=True) as resp:
+            logger.info(f"REPORT sync-collection → {resp.status_code}")
+
+            if resp.status_code in (403, 409) and b'valid-sync-token' in resp.content:
+                raise InvalidSyncToken()
+            if resp.status_code in (400, 403, 404, 405, 415, 501):
+                raise SyncUnsupported()
+            if resp.status_code != 207:
+                raise CardDAVError(resp.status_code, f"sync-collection failed: {resp.status_code}")
+
+            # RFC 6578 §3.6: a 507 on the collection itself means "more to come".
+            collection_statuses = []
+            stream = MultistatusStream(metrics.metered(resp.iter_content(STREAM_CHUNK_SIZE), 'sync-collection'))
+
+            def card_responses():
+                for r in stream:
+                    if r.href.endswith('.vcf'):
+                        yield r
+                    else:
+                        collection_statuses.append(r.status)
+
+            batch_changed, batch_removed = _card_etags_from_multistatus(card_responses())
+
+        for href in batch_removed:
+            changed.pop(href, None)
+        removed -= set(batch_changed)
+        changed.update(batch_changed)
+        removed |= batch_removed
+
+        new_token = stream.sync_token
+        truncated = 507 in collection_statuses
+        if not truncated or not new_token or new_token == token:
+            return changed, removed, new_token
+        token = new_token
+    return changed, removed, token
+
+
+def _propfind_etags(s: requests.Session, url: str) -> dict:
+    body = '''<?xml version="1.0" encoding="utf-8" ?>
+<D:propfind xmlns:D="DAV:">
+    <D:prop>
+        <D:getetag/>
+    </D:prop>
+</D:propfind>'''
+    with _dav_request(s, 'PROPFIND', url, body, depth='1', stream=True) as resp:
+        logger.info(f"PROPFIND getetag → {resp.status_code}")
+        if resp.status_code != 207:
+            raise CardDAVError(resp.status_code, f"PROPFIND failed: {resp.status_code}")
+        changed, _ = _card_etags_from_multistatus(MultistatusStream(resp.iter_content(STREAM_CHUNK_SIZE)))
+    return changed
+
+
+def _probe_partial_data(text: str):
+    """Whether a card answered to a partial request shows the server honours
+    partial retrieval: False if it carries properties we did not ask for,
+    True if PHOTO came back without its value, None if it cannot tell."""
+    names = {m.upper() for m in _PROP_NAME_RE.findall(text)}
+    if names - _PARTIAL_ALLOWED:
+        return False
+    if 'PHOTO' in names:
+        photo = _PHOTO_LINE_RE.search(text)
+        return photo is not None and not photo.group(1).strip()
+    return None
+
+
+def multiget_contacts(s: requests.Session, url: str, hrefs: list, state: AddressBookState = None) -> list:
+    """Fetch and parse the given cards with addressbook-multiget. With a
+    `state`, the list-view subset is requested when the server supports it."""
+    parallel = len(hrefs) >= PARSE_POOL_THRESHOLD
+    if parallel:
+        logger.info(f"Parsing {len(hrefs)} cards across {PARSE_WORKERS} processes.")
+    return list(parse_cards(_iter_multiget_cards(s, url, hrefs, state), parallel))
+
+
+def _iter_multiget_cards(s: requests.Session, url: str, hrefs: list, state: AddressBookState = None):
+    """Yield (href, etag, text, photo_novalue) for the given cards, one
+    multiget batch at a time. The first partial responses are used to probe
+    whether the server honours partial retrieval; the answer is kept on
+    `state` and later batches fall back to full cards if it does not."""
+    for i in range(0, len(hrefs), MULTIGET_BATCH):
+        batch = hrefs[i:i + MULTIGET_BATCH]
+        href_xml = '\n'.join(f"    <D:href>{xml_escape(h)}</D:href>" for h in batch)
+        while True:
+            partial = state is not None and state.partial_data is not False
+            address_data = _ADDRESS_DATA_PARTIAL if partial else '<C:address-data/>'
+            body = f'''<?xml version="1.0" encoding="utf-8" ?>
+<C:addressbook-multiget xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav">
+    <D:prop>
+        <D:getetag/>
+        {address_data}
+    </D:prop>
+{href_xml}
+</C:addressbook-multiget>'''
+            with _dav_request(s, 'REPORT', url, body, depth='1', stream=True) as resp:
+                logger.info(f"REPORT multiget ({len(batch)} cards{', partial' if partial else ''}) → {resp.status_code}")
+                if partial and resp.status_code in (400, 403, 415, 422, 501):
+                    logger.info("Server rejected partial address-data — requesting full cards.")
+                    state.partial_data = False
+                    continue
+                if resp.status_code != 207:
+                    raise CardDAVError(resp.status_code, f"multiget failed: {resp.status_code}")
+                seen = False
+                chunks = metrics.metered(resp.iter_content(STREAM_CHUNK_SIZE), 'multiget')
+                for href, etag, text in iter_report_cards(chunks):
+                    seen = True
+                    if partial and state.partial_data is None:
+                        state.partial_data = _probe_partial_data(text)
+                        if state.partial_data is False:
+                            logger.info("Server ignores partial address-data — requesting full cards.")
+                    yield href, etag, text, partial and state.partial_data is not False
+            if partial and seen and state.partial_data is None:
+                # A whole batch held nothing we did not ask for: assume honoured.
+                state.partial_data = True
+            break
+
+
+def sync_address_book(s: requests.Session, username: str, url: str) -> list:
+    """Bring the cached view of `url` up to date and return its contacts (unsorted)."""
+    state = get_sync_state(username, url)
+    with state.lock:
+        changed = removed = None
+        token = None
+        if state.supports_sync:
+            try:
+                changed, removed, token = _sync_collection(s, url, state.sync_token)
+            except InvalidSyncToken:
+                logger.info("Sync-token rejected — resyncing from scratch.")
+                state.reset()
+                changed, removed, token = _sync_collection(s, url, None)
+            except SyncUnsupported:
+                logger.info("Server lacks sync-collection — falling back to ETag PROPFIND.")
+                state.supports_sync = False
+            if state.supports_sync and state.sync_token is None:
+                # An initial sync lists the whole collection: anything else is gone.
+                removed = set(state.contacts) - set(changed)
+        if not state.supports_sync:
+            changed = _propfind_etags(s, url)
+            removed = set(state.contacts) - set(changed)
+
+        for href in removed:
+            state.discard(href)
+
+        stale = [
+            href for href, etag in changed.items()
+            if href not in state.contacts or not etag or state.contacts[href]['etag'] != etag
+        ]
+        with metrics.phase('cache'):
+            cached = contact_cache.get_many(username, {href: changed[href] for href in stale})
+        for contact in cached.values():
+            state.put(contact)
+        missing = [href for href in stale if href not in cached]
+        if missing:
+            fetched = multiget_contacts(s, url, missing, state)
+            with metrics.phase('cache'):
+                contact_cache.put_many(username, fetched)
+            for contact in fetched:
+                state.put(contact)
+            # Cards deleted between the listing and the multiget
+            for href in set(missing) - {c['href'] for c in fetched}:
+                state.discard(href)
+
+        state.sync_token = token
+        state.synced = True
+        logger.info(
+            f"Sync: {len(stale)} changed ({len(cached)} from cache), "
+            f"{len(removed)} removed, {len(state.contacts)} total."
+        )
+        return list(state.contacts.values())
+
+
+def synced_state(s: requests.Session, username: str, url: str, refresh: bool = True) -> AddressBookState:
+    """State of `url`, synced first unless `refresh` is False and this
+    worker already holds a synced copy."""
+    state = get_sync_state(username, url)
+    if not refresh:
+        metrics.cache_lookup('sync_states', hits=state.synced, misses=not state.synced)
+    if refresh or not state.synced:
+        sync_address_book(s, username, url)
+    return state
+
+
+# ---------------------------------------------------------------------------
+# Address-book discovery
+# A user may have several collections (personal, work, shared). They are
+# found as RFC 6352 §7 describes — current-user-principal, then its
+# addressbook-home-set, then a Depth-1 PROPFIND of each home — and the list
+# is kept per worker for DISCOVERY_TTL seconds. The CARDDAV_URL collection
+# always comes first, and is the only one if discovery is off or fails.
+# Page loads sync every collection concurrently and merge their sort orders.
+# ---------------------------------------------------------------------------
+
+DISCOVER_ADDRESS_BOOKS = os.environ.get('DISCOVER_ADDRESS_BOOKS', '1') != '0'
+DISCOVERY_TTL = int(os.environ.get('DISCOVERY_TTL', '300'))
+BOOK_CONCURRENCY = int(os.environ.get('BOOK_CONCURRENCY', '4'))
+
+AddressBook = namedtuple('AddressBook', 'url name')
+
+_address_books: Dict[str, tuple] = {}  # username -> (discovered at, [AddressBook])
+_address_books_lock = threading.Lock()
+
+
+def _propfind_tree(s: requests.Session, url: str, props: str, depth: str) -> ElementTree.Element:
+    body = f'''<?xml version="1.0" encoding="utf-8" ?>
+<D:propfind xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav">
+    <D:prop>
+        {props}
+    </D:prop>
+</D:propfind>'''
+    resp = _dav_request(s, 'PROPFIND', url, body, depth=depth, timeout=10)
+    if resp.status_code != 207:
+        raise CardDAVError(resp.status_code, f"PROPFIND failed: {resp.status_code}")
+    return ElementTree.fromstring(resp.content)
+
+
+def _server_url(href: str):
+    """Absolute URL of an href the server returned, or None if it points to
+    another host. Scheme and host always come from CARDDAV_URL."""
+    parsed = urlparse(href.strip())
+    if parsed.netloc and parsed.netloc != _FIXED_NETLOC:
+        return None
+    return urlunparse((_FIXED_SCHEME, _FIXED_NETLOC, parsed.path.rstrip('/'), '', '', ''))
+
+
+def discover_address_books(s: requests.Session, username: str) -> list:
+    """The user's address books, the CARDDAV_URL one first."""
+    primary = build_user_url(username)
+    primary_path = urlparse(primary).path.rstrip('/')
+    books = {primary_path: AddressBook(primary, '')}
+    if not DISCOVER_ADDRESS_BOOKS:
+        return list(books.values())
+    try:
+        tree = _propfind_tree(s, primary, '<D:current-user-principal/>', '0')
+        principal = _server_url(tree.findtext('.//D:current-user-principal/D:href', '', DAV_NS))
+        if not principal:
+            return list(books.values())
+        tree = _propfind_tree(s, principal, '<C:addressbook-home-set/>', '0')
+        for home in tree.findall('.//C:addressbook-home-set/D:href', DAV_NS):
+            home_url = _server_url(home.text or '')
+            if not home_url:
+                continue
+            tree = _propfind_tree(s, home_url, '<D:resourcetype/><D:displayname/>', '1')
+            for r in tree.findall('D:response', DAV_NS):
+                if r.find('.//D:resourcetype/C:addressbook', DAV_NS) is None:
+                    continue
+                url = _server_url(r.findtext('D:href', '', DAV_NS))
+                if url:
+                    path = urlparse(url).path
+                    name = r.findtext('.//D:displayname', '', DAV_NS).strip()
+                    books[path] = AddressBook(primary if path == primary_path else url, name)
+    except Exception as e:
+        logger.warning(f"Address-book discovery failed, using CARDDAV_URL only: {e}")
+        return [AddressBook(primary, '')]
+    logger.info(f"Discovered {len(books)} address book(s).")
+    return list(books.values())
+
+
+def user_address_books(s: requests.Session, username: str) -> list:
+    """discover_address_books(), cached for DISCOVERY_TTL seconds."""
+    with _address_books_lock:
+        entry = _address_books.get(username)
+    if entry is not None and time.monotonic() - entry[0] < DISCOVERY_TTL:
+        metrics.cache_lookup('address_books', hits=1)
+        return entry[1]
+    metrics.cache_lookup('address_books', misses=1)
+    books = discover_address_books(s, username)
+    with _address_books_lock:
+        _address_books[username] = (time.monotonic(), books)
+    return books
+
+
+def forget_address_books(username: str) -> None:
+    with _address_books_lock:
+        _address_books.pop(username, None)
+
+
+def synced_books(s: requests.Session, username: str, refresh: bool = True) -> list:
+    """synced_state() of every address book of the user, synced concurrently
+    so a page load costs about as much as the slowest book. A book other
+    than the CARDDAV_URL one that fails to sync is left out."""
+    books = user_address_books(s, username)
+    if len(books) == 1:
+        states = [synced_state(s, username, books[0].url, refresh)]
+        count_synced_contacts()
+        return states
+
+    def sync(book: AddressBook):
+        try:
+            return synced_state(s, username, book.url, refresh)
+        except Exception as e:
+            if book is books[0]:
+                raise
+            logger.warning(f"Leaving out address book '{book.name}': {e}")
+            return None
+
+    # Each book syncs in a copy of this context, so its timings reach the request
+    contexts = [contextvars.copy_context() for _ in books]
+    with ThreadPoolExecutor(max_workers=max(1, min(BOOK_CONCURRENCY, len(books)))) as pool:
+        states = [state for state in pool.map(lambda c, b: c.run(sync, b), contexts, books) if state is not None]
+    count_synced_contacts()
+    return states
+
+
+def contact_location(s: requests.Session, username: str, contact_id: str) -> tuple:
+    """(address book url, card url, href) of a contact id. Raises ValueError
+    unless the id names a card in one of the user's address books."""
+    collection, _, name = contact_href(contact_id).rpartition('/')
+    if name in ('', '.', '..'):
+        raise ValueError('Unknown contact.')
+    for book in user_address_books(s, username):
+        if urlparse(book.url).path.rstrip('/') == collection:
+            return book.url, f"{book.url.rstrip('/')}/{name}", contact_href(contact_id)
+    raise ValueError('Unknown contact.')
+
+
+def search_contacts(states: list, q: str, limit: int, sort_by: str = 'first_name'):
+    """(best, total): the `limit` best (score, sort key, contact) matches of
+    `q` in the address books of `states`, ties in `sort_by` order, and the
+    number of matches. None when `q` has nothing to search for."""
+    ranked, total = [], 0
+    with metrics.phase('search'):
+        for state in states:
+            with state.lock:
+                scores = state.search_index().search(q)
+                if scores is None:
+                    return None
+                total += len(scores)
+                ranked.extend(
+                    (scores[href], key, state.contacts[href])
+                    for key, href in state.sort_order(sort_by).best(scores, limit)
+                )
+    return heapq.nsmallest(limit, ranked, key=lambda m: (-m[0], m[1])), total
+
+
+# ---------------------------------------------------------------------------
+# Background refresh
+# Each worker keeps the address books of its active users synced from a
+# daemon thread: right after login, then every REFRESH_INTERVAL seconds
+# (give or take REFRESH_JITTER, so users do not all refresh at once). Page
+# loads then find a warm copy and only ask the server for what changed. A
+# user stops being refreshed at logout or after REFRESH_IDLE_TIMEOUT seconds
+# without a request.
+# ---------------------------------------------------------------------------
+
+REFRESH_INTERVAL = int(os.environ.get('REFRESH_INTERVAL', '120'))  # 0 disables
+REFRESH_JITTER = float(os.environ.get('REFRESH_JITTER', '0.2'))
+REFRESH_IDLE_TIMEOUT = int(os.environ.get('REFRESH_IDLE_TIMEOUT', '1800'))
+
+
+class Refresher:
+    """Schedule of the users this worker refreshes, and the thread doing it."""
+
+    def __init__(self, interval: int, jitter: float, idle_timeout: int):
+        self.interval = interval
+        self.jitter = min(max(jitter, 0.0), 1.0)
+        self.idle_timeout = idle_timeout
+        self._users = {}  # username -> [password, last request, next refresh]
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def _next_refresh(self, now: float) -> float:
+        return now + self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def track(self, username: str, password: str, prefetch: bool = False) -> None:
+        """Note a request by `username`. With `prefetch` (at login), the
+        user's books are refreshed right away instead of an interval later."""
+        if self.interval <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(username)
+            if entry is None or entry[0] != password:
+                entry = self._users[username] = [password, now, self._next_refresh(now)]
+            entry[1] = now
+            if prefetch:
+                entry[2] = now
+            if self._pid != os.getpid():
+                # First use in this process (gunicorn forks after import)
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='refresher', daemon=True).start()
+        if prefetch:
+            self._wake.set()
+
+    def forget(self, username: str) -> None:
+        with self._lock:
+            self._users.pop(username, None)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            apply_logouts()
+            now = time.monotonic()
+            with self._lock:
+                for username in [u for u, e in self._users.items() if now - e[1] > self.idle_timeout]:
+                    del self._users[username]
+                due = [(u, e[0]) for u, e in self._users.items() if e[2] <= now]
+                for username, _ in due:
+                    self._users[username][2] = self._next_refresh(now)
+            for username, password in due:
+                self._refresh(username, password)
+            with self._lock:
+                next_due = min((e[2] for e in self._users.values()), default=None)
+            timeout = self.interval if next_due is None else next_due - time.monotonic()
+            self._wake.wait(max(timeout, 0.05))
+
+    def _refresh(self, username: str, password: str) -> None:
+        started = time.monotonic()
+        try:
+            states = synced_books(session_pool.get(username, password), username)
+            for state in states:
+                with state.lock:
+                    state.sort_order('first_name')  # what the first page needs
+        except CardDAVError as e:
+            if e.status_code == 401:
+                self.forget(username)
+            logger.warning(f"Background refresh failed: {e}")
+            return
+        except Exception as e:
+            logger.warning(f"Background refresh failed: {e}")
+            return
+        logger.info(
+            f"Background refresh of {len(states)} address book(s) "
+            f"in {(time.monotonic() - started) * 1000:.0f} ms."
+        )
+
+
+refresher = Refresher(REFRESH_INTERVAL, REFRESH_JITTER, REFRESH_IDLE_TIMEOUT)
+
+
+# ---------------------------------------------------------------------------
+# Logout
+# A logout is served by one worker, but every worker may hold the user's
+# password, synced books and refresh schedule. The logging-out worker writes
+# a marker to the shared SQLite cache; the others read the markers they have
+# not seen yet on each logged-in request and in their refresher thread, and
+# drop the state of those users.
+# ---------------------------------------------------------------------------
+
+_logouts_seen = contact_cache.logouts_after(0)[1]  # older logouts left no state here
+_logouts_lock = threading.Lock()
+
+
+def forget_user(username: str) -> None:
+    """Drop everything this worker holds for `username`."""
+    drop_sync_states(username)
+    forget_address_books(username)
+    forget_duplicates(username)
+    refresher.forget(username)
+    session_pool.discard(username)
+    client_pool.discard(username)
+
+
+def apply_logouts() -> None:
+    global _logouts_seen
+    with _logouts_lock:
+        usernames, _logouts_seen = contact_cache.logouts_after(_logouts_seen)
+    for username in dict.fromkeys(usernames):
+        forget_user(username)
+
+
+# ---------------------------------------------------------------------------
+# Photos
+# Avatars are served by their own route so browsers can cache them. The list
+# links each one with ?v=<tag>, a digest of the card's ETag: a new card
+# revision gets a new URL, so the old one can be cached as immutable.
+# ---------------------------------------------------------------------------
+
+PHOTO_MAX_AGE = int(os.environ.get('PHOTO_MAX_AGE', str(365 * 24 * 3600)))
+
+
+def photo_tag(card_etag: str) -> str:
+    return hashlib.sha1(card_etag.encode('utf-8')).hexdigest()[:16]
+
+
+def photo_url(contact: dict, thumb: bool = False) -> str:
+    v = photo_tag(contact.get('etag') or contact['id'])
+    if thumb:
+        return url_for('contact_photo', contact_id=contact['id'], v=v, size='thumb')
+    return url_for('contact_photo', contact_id=contact['id'], v=v)
+
+
+app.jinja_env.globals['photo_url'] = photo_url
+
+
+# List avatars are small, so they are served as thumbnails cached on disk.
+# A thumbnail's file name is derived from the card-ETag tag, so a new card
+# revision never reuses an old thumbnail.
+THUMB_DIR = os.path.join(CACHE_DIR, 'thumbs')
+THUMB_SIZE = int(os.environ.get('THUMB_SIZE', '96'))
+THUMB_CACHE_MAX = int(os.environ.get('THUMB_CACHE_MAX', '20000'))
+_thumb_writes = 0
+
+
+def _thumb_path(username: str, href: str, tag: str) -> str:
+    key = hashlib.sha256(f"{username}\0{href}\0{tag}\0{THUMB_SIZE}".encode('utf-8')).hexdigest()
+    return os.path.join(THUMB_DIR, key[:2], f"{key}.jpg")
+
+
+def read_thumbnail(username: str, href: str, tag: str):
+    try:
+        with open(_thumb_path(username, href, tag), 'rb') as f:
+            thumb = f.read()
+    except OSError:
+        metrics.cache_lookup('thumbnails', misses=1)
+        return None
+    metrics.cache_lookup('thumbnails', hits=1)
+    return thumb
+
+
+def make_thumbnail(username: str, href: str, tag: str, data: bytes):
+    """Render and store a THUMB_SIZE JPEG thumbnail. Returns None if Pillow
+    is unavailable or the image cannot be decoded."""
+    global _thumb_writes
+    if Image is None:
+        return None
+    try:
+        img = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+        img = ImageOps.fit(img.convert('RGB'), (THUMB_SIZE, THUMB_SIZE), Image.LANCZOS)
+        out = BytesIO()
+        img.save(out, format='JPEG', quality=80, optimize=True)
+    except Exception as e:
+        logger.warning(f"Could not render thumbnail: {e}")
+        return None
+    thumb = out.getvalue()
+
+    path = _thumb_path(username, href, tag)
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(thumb)
+        os.replace(tmp, path)
+        _thumb_writes += 1
+        if _thumb_writes % 200 == 0:
+            _prune_thumbnails()
+    except OSError as e:
+        logger.warning(f"Could not store thumbnail: {e}")
+    return thumb
+
+
+def _prune_thumbnails() -> None:
+    """Drop the least recently written thumbnails beyond THUMB_CACHE_MAX."""
+    entries = []
+    for root, _, files in os.walk(THUMB_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+    if len(entries) <= THUMB_CACHE_MAX:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - THUMB_CACHE_MAX]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# ---------------------------------------------------------------------------
+# Contact listing API
+# Pages are cut from the sorted list with keyset cursors: a cursor is the
+# sort key of the last row served, so pages stay stable while cards change.
+# ---------------------------------------------------------------------------
+
+VALID_SORTS = ('first_name', 'last_name', 'org')
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', '50'))
+PAGE_SIZE_MAX = 500
+
+
+def encode_cursor(key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def _is_field_key(part) -> bool:
+    """Whether `part` has the shape of a _sort_key(): (int, str, str)."""
+    return (isinstance(part, list) and len(part) == 3 and type(part[0]) is int
+            and isinstance(part[1], str) and isinstance(part[2], str))
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Inverse of encode_cursor. Raises ValueError on a malformed cursor,
+    including one that decodes but is not shaped like a contact_sort_key(),
+    which would not compare with the keys of a sort order."""
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    if not (isinstance(raw, list) and len(raw) == 3 and _is_field_key(raw[0]) and _is_field_key(raw[1])
+            and isinstance(raw[2], str)):
+        raise ValueError("Invalid cursor: not a sort key.")
+    return tuple(raw[0]), tuple(raw[1]), raw[2]
+
+
+def paginate_entries(entries: list, cursor: str = '', limit: int = PAGE_SIZE) -> tuple:
+    """Return (page, next_cursor) from SortOrder (key, href) entries."""
+    start = 0
+    if cursor:
+        start = bisect.bisect_right(entries, decode_cursor(cursor), key=operator.itemgetter(0))
+    page = entries[start:start + limit]
+    next_cursor = None
+    if start + limit < len(entries) and page:
+        next_cursor = encode_cursor(page[-1][0])
+    return page, next_cursor
+
+
+def contact_to_json(contact: dict) -> dict:
+    return {
+        'id': contact['id'],
+        'uid': contact['uid'],
+        'etag': contact['etag'],
+        'name': contact['name'],
+        'first_name': _as_str(contact['first_name']),
+        'last_name': _as_str(contact['last_name']),
+        'email': _as_str(contact['email']),
+        'phone': _as_str(contact['phone']),
+        'org': contact['org'],
+        'url': contact['url'],
+        'birthday': contact['birthday'],
+        'note': contact['note'],
+        'address': contact['address'],
+        'initials': contact['initials'],
+        'photo_url': photo_url(contact, thumb=True) if contact['has_photo'] else None,
+    }
+
+
+def contacts_page(states: list, sort_by: str, q: str = '', cursor: str = '',
+                  limit: int = PAGE_SIZE) -> dict:
+    """Filter the contacts of `states` (one per address book) by `q` and cut
+    one page in `sort_by` order, shaped as the JSON the list consumes. Each
+    book contributes at most one page after `cursor`; those are merged."""
+    with metrics.phase('sort'):
+        pages, total, more = [], 0, False
+        for state in states:
+            with state.lock:
+                order = state.sort_order(sort_by)
+                scores = state.search_index().search(q) if q else None
+                entries = order.entries if scores is None else order.subset(scores)
+                page, next_cursor = paginate_entries(entries, cursor, limit)
+                pages.append([(key, state.contacts[href]) for key, href in page])
+                total += len(entries)
+                more = more or next_cursor is not None
+        merged = list(heapq.merge(*pages, key=operator.itemgetter(0)))
+        page = merged[:limit]
+        next_cursor = None
+        if page and (more or len(merged) > limit):
+            next_cursor = encode_cursor(page[-1][0])
+        return {
+            'contacts': [contact_to_json(c) for _, c in page],
+            'next_cursor': next_cursor,
+            'total': total,
+            'sort': sort_by,
+            'q': q,
+        }
+
+
+# ---------------------------------------------------------------------------
+# Export
+# Exports stream an addressbook-query REPORT straight through: each card is
+# re-emitted (VCF) or flattened to a row (CSV) as soon as its D:response is
+# parsed, and output leaves in STREAM_CHUNK_SIZE pieces, so worker memory
+# stays flat however large or photo-heavy the collection is.
+# ---------------------------------------------------------------------------
+
+# Same names as the form fields, so an exported CSV imports back as-is.
+EXPORT_CSV_COLUMNS = (
+    'first_name', 'last_name', 'name', 'email', 'phone', 'organization', 'url',
+    'birthday', 'note', 'street', 'city', 'postal', 'country', 'uid',
+)
+
+
+def open_export_report(s: requests.Session, url: str, partial: bool = False) -> requests.Response:
+    """Start an addressbook-query REPORT of every card, unread. The caller
+    closes the response. With `partial`, only the list-view properties."""
+    address_data = _ADDRESS_DATA_PARTIAL if partial else '<C:address-data/>'
+    body = f'''<?xml version="1.0" encoding="utf-8" ?>
+<C:addressbook-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav">
+    <D:prop>
+        <D:getetag/>
+        {address_data}
+    </D:prop>
+</C:addressbook-query>'''
+    resp = _dav_request(s, 'REPORT', url, body, depth='1', timeout=60, stream=True)
+    logger.info(f"REPORT addressbook-query (export{', partial' if partial else ''}) → {resp.status_code}")
+    if resp.status_code != 207:
+        resp.close()
+        raise CardDAVError(resp.status_code, f"addressbook-query failed: {resp.status_code}")
+    return resp
+
+
+def _chunked(pieces):
+    """Regroup many small strings into byte chunks of about STREAM_CHUNK_SIZE.
+    The first piece goes out alone so the download starts at once."""
+    pieces = iter(pieces)
+    for piece in pieces:
+        yield piece.encode('utf-8')
+        break
+    buf, size = [], 0
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        buf.append(data)
+        size += len(data)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b''.join(buf)
+
+
+def export_vcf(responses):
+    """Yield the cards of open REPORT responses, one per address book, as
+    one .vcf text."""
+    for resp in responses:
+        try:
+            chunks = metrics.metered(resp.iter_content(STREAM_CHUNK_SIZE), 'addressbook-query')
+            for _, _, text in iter_report_cards(chunks):
+                # The XML parser turned CRLF into LF; vCard wants CRLF back.
+                yield '\r\n'.join(text.strip().splitlines()) + '\r\n'
+        finally:
+            resp.close()
+
+
+def export_csv(responses):
+    """Yield a CSV header and one row per card of open REPORT responses,
+    one per address book."""
+    out = StringIO()
+    writer = csv.writer(out)
+
+    def row(values) -> str:
+        writer.writerow(values)
+        text = out.getvalue()
+        out.seek(0)
+        out.truncate()
+        return text
+
+    yield row(EXPORT_CSV_COLUMNS)
+    for resp in responses:
+        try:
+            chunks = metrics.metered(resp.iter_content(STREAM_CHUNK_SIZE), 'addressbook-query')
+            for contact in iter_contacts_from_report(chunks):
+                address = contact['address'] or {}
+                yield row([
+                    _as_str(contact['first_name']), _as_str(contact['last_name']), contact['name'],
+                    _as_str(contact['email']), _as_str(contact['phone']), contact['org'], contact['url'],
+                    contact['birthday'], contact['note'],
+                    address.get('street', ''), address.get('city', ''),
+                    address.get('postal', ''), address.get('country', ''),
+                    contact['uid'],
+                ])
+        finally:
+            resp.close()
+
+
+# ---------------------------------------------------------------------------
+# Batch operations
+# One request applies one operation to many contacts. DELETEs and GET/PUT
+# edits run concurrently on the user's carddav_async client; each item reports
+# its own outcome, and the list is refreshed once afterwards.
+# ---------------------------------------------------------------------------
+
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+BATCH_MAX_ITEMS = 1000
+
+# Field name in the API -> (vCard property, value normaliser)
+BATCH_FIELDS = {
+    'org': ('org', lambda v: [v]),
+    'url': ('url', lambda v: v),
+    'note': ('note', lambda v: v),
+    'birthday': ('bday', lambda v: normalize_birthday_to_iso(v)),
+}
+BATCH_OPS = ('delete', 'set', 'append_note')
+
+
+class BatchItemError(Exception):
+    """One item of a batch failed; `status` is the upstream status if any."""
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+
+def edit_vcard(text: str, op: str, field: str, value: str) -> str:
+    """Apply a batch edit to a card with vobject, keeping every property the
+    form does not know about."""
+    card = vobject.readOne(text)
+    if op == 'append_note':
+        current = card.note.value if 'note' in card.contents else ''
+        prop, value = 'note', f"{current}\n{value}" if current else value
+    else:
+        prop, normalise = BATCH_FIELDS[field]
+        value = normalise(value) if value else None
+    for existing in list(card.contents.get(prop, [])):
+        card.remove(existing)
+    if value:
+        card.add(prop).value = value
+    return card.serialize()
+
+
+async def _batch_item(client: AsyncCardDAVClient, contact_id: str, contact_url: str,
+                      op: str, field: str, value: str) -> dict:
+    try:
+        if contact_url is None:
+            raise BatchItemError('Unknown contact.')
+        if op == 'delete':
+            resp = await client.delete(contact_url)
+            if resp.status_code not in (200, 204, 404):
+                raise BatchItemError(f"Status {resp.status_code}", resp.status_code)
+            return {'id': contact_id, 'ok': True, 'status': resp.status_code, 'error': None}
+
+        resp = await client.get(contact_url)
+        if resp.status_code != 200:
+            raise BatchItemError(f"Could not fetch contact: status {resp.status_code}", resp.status_code)
+        try:
+            vcard_content = edit_vcard(resp.text, op, field, value)
+        except Exception as e:
+            raise BatchItemError(f"Could not edit vCard: {e}")
+        # If-Match: someone else's change between our GET and PUT must not be lost
+        put = await client.put(contact_url, vcard_content, etag=resp.headers.get('ETag', ''))
+        if put.status_code == 412:
+            raise BatchItemError('Changed on the server meanwhile; reload and retry.', 412)
+        if put.status_code not in (200, 201, 204):
+            raise BatchItemError(f"Status {put.status_code}", put.status_code)
+        return {'id': contact_id, 'ok': True, 'status': put.status_code, 'error': None}
+    except BatchItemError as e:
+        return {'id': contact_id, 'ok': False, 'status': e.status, 'error': str(e)}
+    except Exception as e:
+        return {'id': contact_id, 'ok': False, 'status': None, 'error': str(e) or type(e).__name__}
+
+
+def run_batch(client: CardDAVClient, s: requests.Session, username: str, ids: list,
+              op: str, field: str = '', value: str = '') -> list:
+    """Apply `op` to every contact of `ids`, BATCH_CONCURRENCY at a time on
+    the event loop. Returns one result dict per id, in order."""
+    urls = {}
+    for contact_id in ids:
+        try:
+            urls[contact_id] = contact_location(s, username, contact_id)[1]
+        except ValueError:
+            urls[contact_id] = None
+    results = client.map(
+        lambda aio, cid: _batch_item(aio, cid, urls[cid], op, field, value),
+        ids, BATCH_CONCURRENCY
+    )
+    for contact_id in ids:
+        contact_cache.invalidate(username, contact_href(contact_id))
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Duplicates
+# Contacts are put into blocks by keys that copies of one person are likely
+# to share: the UID, the normalised email, the last digits of the phone
+# number and a phonetic code of the name. Only contacts of a same block are
+# compared, so the work grows with the size of the blocks instead of with n²;
+# a block larger than DUPLICATE_BLOCK_MAX (a shared office number, a very
+# common name) tells little and is left out. Candidate pairs are scored, and
+# pairs scoring DUPLICATE_MIN_SCORE or more are joined into groups, kept until
+# the collection changes. A merge adds what the other cards have to the kept
+# card and deletes them.
+# ---------------------------------------------------------------------------
+
+DUPLICATE_MIN_SCORE = float(os.environ.get('DUPLICATE_MIN_SCORE', '0.5'))
+DUPLICATE_BLOCK_MAX = int(os.environ.get('DUPLICATE_BLOCK_MAX', '100'))
+DUPLICATE_PHONE_DIGITS = 9  # the subscriber number, without country or trunk prefix
+MERGE_MAX_CARDS = 20
+
+# Evidence for, or against, two cards being the same person
+_DUP_SAME_UID = 1.0
+_DUP_SAME_EMAIL, _DUP_SAME_PHONE = 0.7, 0.5
+_DUP_SAME_NAME, _DUP_SOUNDS_ALIKE = 0.5, 0.35
+_DUP_SAME_ORG = 0.1
+_DUP_OTHER_EMAIL, _DUP_OTHER_PHONE = -0.25, -0.15
+
+_SOUNDEX_CODES = {
+    letter: str(code)
+    for code, letters in enumerate(('aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r'))
+    for letter in letters
+}
+
+DuplicateKeys = namedtuple('DuplicateKeys', 'uid email phone name sounds org')
+
+
+def _soundex(token: str) -> str:
+    """Soundex code of a folded token: 'robert' and 'rupert' -> 'r163'."""
+    letters = [c for c in token if c in _SOUNDEX_CODES]
+    if not letters:
+        return token
+    code, previous = letters[0], _SOUNDEX_CODES[letters[0]]
+    for letter in letters[1:]:
+        digit = _SOUNDEX_CODES[letter]
+        if digit != '0' and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        if letter not in 'hw':
+            previous = digit
+    return code.ljust(4, '0')
+
+
+@lru_cache(maxsize=65536)
+def _name_keys(name: str) -> tuple:
+    """(folded tokens, their Soundex codes) of a name, both sorted so that
+    'Martin Alice' and 'Alice Martin' agree. Names repeat a lot: cached."""
+    tokens = sorted(_TOKEN_RE.findall(fold_text(name)))
+    return ' '.join(tokens), ' '.join(sorted(_soundex(t) for t in tokens))
+
+
+def duplicate_keys(contact: dict) -> DuplicateKeys:
+    email = fold_text(contact['email']).strip()
+    digits = re.sub(r'\D', '', _as_str(contact['phone']))
+    name = f"{_as_str(contact['first_name'])} {_as_str(contact['last_name'])}".strip()
+    if not name and contact['name'] != 'No Name':
+        name = contact['name']
+    name, sounds = _name_keys(name)
+    return DuplicateKeys(
+        uid=contact['uid'],
+        email=email if '@' in email else '',
+        phone=digits[-DUPLICATE_PHONE_DIGITS:] if len(digits) >= 7 else '',
+        name=name,
+        sounds=sounds,
+        org=fold_text(contact['org']).strip(),
+    )
+
+
+def duplicate_score(a: DuplicateKeys, b: DuplicateKeys) -> tuple:
+    """(score between 0 and 1, reasons) of two contacts being one person."""
+    if a.uid and a.uid == b.uid:
+        return _DUP_SAME_UID, ['uid']
+    score, reasons = 0.0, []
+    if a.email and b.email:
+        if a.email == b.email:
+            score += _DUP_SAME_EMAIL
+            reasons.append('email')
+        else:
+            score += _DUP_OTHER_EMAIL
+    if a.phone and b.phone:
+        if a.phone == b.phone:
+            score += _DUP_SAME_PHONE
+            reasons.append('phone')
+        else:
+            score += _DUP_OTHER_PHONE
+    if a.name and a.name == b.name:
+        score += _DUP_SAME_NAME
+        reasons.append('name')
+    elif a.sounds and a.sounds == b.sounds:
+        score += _DUP_SOUNDS_ALIKE
+        reasons.append('name sounds alike')
+    if a.org and a.org == b.org:
+        score += _DUP_SAME_ORG
+        reasons.append('organization')
+    return min(max(score, 0.0), 1.0), reasons
+
+
+def _name_block_pairs(members: list, keys: list):
+    """The pairs of a name block that can still reach DUPLICATE_MIN_SCORE.
+    A shared email or phone number brings its pair in through its own
+    block, so here two cards that both have one have different ones and
+    lose score for it: in a large block of namesakes, cards that both carry
+    an email and a phone number need not be compared at all."""
+    classes = {}
+    for i in members:
+        classes.setdefault((bool(keys[i].email), bool(keys[i].phone)), []).append(i)
+    kinds = sorted(classes)
+    for n, a in enumerate(kinds):
+        for b in kinds[n:]:
+            best = (_DUP_SAME_NAME + _DUP_SAME_ORG
+                    + (_DUP_OTHER_EMAIL if a[0] and b[0] else 0)
+                    + (_DUP_OTHER_PHONE if a[1] and b[1] else 0))
+            if best < DUPLICATE_MIN_SCORE:
+                continue
+            if a == b:
+                yield from itertools.combinations(classes[a], 2)
+            else:
+                yield from ((min(i, j), max(i, j)) for i in classes[a] for j in classes[b])
+
+
+def find_duplicates(contacts: list, keys: list = None) -> list:
+    """Groups of likely duplicates among `contacts`, best first. Each group
+    is {'contacts': [...], 'score': best pair score, 'pairs': [(i, j, score,
+    reasons)]} with i and j indexes into the group's contacts. `keys` are
+    the duplicate_keys() of the contacts, when already known."""
+    if keys is None:
+        keys = [duplicate_keys(c) for c in contacts]
+    blocks = {}  # kind of key -> key -> indexes of the contacts sharing it
+    for kind in ('uid', 'email', 'phone', 'sounds'):
+        values = list(map(operator.attrgetter(kind), keys))
+        # Most keys are unique: counted first, so only shared ones get a list
+        counts = Counter(values)
+        blocks[kind] = by_value = {}
+        for i, value in enumerate(values):
+            if value and counts[value] > 1:
+                by_value.setdefault(value, []).append(i)
+
+    parent = list(range(len(contacts)))
+
+    def root(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    compared, pairs, skipped = set(), [], 0
+    for kind, by_value in blocks.items():
+        for members in by_value.values():
+            if len(members) > DUPLICATE_BLOCK_MAX:
+                skipped += 1
+                continue
+            candidates = _name_block_pairs(members, keys) if kind == 'sounds' else itertools.combinations(members, 2)
+            for i, j in candidates:
+                if (i, j) in compared:
+                    continue
+                compared.add((i, j))
+                score, reasons = duplicate_score(keys[i], keys[j])
+                if score >= DUPLICATE_MIN_SCORE:
+                    pairs.append((i, j, score, reasons))
+                    parent[root(j)] = root(i)
+    if skipped:
+        logger.info(f"Duplicate search left out {skipped} blocks of more than {DUPLICATE_BLOCK_MAX} contacts.")
+
+    groups = {}
+    for i, j, score, reasons in pairs:
+        group = groups.setdefault(root(i), {'members': set(), 'score': 0.0, 'pairs': []})
+        group['members'].update((i, j))
+        group['score'] = max(group['score'], score)
+        group['pairs'].append((i, j, score, reasons))
+    result = []
+    for group in groups.values():
+        members = sorted(group['members'], key=lambda i: contact_sort_key(contacts[i]))
+        position = {i: n for n, i in enumerate(members)}
+        result.append({
+            'contacts': [contacts[i] for i in members],
+            'score': group['score'],
+            'pairs': sorted(((position[i], position[j], score, reasons)
+                             for i, j, score, reasons in group['pairs']), key=lambda p: -p[2]),
+        })
+    result.sort(key=lambda g: (-g['score'], contact_sort_key(g['contacts'][0])))
+    return result
+
+
+_duplicates: Dict[str, tuple] = {}  # username -> (collection key, groups, {href: (etag, keys)})
+_duplicates_lock = threading.Lock()
+
+
+def duplicate_groups(username: str, states: list) -> list:
+    """find_duplicates() over the address books of `states`, computed again
+    only when one of them has changed."""
+    key = tuple((state.url, state.digest, len(state.contacts)) for state in states)
+    with _duplicates_lock:
+        cached = _duplicates.get(username)
+    metrics.cache_lookup('duplicates', hits=cached is not None and cached[0] == key,
+                         misses=cached is None or cached[0] != key)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    contacts = []
+    for state in states:
+        with state.lock:
+            contacts.extend(state.contacts.values())
+    started = time.monotonic()
+    with metrics.phase('duplicates'):
+        # Keys of the cards unchanged since the last run are reused
+        known = cached[2] if cached is not None else {}
+        keys = []
+        for contact in contacts:
+            etag, keyed = known.get(contact['href'], (None, None))
+            keys.append(keyed if etag == contact['etag'] else duplicate_keys(contact))
+        groups = find_duplicates(contacts, keys)
+    logger.info(
+        f"Found {len(groups)} duplicate groups among {len(contacts)} contacts "
+        f"in {(time.monotonic() - started) * 1000:.0f} ms."
+    )
+    with _duplicates_lock:
+        _duplicates[username] = (key, groups, {c['href']: (c['etag'], k) for c, k in zip(contacts, keys)})
+    return groups
+
+
+def forget_duplicates(username: str) -> None:
+    with _duplicates_lock:
+        _duplicates.pop(username, None)
+
+
+# Of these a card shows one: the kept card's value wins
+_MERGE_SINGLE = frozenset(('fn', 'n', 'bday', 'anniversary', 'gender', 'kind', 'photo', 'sort-string', 'class'))
+# Bookkeeping of the kept card, never taken from the others
+_MERGE_SKIP = frozenset(('version', 'uid', 'rev', 'prodid'))
+
+
+def _merge_key(prop) -> tuple:
+    """What makes two values of a property the same, for a merge."""
+    value = prop.value
+    if prop.name == 'EMAIL':
+        value = fold_text(value).strip()
+    elif prop.name == 'TEL':
+        value = re.sub(r'\D', '', _as_str(value))[-DUPLICATE_PHONE_DIGITS:] or _as_str(value)
+    elif not isinstance(value, bytes):
+        value = ' '.join(fold_text(str(value)).split())
+    return prop.name.lower(), value
+
+
+def merge_vcards(texts: list) -> tuple:
+    """Merge vCards, the one to keep first, into (vCard text, dropped).
+
+    The kept card keeps every property it has. Every property of the other
+    cards is added to it unless it already has that value, grouped
+    properties (item1.EMAIL with its item1.X-ABLabel) as a unit. Of a
+    property a card shows one of (name, birthday…), a value other than the
+    kept card's is written to the note instead; a photo cannot be, and is
+    reported in `dropped` as (index of its card, property name)."""
+    try:
+        cards = [vobject.readOne(text) for text in texts]
+    except Exception as e:
+        raise ValueError(f"Could not parse a card: {e}")
+    kept = cards[0]
+    seen = {_merge_key(prop) for props in kept.contents.values() for prop in props}
+    groups = {prop.group.lower() for props in kept.contents.values() for prop in props if prop.group}
+    notes, dropped = [], []
+
+    def add(prop, group=None):
+        line = vobject.base.ContentLine.duplicate(prop)
+        line.group = group
+        kept.add(line)
+
+    for index, card in enumerate(cards[1:], 1):
+        grouped = {}
+        for name, props in card.contents.items():
+            for prop in props:
+                if prop.group:
+                    grouped.setdefault(prop.group.lower(), []).append(prop)
+                    continue
+                key = _merge_key(prop)
+                if name in _MERGE_SKIP or key in seen:
+                    continue
+                seen.add(key)
+                if name == 'note':
+                    notes.append(prop.value)
+                elif name == 'categories' and 'categories' in kept.contents:
+                    current = kept.categories.value
+                    current.extend(v for v in prop.value if v not in current)
+                elif name in _MERGE_SINGLE and name in kept.contents:
+                    if isinstance(prop.value, bytes):
+                        dropped.append((index, prop.name))
+                    else:
+                        notes.append(f"{prop.name}: {' '.join(str(prop.value).split())}")
+                else:
+                    add(prop)
+        for props in grouped.values():
+            keys = [_merge_key(prop) for prop in props]
+            # A label alone does not make a group new
+            main = [key for key, prop in zip(keys, props) if not prop.name.startswith('X-')] or keys
+            if all(key in seen for key in main):
+                continue
+            seen.update(keys)
+            group = next(f"item{n}" for n in itertools.count(1) if f"item{n}" not in groups)
+            groups.add(group)
+            for prop in props:
+                add(prop, group)
+
+    if notes:
+        if 'note' in kept.contents:
+            kept.note.value = '\n'.join([kept.note.value, *notes])
+        else:
+            kept.add('note').value = '\n'.join(notes)
+    return kept.serialize(), dropped
+
+
+async def _merge_delete(client: AsyncCardDAVClient, contact_id: str, contact_url: str, etag: str) -> dict:
+    try:
+        # If-Match: a card edited since it was read is kept rather than lost
+        resp = await client.delete(contact_url, etag=etag)
+    except Exception as e:
+        return {'id': contact_id, 'ok': False, 'status': None, 'error': str(e) or type(e).__name__}
+    if resp.status_code in (200, 204, 404):
+        return {'id': contact_id, 'ok': True, 'status': resp.status_code, 'error': None}
+    if resp.status_code == 412:
+        return {'id': contact_id, 'ok': False, 'status': 412, 'error': 'Changed on the server meanwhile; not deleted.'}
+    return {'id': contact_id, 'ok': False, 'status': resp.status_code, 'error': f"Status {resp.status_code}"}
+
+
+def run_merge(client: CardDAVClient, s: requests.Session, username: str, keep: str, ids: list,
+              preview: bool = False) -> dict:
+    """Merge the contacts of `ids` into `keep`: GET every card, PUT the merged
+    card over `keep` if it has not changed since, then delete the others.
+    With `preview`, only tell what the merged card would hold. Raises
+    ValueError for an unknown id, BatchItemError when nothing could be
+    written."""
+    ids = [keep] + [contact_id for contact_id in ids if contact_id != keep]
+    locations = {contact_id: contact_location(s, username, contact_id) for contact_id in ids}
+    try:
+        responses = client.map(lambda aio, cid: aio.get(locations[cid][1]), ids, BATCH_CONCURRENCY)
+        for contact_id, resp in zip(ids, responses):
+            if resp.status_code != 200:
+                raise BatchItemError(f"Could not fetch {contact_id}: status {resp.status_code}", resp.status_code)
+        text, dropped = merge_vcards([resp.text for resp in responses])
+        dropped = [f"{name} of {ids[index]}" for index, name in dropped]
+        if preview:
+            names = Counter(m.upper() for m in _PROP_NAME_RE.findall(text))
+            for name in ('BEGIN', 'END', 'VERSION'):
+                names.pop(name, None)
+            return {'kept': keep, 'properties': dict(sorted(names.items())), 'dropped': dropped}
+        etags = {cid: resp.headers.get('ETag', '') for cid, resp in zip(ids, responses)}
+        put = client.put(locations[keep][1], text, etag=etags[keep])
+        if put.status_code == 412:
+            raise BatchItemError(f"{keep} was changed on the server meanwhile; reload and retry.", 412)
+        if put.status_code not in (200, 201, 204):
+            raise BatchItemError(f"Could not save {keep}: status {put.status_code}", put.status_code)
+        others = [cid for cid in ids if cid != keep]
+        results = client.map(
+            lambda aio, cid: _merge_delete(aio, cid, locations[cid][1], etags[cid]), others, BATCH_CONCURRENCY
+        )
+    finally:
+        for contact_id in ids:
+            contact_cache.invalidate(username, locations[contact_id][2])
+    return {'kept': keep, 'results': results, 'dropped': dropped}
+
+
+# ---------------------------------------------------------------------------
+# Bulk import
+# An uploaded .vcf or .csv is spooled to disk and imported by a background
+# thread: cards are read one at a time and PUT through a small thread pool
+# that shares the user's keep-alive session. Progress lives in SQLite so the
+# status poll can be answered by any worker.
+# ---------------------------------------------------------------------------
+
+IMPORT_CONCURRENCY = int(os.environ.get('IMPORT_CONCURRENCY', '4'))
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', str(50 * 1024 * 1024)))
+IMPORT_DIR = os.path.join(CACHE_DIR, 'imports')
+IMPORT_ERRORS_MAX = 200
+IMPORT_STALE_AFTER = 300  # a running job silent this long died with its worker
+IMPORT_JOB_TTL = 86400
+
+ImportCard = namedtuple('ImportCard', 'index uid name text error')
+
+_SAFE_RESOURCE_RE = re.compile(r'^[A-Za-z0-9._-]{1,128}$')
+
+# CSV header (lowercased, letters and digits only) -> form field. Our own
+# field names plus the usual Google/Outlook export columns.
+_CSV_COLUMNS = {
+    'firstname': 'first_name', 'givenname': 'first_name',
+    'lastname': 'last_name', 'familyname': 'last_name', 'surname': 'last_name',
+    'email': 'email', 'emailaddress': 'email', 'email1value': 'email',
+    'phone': 'phone', 'mobilephone': 'phone', 'phone1value': 'phone', 'primaryphone': 'phone',
+    'organization': 'organization', 'org': 'organization', 'company': 'organization',
+    'organization1name': 'organization',
+    'url': 'url', 'website': 'url', 'webpage': 'url', 'website1value': 'url',
+    'birthday': 'birthday',
+    'note': 'note', 'notes': 'note',
+    'street': 'street', 'homestreet': 'street', 'address1street': 'street',
+    'city': 'city', 'homecity': 'city', 'address1city': 'city',
+    'postal': 'postal', 'postalcode': 'postal', 'zip': 'postal', 'homepostalcode': 'postal',
+    'address1postalcode': 'postal',
+    'country': 'country', 'homecountry': 'country', 'countryregion': 'country',
+    'homecountryregion': 'country', 'address1country': 'country',
+    'uid': 'uid',
+}
+
+
+class ImportJobs:
+    """Progress of import jobs, shared by all workers through SQLite."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.enabled = True
+        self._local = threading.local()
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            with self._connect() as db:
+                db.execute('''CREATE TABLE IF NOT EXISTS import_jobs (
+                    id        TEXT PRIMARY KEY,
+                    username  TEXT NOT NULL,
+                    filename  TEXT NOT NULL,
+                    status    TEXT NOT NULL,
+                    parsed    INTEGER NOT NULL DEFAULT 0,
+                    created   INTEGER NOT NULL DEFAULT 0,
+                    skipped   INTEGER NOT NULL DEFAULT 0,
+                    failed    INTEGER NOT NULL DEFAULT 0,
+                    errors    TEXT NOT NULL DEFAULT '[]',
+                    started   REAL NOT NULL,
+                    updated   REAL NOT NULL
+                )''')
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Import jobs disabled ({path}): {e}")
+            self.enabled = False
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def create(self, username: str, filename: str) -> str:
+        job_id = secrets.token_urlsafe(12)
+        now = time.time()
+        with self._connect() as db:
+            db.execute('DELETE FROM import_jobs WHERE updated < ?', (now - IMPORT_JOB_TTL,))
+            db.execute(
+                'INSERT INTO import_jobs (id, username, filename, status, started, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, username, filename, 'running', now, now)
+            )
+        return job_id
+
+    def update(self, job_id: str, progress: dict, status: str = 'running') -> None:
+        with self._connect() as db:
+            db.execute(
+                'UPDATE import_jobs SET status = ?, parsed = ?, created = ?, skipped = ?, failed = ?, '
+                'errors = ?, updated = ? WHERE id = ?',
+                (status, progress['parsed'], progress['created'], progress['skipped'], progress['failed'],
+                 json.dumps(progress['errors']), time.time(), job_id)
+            )
+
+    def get(self, username: str, job_id: str):
+        row = self._connect().execute(
+            'SELECT filename, status, parsed, created, skipped, failed, errors, started, updated '
+            'FROM import_jobs WHERE id = ? AND username = ?', (job_id, username)
+        ).fetchone()
+        if row is None:
+            return None
+        filename, status, parsed, created, skipped, failed, errors, started, updated = row
+        if status == 'running' and time.time() - updated > IMPORT_STALE_AFTER:
+            status = 'interrupted'
+        return {
+            'id': job_id, 'filename': filename, 'status': status,
+            'parsed': parsed, 'created': created, 'skipped': skipped, 'failed': failed,
+            'errors': json.loads(errors), 'elapsed': round(updated - started, 1),
+        }
+
+
+import_jobs = ImportJobs(os.path.join(IMPORT_DIR, 'jobs.sqlite3'))
+
+
+def iter_vcard_texts(lines):
+    """Yield the text of each top-level BEGIN:VCARD … END:VCARD block of a
+    line iterator, so one malformed card cannot stop the ones after it."""
+    buf, depth = [], 0
+    for line in lines:
+        marker = line.strip().upper()
+        if marker == 'BEGIN:VCARD':
+            depth += 1
+        if depth:
+            buf.append(line.rstrip('\r\n'))
+        if marker == 'END:VCARD' and depth:
+            depth -= 1
+            if not depth:
+                yield '\r\n'.join(buf) + '\r\n'
+                buf = []
+
+
+def _vcf_import_card(index: int, text: str) -> ImportCard:
+    try:
+        card = next(vobject.readComponents(text))
+        if 'uid' not in card.contents or not card.uid.value.strip():
+            card.add('uid').value = str(uuid.uuid4())
+        name = card.fn.value if 'fn' in card.contents else ''
+        return ImportCard(index, card.uid.value.strip(), name, card.serialize(), None)
+    except Exception as e:
+        return ImportCard(index, '', '', None, f"Unreadable vCard: {e}")
+
+
+def _csv_import_card(index: int, row: dict) -> ImportCard:
+    form = {}
+    for header, value in row.items():
+        field = _CSV_COLUMNS.get(re.sub(r'[^a-z0-9]', '', (header or '').lower()))
+        if field and value and not form.get(field):
+            form[field] = value.strip()
+    if not any(form.get(f) for f in ('first_name', 'last_name', 'email', 'phone', 'organization')):
+        return ImportCard(index, '', '', None, 'Row has no name, email, phone or organization')
+    try:
+        data = collect_vcard_data_from_form(form)
+        if not data['FN']:
+            data['FN'] = form.get('organization') or form.get('email') or form.get('phone')
+        data['UID'] = form.get('uid') or str(uuid.uuid4())
+        return ImportCard(index, data['UID'], data['FN'], generate_vcard(data), None)
+    except Exception as e:
+        return ImportCard(index, '', '', None, f"Invalid row: {e}")
+
+
+def iter_import_cards(path: str, kind: str):
+    """Yield an ImportCard per card of a spooled .vcf or .csv upload."""
+    with open(path, encoding='utf-8-sig', errors='replace', newline='') as f:
+        if kind == 'csv':
+            for index, row in enumerate(csv.DictReader(f), 1):
+                yield _csv_import_card(index, row)
+        else:
+            for index, text in enumerate(iter_vcard_texts(f), 1):
+                yield _vcf_import_card(index, text)
+
+
+def _put_import_card(s: requests.Session, carddav_url: str, card: ImportCard) -> bool:
+    """PUT one card as a new resource. False if that resource already exists."""
+    name = card.uid if _SAFE_RESOURCE_RE.match(card.uid) else uuid.uuid4().hex
+    resp = s.put(
+        f"{carddav_url.rstrip('/')}/{name}.vcf",
+        data=card.text.encode('utf-8'),
+        headers={'Content-Type': 'text/vcard; charset=utf-8', 'If-None-Match': '*'},
+        timeout=30
+    )
+    if resp.status_code == 412:
+        return False
+    if resp.status_code not in (200, 201, 204):
+        raise CardDAVError(resp.status_code, f"Status {resp.status_code}: {resp.text[:200]}")
+    return True
+
+
+def run_import(job_id: str, path: str, kind: str, username: str, password: str, carddav_url: str) -> None:
+    """Import job body, run in a background thread."""
+    progress = {'parsed': 0, 'created': 0, 'skipped': 0, 'failed': 0, 'errors': []}
+
+    def fail(card: ImportCard, error: str) -> None:
+        progress['failed'] += 1
+        if len(progress['errors']) < IMPORT_ERRORS_MAX:
+            progress['errors'].append({'index': card.index, 'uid': card.uid, 'name': card.name, 'error': error})
+
+    def collect(card: ImportCard, future) -> None:
+        try:
+            if future.result():
+                progress['created'] += 1
+            else:
+                progress['skipped'] += 1
+        except Exception as e:
+            logger.warning(f"Import {job_id}: card {card.index} failed: {e}")
+            fail(card, str(e))
+
+    status = 'done'
+    pool = ThreadPoolExecutor(max_workers=IMPORT_CONCURRENCY)
+    pending = deque()  # (card, future) in submission order
+    last_flush = time.monotonic()
+    try:
+        s = session_pool.get(username, password)
+        # Cards go to the CARDDAV_URL book but are skipped if any book has them
+        seen_uids = set()
+        for state in synced_books(s, username):
+            with state.lock:
+                seen_uids.update(c.get('uid') for c in state.contacts.values())
+        seen_uids -= {None, ''}
+
+        for card in iter_import_cards(path, kind):
+            progress['parsed'] += 1
+            if card.error:
+                fail(card, card.error)
+            elif card.uid in seen_uids:
+                progress['skipped'] += 1
+            else:
+                seen_uids.add(card.uid)
+                pending.append((card, pool.submit(_put_import_card, s, carddav_url, card)))
+            while len(pending) > IMPORT_CONCURRENCY * 2:
+                collect(*pending.popleft())
+            if time.monotonic() - last_flush > 0.5:
+                import_jobs.update(job_id, progress)
+                last_flush = time.monotonic()
+        while pending:
+            collect(*pending.popleft())
+    except Exception as e:
+        logger.error(f"Import {job_id} aborted: {e}")
+        progress['errors'].append({'index': None, 'uid': '', 'name': '', 'error': f"Import aborted: {e}"})
+        status = 'failed'
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        import_jobs.update(job_id, progress, status)
+    logger.info(
+        f"Import {job_id} {status}: {progress['created']} created, {progress['skipped']} skipped, "
+        f"{progress['failed']} failed of {progress['parsed']}."
+    )
+
+
+# ---------------------------------------------------------------------------
+# Metrics and profiling
+# /metrics serves Prometheus metrics (see metrics.py): latency per route and
+# per upstream method, REPORT sizes, parse times, synced contacts and cache
+# lookups. With METRICS_TOKEN set, scrapes must send it as a bearer token;
+# without it, only scrapes from the host itself are answered. Timings are
+# taken around the whole request, compression included.
+#
+# Every response also carries a Server-Timing header with the request's
+# phases: upstream round trips, XML parsing, vCard parsing, the contact
+# cache, sorting or search, and template rendering. Browsers show it in
+# the network panel.
+#
+# With ADMIN_TOKEN set, /admin/profile arms the sampling profiler of
+# profiler.py on the next requests to a route, in every worker, and
+# returns their folded stacks for a flame graph.
+# ---------------------------------------------------------------------------
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+PROFILE_MAX_REQUESTS = 100
+
+profiler = SamplingProfiler(os.path.join(CACHE_DIR, 'profiles'))
+
+
+def bearer_token_ok(token: str) -> bool:
+    return secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+
+
+def metrics_allowed() -> bool:
+    if METRICS_TOKEN:
+        return bearer_token_ok(METRICS_TOKEN)
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+
+def _route() -> str:
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@app.before_request
+def start_timer():
+    g.phases = metrics.start_phases()
+    g.profile = profiler.begin(_route()) if ADMIN_TOKEN else None
+
+
+def _record(phases: metrics.Phases, route: str, method: str, status: int) -> None:
+    metrics.REQUEST_LATENCY.labels(route, method).observe(time.perf_counter() - phases.started)
+    metrics.REQUESTS.labels(route, method, str(status)).inc()
+
+
+def _timed_body(chunks, done):
+    """Pass a streamed body through, calling done() once it is all sent or
+    the client has gone."""
+    try:
+        yield from chunks
+    finally:
+        done()
+
+
+@app.after_request
+def record_request(response: Response) -> Response:
+    phases = g.pop('phases', None)
+    if phases is None:
+        return response
+    record = partial(_record, phases, _route(), request.method, response.status_code)
+    if response.is_streamed:
+        # Runs before a streamed body is produced: the request is recorded
+        # once the body is out, and the header only covers the time until the
+        # headers. stream_page() ends the page with the full timings.
+        response.headers['Server-Timing'] = phases.server_timing(last='headers')
+        response.response = _timed_body(response.response, record)
+    else:
+        record()
+        response.headers['Server-Timing'] = phases.server_timing()
+    return response
+
+
+@app.teardown_request
+def stop_profile(exc):
+    # After a streamed body too, which outlives after_request
+    profiler.end(g.pop('profile', None))
+
+
+@before_render_template.connect_via(app)
+def _render_started(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def _render_done(sender, template, context, **extra):
+    started = g.pop('render_started', None)
+    if started is not None:
+        metrics.add_phase('render', time.perf_counter() - started)
+
+
+# ---------------------------------------------------------------------------
+# Conditional responses and compression
+# The list page and the JSON contact endpoints carry a weak ETag computed
+# from the synced state of every address book shown (sync-token plus a
+# digest of the card ETags, so it also works without sync-collection) and
+# the request parameters: a revisit with nothing new is answered 304.
+# Text responses of COMPRESS_MIN_BYTES or more go out brotli- or
+# gzip-compressed.
+# ---------------------------------------------------------------------------
+
+COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES', '1') != '0'
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # well past gzip's ratio, still a few ms per 100 KB
+_COMPRESSIBLE = frozenset((
+    'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+    'application/json', 'image/svg+xml',
+))
+
+
+def _code_digest() -> bytes:
+    """Changes with this file or any template, so a new deployment never
+    confirms a page rendered by the previous one."""
+    h = hashlib.sha1()
+    folder = os.path.join(app.root_path, app.template_folder)
+    try:
+        paths = [__file__] + [os.path.join(folder, name) for name in sorted(os.listdir(folder))]
+        for path in paths:
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    except OSError as e:
+        logger.warning(f"Could not fingerprint the code for ETags: {e}")
+        h.update(secrets.token_bytes(16))
+    return h.digest()
+
+
+_CODE_DIGEST = _code_digest()
+
+
+def collection_etag(states: list, *parts) -> str:
+    """ETag of a view of `states` shaped by `parts` (sort, query, cursor…)."""
+    h = hashlib.sha1(_CODE_DIGEST)
+    for state in states:
+        with state.lock:
+            h.update(f"{state.url}\0{state.sync_token}\0{state.digest:x}\0".encode('utf-8'))
+    for part in parts:
+        h.update(f"{part}\0".encode('utf-8'))
+    return h.hexdigest()[:32]
+
+
+def not_modified(etag: str):
+    """A 304 if the client already holds `etag`, else None."""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    return with_etag(response, etag)
+
+
+def with_etag(response: Response, etag: str) -> Response:
+    response.set_etag(etag, weak=True)
+    # Revalidated on every use: a 304 is cheap, a stale list is not
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def compress_stream(chunks, encoding: str):
+    """Compress a streamed body piece by piece, flushing after each piece
+    so the client can render what has been sent so far."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, finish = compressor.compress, compressor.flush
+        flush = partial(compressor.flush, zlib.Z_SYNC_FLUSH)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if data := process(chunk) + flush():
+            yield data
+    yield finish()
+
+
+@app.after_request
+def compress_response(response: Response) -> Response:
+    if (not COMPRESS_RESPONSES or response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.mimetype not in _COMPRESSIBLE):
+        return response
+    response.vary.add('Accept-Encoding')
+    accepted = request.accept_encodings
+    encoding = 'br' if brotli is not None and accepted['br'] else 'gzip' if accepted['gzip'] else None
+    if response.is_streamed:
+        if encoding:
+            response.response = compress_stream(response.response, encoding)
+            response.headers['Content-Encoding'] = encoding
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        response.headers['Content-Encoding'] = 'br'
+    elif encoding == 'gzip':
+        response.set_data(gzip.compress(data, GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+# ---------------------------------------------------------------------------
+# Streamed pages
+# The list page is streamed: the head, navigation and toolbar leave before
+# the address books are loaded, and the rows follow once they are. Output is
+# sent in STREAM_BUFFER_BYTES pieces, and at once where a template calls
+# flush(), just before its slow part. Streamed responses are compressed on
+# the fly. A session change must happen before streaming starts, since the
+# session cookie goes out with the headers; for the same reason the full
+# Server-Timing of the page comes last, in an HTML comment.
+# ---------------------------------------------------------------------------
+
+STREAM_BUFFER_BYTES = 16 * 1024
+
+
+def _no_flush() -> str:
+    return ''
+
+
+# Outside stream_page(), flush() in a template does nothing
+app.jinja_env.globals['flush'] = _no_flush
+
+
+def stream_page(template: str, **context) -> Response:
+    phases = metrics.current_phases()
+    flush_requested = False
+
+    def flush() -> str:
+        nonlocal flush_requested
+        flush_requested = True
+        return ''
+
+    def buffered(chunks):
+        nonlocal flush_requested
+        buf, size = [], 0
+        for chunk in chunks:
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_BUFFER_BYTES or flush_requested:
+                flush_requested = False
+                yield ''.join(buf)
+                buf, size = [], 0
+        if buf:
+            yield ''.join(buf)
+        if phases is not None:
+            yield f"\n<!-- Server-Timing: {phases.server_timing()} -->\n"
+    return Response(buffered(stream_template(template, flush=flush, **context)), mimetype='text/html')
+
+
 # ---------------------------------------------------------------------------
 # Routes
 # ---------------------------------------------------------------------------
@@ -473,8 +3484,11 @@ def login():
             return render_template('login.html')
 
         if check_auth(username, password):
+            apply_logouts()  # a logout of this user elsewhere must not drop the new state
             session['username'] = username
             session['password'] = password
+            # Warm the address books while the browser follows the redirect
+            refresher.track(username, password, prefetch=True)
             logger.info("User logged in successfully.")
             return redirect(url_for('contacts'))
 
@@ -487,6 +3501,10 @@ def login():
 
 @app.route('/logout')
 def logout():
+    if 'username' in session:
+        forget_user(session['username'])
+        contact_cache.record_logout(session['username'])
+        apply_logouts()  # this worker has nothing left to drop
     session.clear()
     logger.info("User logged out.")
     return redirect(url_for('login'))
@@ -496,10 +3514,9 @@ def logout():
 @check_login_required
 def health_check():
     carddav_url = get_user_carddav_url()
-    s = get_user_session()
     status = {'carddav_url': carddav_url, 'is_healthy': False, 'status_code': None, 'error': None}
     try:
-        resp = s.request('PROPFIND', carddav_url, headers={'Depth': '1'}, timeout=10)
+        resp = get_user_client().propfind(carddav_url, depth='1')
         status['is_healthy'] = resp.status_code == 207
         status['status_code'] = resp.status_code
         status['message'] = (
@@ -509,11 +3526,59 @@ def health_check():
         )
     except Exception as e:
         logger.error(f"Health check failed: {e}")
-        status['error'] = str(e)
+        status['error'] = str(e) or type(e).__name__
         status['message'] = 'Could not reach the CardDAV server.'
     return render_template('health.html', status=status)
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics_allowed():
+        if not METRICS_TOKEN:
+            return Response('Set METRICS_TOKEN to scrape from another host.\n', status=403, mimetype='text/plain')
+        return Response('Unauthorized.\n', status=401, mimetype='text/plain',
+                        headers={'WWW-Authenticate': 'Bearer'})
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def admin_profile():
+    """POST arms the profiler ({"route": "/contacts", "requests": 10,
+    "interval_ms": 5}), GET reports progress (?format=folded: the stacks),
+    DELETE drops the job and its output."""
+    if not ADMIN_TOKEN:
+        abort(404)
+    if not bearer_token_ok(ADMIN_TOKEN):
+        return jsonify({'error': 'Not authorized.'}), 401, {'WWW-Authenticate': 'Bearer'}
+
+    if request.method == 'POST':
+        params = request.get_json(silent=True) or request.form
+        route = params.get('route', '')
+        if route not in {rule.rule for rule in app.url_map.iter_rules()}:
+            return jsonify({'error': f"Unknown route '{route}'."}), 400
+        try:
+            count = int(params.get('requests', 10))
+            interval_ms = float(params.get('interval_ms', 5))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'requests and interval_ms must be numbers.'}), 400
+        if not 1 <= count <= PROFILE_MAX_REQUESTS or not 1 <= interval_ms <= 1000:
+            return jsonify({'error': f"requests must be 1–{PROFILE_MAX_REQUESTS}, interval_ms 1–1000."}), 400
+        job = profiler.arm(route, count, interval_ms / 1000)
+        logger.info(f"Profiling the next {count} requests to {route}.")
+        return jsonify({'job': job}), 201
+
+    if request.method == 'DELETE':
+        profiler.clear()
+        return '', 204
+
+    status = profiler.status()
+    if request.args.get('format') == 'folded':
+        return Response(status['folded'], mimetype='text/plain')
+    del status['folded']
+    return jsonify(status)
+
+
 @app.route('/contacts', methods=['GET', 'POST'])
 @check_login_required
 def contacts():
@@ -523,8 +3588,7 @@ def contacts():
     # Sort preference: query string > session > default
     # Read before POST handling so redirect preserves it
     sort_by = request.args.get('sort') or session.get('sort_by', 'first_name')
-    valid_sorts = {'first_name', 'last_name', 'org'}
-    if sort_by not in valid_sorts:
+    if sort_by not in VALID_SORTS:
         sort_by = 'first_name'
     session['sort_by'] = sort_by
 
@@ -537,7 +3601,8 @@ def contacts():
             vcard_content = generate_vcard(vcard_data)
             filename = f"{base64.urlsafe_b64encode(os.urandom(12)).decode()}.vcf"
             put_url = f"{carddav_url.rstrip('/')}/{filename}"
-            resp = s.put(put_url, data=vcard_content, headers={'Content-Type': 'text/vcard'}, timeout=10)
+            resp = get_user_client().put(put_url, vcard_content)
+            contact_cache.invalidate(session['username'], urlparse(put_url).path)
             if resp.status_code not in (201, 204):
                 raise Exception(f"Status {resp.status_code}: {resp.text[:200]}")
             flash('Contact created successfully.', 'success')
@@ -546,40 +3611,389 @@ def contacts():
             flash(f"Error creating contact: {e}", 'error')
         return redirect(url_for('contacts', sort=sort_by))
 
-    contact_list = []
-    try:
-        report_body = '''<?xml version="1.0" encoding="utf-8" ?>
-<C:addressbook-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav">
-    <D:prop>
-        <D:getetag/>
-        <C:address-data/>
-    </D:prop>
-</C:addressbook-query>'''
+    username = session['username']
+    # A page carrying a flash message is shown once, never revalidated
+    flashed = '_flashes' in session
+    # The page is streamed: settle the session before the headers go out
+    csrf_token = generate_csrf_token()
+    get_flashed_messages(with_categories=True)
 
-        resp = s.request(
-            'REPORT', carddav_url,
-            headers={
-                'Depth': '1',
-                'Content-Type': 'application/xml; charset=utf-8',
-            },
-            data=report_body.encode('utf-8'),
-            timeout=30
-        )
+    def load_page(states=None):
+        """(page, error message) for the template, syncing unless given `states`."""
+        try:
+            if states is None:
+                states = synced_books(s, username)
+            page = contacts_page(states, sort_by)
+        except CardDAVError as e:
+            logger.error(f"Could not load contacts: {e}")
+            return contacts_page([], sort_by), f"Could not load contacts (status {e.status_code})."
+        except Exception as e:
+            logger.error(f"Error listing contacts: {e}")
+            return contacts_page([], sort_by), f"Error: {e}"
+        logger.info(f"Loaded {page['total']} contacts.")
+        return page, None
+
+    load, etag = load_page, None
+    if books_synced(username):
+        # A warm copy costs one sync round trip: take it before the headers,
+        # so the page carries an ETag and a revisit can be answered 304.
+        # A cold load is what streaming is for, and goes out without one.
+        try:
+            states = synced_books(s, username)
+        except Exception:
+            pass  # load_page() tries again and shows the error
+        else:
+            load = partial(load_page, states)
+            if not flashed:
+                etag = collection_etag(states, username, csrf_token, sort_by)
+                if (cached := not_modified(etag)) is not None:
+                    return cached
 
-        logger.info(f"REPORT → {resp.status_code}")
+    response = stream_page('index.html', load_page=load, sort_by=sort_by)
+    return with_etag(response, etag) if etag else response
 
-        if resp.status_code == 207:
-            contact_list = parse_contacts_from_report(resp.content)
-            contact_list = sort_contacts(contact_list, sort_by)
-            logger.info(f"Loaded {len(contact_list)} contacts.")
-        else:
-            logger.error(f"REPORT failed: {resp.status_code} — {resp.text[:300]}")
-            flash(f"Could not load contacts (status {resp.status_code}).", 'error')
+
+@app.route('/api/contacts')
+@check_login_required
+def api_contacts():
+    sort_by = request.args.get('sort') or session.get('sort_by', 'first_name')
+    if sort_by not in VALID_SORTS:
+        return jsonify({'error': f"Unknown sort '{sort_by}'."}), 400
+    q = request.args.get('q', '').strip()
+    cursor = request.args.get('cursor', '')
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), PAGE_SIZE_MAX)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer.'}), 400
+
+    try:
+        if cursor:
+            decode_cursor(cursor)  # a malformed cursor costs no sync
+        # Follow-up pages reuse this worker's synced copy instead of resyncing
+        states = synced_books(get_user_session(), session['username'], refresh=not cursor)
+        etag = collection_etag(states, session['username'], sort_by, q, cursor, limit)
+        if (cached := not_modified(etag)) is not None:
+            return cached
+        return with_etag(jsonify(contacts_page(states, sort_by, q, cursor, limit)), etag)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except CardDAVError as e:
+        logger.error(f"Could not load contacts: {e}")
+        return jsonify({'error': f"Could not load contacts (status {e.status_code})."}), 502
     except Exception as e:
         logger.error(f"Error listing contacts: {e}")
-        flash(f"Error: {e}", 'error')
+        return jsonify({'error': str(e)}), 502
+
+
+@app.route('/api/contacts/search')
+@check_login_required
+def api_search_contacts():
+    """Best matches first; unlike /api/contacts the order is by relevance."""
+    q = request.args.get('q', '').strip()
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), PAGE_SIZE_MAX)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer.'}), 400
+    if not q:
+        return jsonify({'error': 'q is required.'}), 400
+
+    try:
+        # Searches run as the user types: answer from this worker's copy when it has one
+        states = synced_books(get_user_session(), session['username'], refresh=False)
+        etag = collection_etag(states, session['username'], 'search', q, limit)
+        if (cached := not_modified(etag)) is not None:
+            return cached
+        best, total = search_contacts(states, q, limit) or ([], 0)
+        return with_etag(jsonify({
+            'contacts': [dict(contact_to_json(c), score=score) for score, _, c in best],
+            'total': total,
+            'q': q,
+        }), etag)
+    except CardDAVError as e:
+        logger.error(f"Could not load contacts: {e}")
+        return jsonify({'error': f"Could not load contacts (status {e.status_code})."}), 502
+    except Exception as e:
+        logger.error(f"Error searching contacts: {e}")
+        return jsonify({'error': str(e)}), 502
+
+
+@app.route('/contacts/batch', methods=['POST'])
+@check_login_required
+def batch_contacts():
+    """JSON body: {"ids": [...], "op": "delete" | "set" | "append_note",
+    "field": one of BATCH_FIELDS (for "set"), "value": "..."}."""
+    if not validate_csrf():
+        return jsonify({'error': 'Invalid request (CSRF).'}), 400
+    payload = request.get_json(silent=True) or {}
+    ids, op = payload.get('ids'), payload.get('op')
+    field, value = payload.get('field') or '', payload.get('value') or ''
+    if not isinstance(ids, list) or not ids or not all(isinstance(i, str) and i for i in ids):
+        return jsonify({'error': 'ids must be a non-empty list of contact ids.'}), 400
+    if len(ids) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f"At most {BATCH_MAX_ITEMS} contacts per batch."}), 400
+    if op not in BATCH_OPS:
+        return jsonify({'error': f"op must be one of {', '.join(BATCH_OPS)}."}), 400
+    if op == 'set' and field not in BATCH_FIELDS:
+        return jsonify({'error': f"field must be one of {', '.join(BATCH_FIELDS)}."}), 400
+    if not isinstance(value, str) or (op == 'append_note' and not value.strip()):
+        return jsonify({'error': 'value must be a non-empty string.'}), 400
+
+    ids = list(dict.fromkeys(ids))
+    results = run_batch(
+        get_user_client(), get_user_session(), session['username'], ids, op, field, value.strip()
+    )
+    succeeded = sum(1 for r in results if r['ok'])
+    logger.info(f"Batch {op} {field}: {succeeded}/{len(results)} succeeded.")
+    return jsonify({'results': results, 'succeeded': succeeded, 'failed': len(results) - succeeded})
+
+
+@app.route('/api/contacts/duplicates')
+@check_login_required
+def api_duplicates():
+    """Groups of likely duplicates, best first; see find_duplicates()."""
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), PAGE_SIZE_MAX)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer.'}), 400
+
+    try:
+        states = synced_books(get_user_session(), session['username'])
+        etag = collection_etag(states, session['username'], 'duplicates', limit)
+        if (cached := not_modified(etag)) is not None:
+            return cached
+        groups = duplicate_groups(session['username'], states)
+        return with_etag(jsonify({
+            'groups': [{
+                'score': round(group['score'], 2),
+                'contacts': [contact_to_json(c) for c in group['contacts']],
+                'pairs': [{'a': i, 'b': j, 'score': round(score, 2), 'reasons': reasons}
+                          for i, j, score, reasons in group['pairs']],
+            } for group in groups[:limit]],
+            'total': len(groups),
+        }), etag)
+    except CardDAVError as e:
+        logger.error(f"Could not load contacts: {e}")
+        return jsonify({'error': f"Could not load contacts (status {e.status_code})."}), 502
+    except Exception as e:
+        logger.error(f"Error finding duplicates: {e}")
+        return jsonify({'error': str(e)}), 502
+
+
+@app.route('/contacts/merge', methods=['POST'])
+@check_login_required
+def merge_contacts():
+    """JSON body: {"ids": [...], "keep": one of ids (default: the first),
+    "preview": true to only see what the merged card would hold}."""
+    if not validate_csrf():
+        return jsonify({'error': 'Invalid request (CSRF).'}), 400
+    payload = request.get_json(silent=True) or {}
+    ids = payload.get('ids')
+    if not isinstance(ids, list) or not all(isinstance(i, str) and i for i in ids):
+        return jsonify({'error': 'ids must be a list of contact ids.'}), 400
+    ids = list(dict.fromkeys(ids))
+    if not 2 <= len(ids) <= MERGE_MAX_CARDS:
+        return jsonify({'error': f"Merge between 2 and {MERGE_MAX_CARDS} contacts."}), 400
+    keep = payload.get('keep') or ids[0]
+    if keep not in ids:
+        return jsonify({'error': 'keep must be one of ids.'}), 400
+
+    try:
+        outcome = run_merge(get_user_client(), get_user_session(), session['username'], keep, ids,
+                            preview=payload.get('preview') is True)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except BatchItemError as e:
+        logger.info(f"Merge into {keep} failed: {e}")
+        return jsonify({'error': str(e)}), 409 if e.status == 412 else 502
+    except Exception as e:
+        logger.error(f"Error merging contacts: {e}")
+        return jsonify({'error': str(e)}), 502
+    if 'results' not in outcome:
+        return jsonify(dict(outcome, preview=True))
+    deleted = sum(1 for r in outcome['results'] if r['ok'])
+    logger.info(f"Merged {deleted + 1}/{len(ids)} contacts into {keep}.")
+    return jsonify(dict(outcome, deleted=deleted, failed=len(outcome['results']) - deleted))
 
-    return render_template('index.html', contacts=contact_list, sort_by=sort_by)
+
+@app.route('/contacts/export.<fmt>')
+@check_login_required
+def export_contacts(fmt):
+    if fmt not in ('vcf', 'csv'):
+        abort(404)
+    s = get_user_session()
+    username = session['username']
+
+    def open_report(book: AddressBook) -> requests.Response:
+        # CSV only needs the list-view properties when the server can trim cards.
+        partial = fmt == 'csv' and get_sync_state(username, book.url).partial_data is True
+        return open_export_report(s, book.url, partial)
+
+    try:
+        books = user_address_books(s, username)
+        first = open_report(books[0])
+    except Exception as e:
+        logger.error(f"Error exporting contacts: {e}")
+        flash(f"Could not export contacts: {e}", 'error')
+        return redirect(url_for('contacts', sort=session.get('sort_by', 'first_name')))
+
+    def responses():
+        # The other books are opened as the download reaches them
+        yield first
+        for book in books[1:]:
+            try:
+                yield open_report(book)
+            except Exception as e:
+                logger.warning(f"Export left out address book '{book.name}': {e}")
+
+    rows = export_vcf(responses()) if fmt == 'vcf' else export_csv(responses())
+    filename = f"contacts-{time.strftime('%Y-%m-%d')}.{fmt}"
+    return Response(
+        _chunked(rows),
+        mimetype='text/vcard' if fmt == 'vcf' else 'text/csv',
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Cache-Control': 'private, no-store',
+            'X-Accel-Buffering': 'no',
+        },
+    )
+
+
+@app.route('/contacts/import', methods=['POST'])
+@check_login_required
+def import_contacts():
+    """Start importing an uploaded .vcf or .csv. Answers JSON with the job's
+    status URL when asked for JSON, else flashes and redirects."""
+    wants_json = request.accept_mimetypes.best == 'application/json'
+
+    def refuse(message: str, status: int):
+        if wants_json:
+            return jsonify({'error': message}), status
+        flash(message, 'error')
+        return redirect(url_for('contacts', sort=session.get('sort_by', 'first_name')))
+
+    request.max_content_length = IMPORT_MAX_BYTES
+    try:
+        if not validate_csrf():
+            return refuse('Invalid request (CSRF).', 400)
+        upload = request.files.get('file')
+    except RequestEntityTooLarge:
+        return refuse(f"File too large (limit {IMPORT_MAX_BYTES // (1024 * 1024)} MB).", 413)
+    if not upload or not upload.filename:
+        return refuse('No file selected.', 400)
+    if not import_jobs.enabled:
+        return refuse('Import is unavailable (cache directory not writable).', 503)
+
+    kind = 'csv' if upload.filename.lower().endswith('.csv') or upload.mimetype == 'text/csv' else 'vcf'
+    username = session['username']
+    job_id = import_jobs.create(username, os.path.basename(upload.filename))
+    path = os.path.join(IMPORT_DIR, f"{job_id}.{kind}")
+    upload.save(path)
+    threading.Thread(
+        target=run_import, name=f"import-{job_id}", daemon=True,
+        args=(job_id, path, kind, username, session['password'], get_user_carddav_url())
+    ).start()
+    logger.info(f"Import {job_id} started ({kind}).")
+
+    status_url = url_for('import_status', job_id=job_id)
+    if wants_json:
+        return jsonify({'job_id': job_id, 'status_url': status_url}), 202
+    flash('Import started — new contacts will appear as they are uploaded.', 'success')
+    return redirect(url_for('contacts', sort=session.get('sort_by', 'first_name')))
+
+
+@app.route('/contacts/import/<job_id>')
+@check_login_required
+def import_status(job_id):
+    job = import_jobs.get(session['username'], job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown import.'}), 404
+    return jsonify(job)
+
+
+@app.route('/contacts/<path:contact_id>/photo')
+@check_login_required
+def contact_photo(contact_id):
+    username = session['username']
+    try:
+        book_url, contact_url, href = contact_location(get_user_session(), username, contact_id)
+    except ValueError:
+        abort(404)
+
+    requested_tag = request.args.get('v', '')
+    tag = requested_tag
+    if not tag:
+        contact = get_sync_state(username, book_url).contacts.get(href)
+        tag = photo_tag(contact['etag']) if contact and contact['etag'] else ''
+
+    thumb = request.args.get('size') == 'thumb' and Image is not None
+    etag = f"{tag}-thumb" if thumb else tag
+
+    # A strong ETag, unlike not_modified(): the photo at a tag never changes
+    if tag and request.if_none_match.contains(etag):
+        unchanged = Response(status=304)
+        unchanged.set_etag(etag)
+        return unchanged
+
+    data = read_thumbnail(username, href, tag) if thumb and tag else None
+    if data is not None:
+        mimetype = 'image/jpeg'
+    else:
+        cached = contact_cache.get_photo(username, href, tag)
+        if cached:
+            data, mimetype = cached
+        else:
+            try:
+                resp = get_user_client().get(contact_url)
+            except Exception as e:
+                logger.error(f"Error fetching photo: {e}")
+                abort(502)
+            if resp.status_code != 200:
+                abort(404)
+            data, mimetype = extract_photo(resp.text)
+            if data is None:
+                abort(404)
+            card_etag = resp.headers.get('ETag')
+            tag = photo_tag(card_etag) if card_etag else hashlib.sha1(data).hexdigest()[:16]
+            contact_cache.put_photo(username, href, tag, data, mimetype)
+        if thumb:
+            thumb_data = make_thumbnail(username, href, tag, data)
+            if thumb_data is not None:
+                data, mimetype = thumb_data, 'image/jpeg'
+            else:
+                thumb = False
+        etag = f"{tag}-thumb" if thumb else tag
+
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(etag)
+    if requested_tag and requested_tag == tag:
+        response.headers['Cache-Control'] = f"private, max-age={PHOTO_MAX_AGE}, immutable"
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+def read_card_for_edit(client: CardDAVClient, contact_url: str) -> tuple:
+    """(text, etag, uid, photo bytes or None) of the card at `contact_url`."""
+    resp = client.get(contact_url)
+    if resp.status_code != 200:
+        raise Exception(f"Could not fetch contact: status {resp.status_code}")
+    text = resp.text
+    try:
+        vobj = vobject.readOne(text)
+    except Exception as parse_err:
+        raise Exception(f"Could not parse existing vCard: {parse_err}")
+    uid = vobj.uid.value if 'uid' in vobj.contents else str(uuid.uuid4())
+    photo = _decode_photo(vobj.photo)[0] if 'photo' in vobj.contents else None
+    return text, resp.headers.get('ETag', ''), uid, photo
+
+
+def put_card(client: CardDAVClient, contact_url: str, vcard_data: dict, etag: str = ''):
+    return client.put(contact_url, generate_vcard(vcard_data), etag=etag)
+
+
+def _same_fields(a: dict, b: dict) -> bool:
+    """Whether two parsed versions of a card show the same data."""
+    return {k: v for k, v in a.items() if k != 'etag'} == {k: v for k, v in b.items() if k != 'etag'}
 
 
 @app.route('/contacts/update', methods=['POST'])
@@ -589,34 +4003,57 @@ def update_contact():
         flash('Invalid request (CSRF).', 'error')
         return redirect(url_for('contacts'))
 
-    s = get_user_session()
-    carddav_url = get_user_carddav_url()
+    client = get_user_client()
+    username = session['username']
 
     try:
         contact_id = request.form.get('contact_id', '').strip()
         if not contact_id:
             raise Exception("Missing contact_id")
 
-        contact_url = f"{carddav_url.rstrip('/')}/{contact_id}"
-
-        existing_resp = s.get(contact_url, timeout=10)
-        if existing_resp.status_code != 200:
-            raise Exception(f"Could not fetch contact: status {existing_resp.status_code}")
-
-        try:
-            vobj = vobject.readOne(existing_resp.text)
-            existing_uid = vobj.uid.value if 'uid' in vobj.contents else str(uuid.uuid4())
-        except Exception as parse_err:
-            raise Exception(f"Could not parse existing vCard: {parse_err}")
+        book_url, contact_url, href = contact_location(get_user_session(), username, contact_id)
 
+        # The form carries the ETag and UID of the version it was opened on,
+        # so the update is one conditional PUT with no read beforehand.
+        etag = request.form.get('etag', '').strip()
+        uid = request.form.get('uid', '').strip()
         vcard_data = collect_vcard_data_from_form(request.form, request.files)
-        vcard_data['UID'] = existing_uid
-
-        if 'PHOTO' not in vcard_data and 'photo' in vobj.contents:
-            vcard_data['PHOTO'] = vobj.photo.value
-
-        vcard_content = generate_vcard(vcard_data)
-        resp = s.put(contact_url, data=vcard_content, headers={'Content-Type': 'text/vcard'}, timeout=10)
+        keep_photo = 'PHOTO' not in vcard_data and request.form.get('has_photo') == '1'
+        if keep_photo and etag:
+            cached = contact_cache.get_photo(username, href, photo_tag(etag))
+            if cached:
+                vcard_data['PHOTO'] = cached[0]
+
+        if not etag or not uid or (keep_photo and 'PHOTO' not in vcard_data):
+            # Opened without a known version, or the photo is not cached
+            _, etag, fetched_uid, photo = read_card_for_edit(client, contact_url)
+            uid = uid or fetched_uid
+            if keep_photo and photo:
+                vcard_data['PHOTO'] = photo
+        vcard_data['UID'] = uid
+
+        resp = put_card(client, contact_url, vcard_data, etag)
+        if resp.status_code == 412:
+            # Changed since the form was opened. Retry once on the new version
+            # if nothing the form shows differs from what the user saw (e.g.
+            # the server only bumped REV); otherwise keep the other change.
+            original = get_sync_state(username, book_url).contacts.get(href)
+            text, etag, _, photo = read_card_for_edit(client, contact_url)
+            current = parse_vcard(href, text)
+            if (original is None or original['etag'] != request.form.get('etag', '').strip()
+                    or current is None or not _same_fields(original, current)):
+                contact_cache.invalidate(username, href)
+                logger.info(f"Edit conflict on {contact_id}: changed on the server meanwhile.")
+                flash('This contact was changed elsewhere in the meantime, so your edit was not saved. '
+                      'The list now shows the latest version; please edit it again.', 'error')
+                return redirect(url_for('contacts', sort=session.get('sort_by', 'first_name')))
+            if keep_photo:
+                vcard_data.pop('PHOTO', None)
+                if photo:
+                    vcard_data['PHOTO'] = photo
+            resp = put_card(client, contact_url, vcard_data, etag)
+
+        contact_cache.invalidate(username, href)
         if resp.status_code not in (200, 201, 204):
             raise Exception(f"Status {resp.status_code}: {resp.text[:200]}")
 
@@ -628,19 +4065,20 @@ def update_contact():
     return redirect(url_for('contacts', sort=session.get('sort_by', 'first_name')))
 
 
-@app.route('/contacts/<contact_id>/delete', methods=['POST'])
+@app.route('/contacts/<path:contact_id>/delete', methods=['POST'])
 @check_login_required
 def delete_contact(contact_id):
     if not validate_csrf():
         flash('Invalid request (CSRF).', 'error')
         return redirect(url_for('contacts'))
 
-    s = get_user_session()
-    carddav_url = get_user_carddav_url()
+    client = get_user_client()
+    username = session['username']
 
     try:
-        contact_url = f"{carddav_url.rstrip('/')}/{contact_id}"
-        resp = s.delete(contact_url, timeout=10)
+        _, contact_url, href = contact_location(get_user_session(), username, contact_id)
+        resp = client.delete(contact_url)
+        contact_cache.invalidate(username, href)
         if resp.status_code not in (200, 204):
             raise Exception(f"Status {resp.status_code}")
         flash('Contact deleted.', 'success')
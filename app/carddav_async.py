@@ -0,0 +1,212 @@
+"""
+Asynchronous CardDAV client for GUIVCard.
+
+Upstream calls run on aiohttp, on one event loop per worker process that
+lives in a background thread. Flask views stay synchronous and go through
+CardDAVClient, which submits each call to that loop and waits for the
+result. Independent calls (the items of a batch, say) are fanned out with
+CardDAVClient.map() and overlap on the loop instead of each holding a
+thread, and under a threaded gunicorn worker (gthread) a view waiting on a
+slow server leaves the other threads of the process free.
+"""
+
+import asyncio
+import base64
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Iterable, List
+from xml.sax.saxutils import escape as xml_escape
+
+import aiohttp
+
+import metrics
+
+USER_AGENT = 'GUIVCard/2.0'
+DEFAULT_TIMEOUT = 10
+
+
+class Response:
+    """A fully read upstream response, shaped like the bits of
+    requests.Response the app uses."""
+
+    __slots__ = ('status_code', 'headers', 'content')
+
+    def __init__(self, status_code: int, headers, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        # vCard 3.0/4.0 and DAV XML are UTF-8 unless the server says otherwise
+        charset = 'utf-8'
+        for param in self.headers.get('Content-Type', '').split(';')[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'charset' and value:
+                charset = value.strip('"')
+        return self.content.decode(charset, errors='replace')
+
+
+class AsyncCardDAVClient:
+    """One user's connection to the CardDAV server. The aiohttp session
+    (and with it the keep-alive connection pool) is opened on first use,
+    inside the event loop that will run it."""
+
+    def __init__(self, username: str, password: str, connections: int = 4, timeout: int = DEFAULT_TIMEOUT):
+        # Sent as a plain header: aiohttp deprecates BasicAuth and auth=.
+        # latin-1, as aiohttp.BasicAuth and requests encode credentials.
+        credentials = base64.b64encode(f'{username}:{password}'.encode('latin1')).decode('ascii')
+        self._authorization = f'Basic {credentials}'
+        self._connections = connections
+        self._timeout = timeout
+        self._session = None
+
+    def _client_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={'User-Agent': USER_AGENT, 'Authorization': self._authorization},
+                connector=aiohttp.TCPConnector(limit=self._connections),
+                timeout=aiohttp.ClientTimeout(total=self._timeout),
+            )
+        return self._session
+
+    async def request(self, method: str, url: str, data: bytes = None, headers: dict = None,
+                      timeout: int = None) -> Response:
+        kwargs = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+        started = time.perf_counter()
+        try:
+            async with self._client_session().request(method, url, data=data, headers=headers, **kwargs) as resp:
+                response = Response(resp.status, resp.headers, await resp.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            metrics.observe_upstream(method, 'error', started)
+            raise
+        metrics.observe_upstream(method, response.status_code, started)
+        return response
+
+    async def propfind(self, url: str, body: str = '', depth: str = '0') -> Response:
+        headers = {'Depth': depth}
+        if body:
+            headers['Content-Type'] = 'application/xml; charset=utf-8'
+        return await self.request('PROPFIND', url, body.encode('utf-8') if body else None, headers)
+
+    async def report(self, url: str, body: str, depth: str = '1', timeout: int = 30) -> Response:
+        return await self.request(
+            'REPORT', url, body.encode('utf-8'),
+            {'Depth': depth, 'Content-Type': 'application/xml; charset=utf-8'},
+            timeout=timeout
+        )
+
+    async def multiget(self, url: str, hrefs: Iterable[str], address_data: str = '<C:address-data/>') -> Response:
+        """addressbook-multiget of `hrefs` (RFC 6352 §8.7)."""
+        href_xml = '\n'.join(f"    <D:href>{xml_escape(h)}</D:href>" for h in hrefs)
+        body = f'''<?xml version="1.0" encoding="utf-8" ?>
+<C:addressbook-multiget xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav">
+    <D:prop>
+        <D:getetag/>
+        {address_data}
+    </D:prop>
+{href_xml}
+</C:addressbook-multiget>'''
+        return await self.report(url, body)
+
+    async def get(self, url: str) -> Response:
+        return await self.request('GET', url)
+
+    async def put(self, url: str, data, etag: str = '', create: bool = False,
+                  content_type: str = 'text/vcard; charset=utf-8') -> Response:
+        """PUT a card. With `etag` only if it is still that version
+        (If-Match); with `create` only if it does not exist yet."""
+        headers = {'Content-Type': content_type}
+        if etag:
+            headers['If-Match'] = etag
+        if create:
+            headers['If-None-Match'] = '*'
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return await self.request('PUT', url, data, headers)
+
+    async def delete(self, url: str, etag: str = '') -> Response:
+        return await self.request('DELETE', url, headers={'If-Match': etag} if etag else None)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class _LoopThread:
+    """The worker's event loop, run forever in a daemon thread. Started on
+    first use and again after a fork, since a forked child inherits the
+    loop object but not the thread running it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._pid = None
+
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                threading.Thread(target=self._loop.run_forever, name='carddav-async', daemon=True).start()
+            return self._loop
+
+    def run(self, coro: Awaitable):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop()).result()
+
+
+_loop_thread = _LoopThread()
+
+
+class CardDAVClient:
+    """Blocking facade over AsyncCardDAVClient for synchronous views. Every
+    method runs the coroutine of the same name on the worker's loop."""
+
+    def __init__(self, username: str, password: str, connections: int = 4, timeout: int = DEFAULT_TIMEOUT):
+        self.aio = AsyncCardDAVClient(username, password, connections, timeout)
+        self._pid = os.getpid()
+
+    def _run(self, coro: Awaitable):
+        if self._pid != os.getpid():
+            # Inherited across a fork: the old session belongs to the parent's loop
+            self.aio._session = None
+            self._pid = os.getpid()
+        return _loop_thread.run(coro)
+
+    def request(self, *args, **kwargs) -> Response:
+        return self._run(self.aio.request(*args, **kwargs))
+
+    def propfind(self, *args, **kwargs) -> Response:
+        return self._run(self.aio.propfind(*args, **kwargs))
+
+    def report(self, *args, **kwargs) -> Response:
+        return self._run(self.aio.report(*args, **kwargs))
+
+    def multiget(self, *args, **kwargs) -> Response:
+        return self._run(self.aio.multiget(*args, **kwargs))
+
+    def get(self, *args, **kwargs) -> Response:
+        return self._run(self.aio.get(*args, **kwargs))
+
+    def put(self, *args, **kwargs) -> Response:
+        return self._run(self.aio.put(*args, **kwargs))
+
+    def delete(self, *args, **kwargs) -> Response:
+        return self._run(self.aio.delete(*args, **kwargs))
+
+    def map(self, fn: Callable[[AsyncCardDAVClient, object], Awaitable], items: Iterable,
+            concurrency: int = 4) -> List:
+        """Await `fn(client, item)` for every item, at most `concurrency` at
+        a time, and return the results in the order of `items`."""
+        async def run_all():
+            limit = asyncio.Semaphore(max(1, concurrency))
+
+            async def one(item):
+                async with limit:
+                    return await fn(self.aio, item)
+            return await asyncio.gather(*(one(item) for item in items))
+        return self._run(run_all())
+
+    def close(self) -> None:
+        self._run(self.aio.close())
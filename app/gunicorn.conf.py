@@ -0,0 +1,26 @@
+"""
+gunicorn settings for GUIVCard.
+
+Workers keep their Prometheus samples in PROMETHEUS_MULTIPROC_DIR so that
+/metrics can add them up across workers. The directory is emptied when
+the server starts, and a worker's live gauges are dropped when it exits.
+"""
+
+import glob
+import os
+
+from prometheus_client import multiprocess
+
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/guivcard-metrics')
+
+
+def on_starting(server):
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(path, exist_ok=True)
+    # Only our own files: the variable may point at a shared directory
+    for name in glob.glob(os.path.join(path, '*.db')):
+        os.remove(name)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
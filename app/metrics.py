@@ -0,0 +1,168 @@
+"""
+Prometheus metrics and per-request phase timings for GUIVCard.
+
+Under gunicorn every worker writes its samples to files in
+PROMETHEUS_MULTIPROC_DIR (set up by gunicorn.conf.py) and /metrics merges
+the files of all workers, so counters and histograms add up across
+workers whichever one answers the scrape. Without that variable, as with
+`python app.py`, the process's own registry is served.
+
+The same instrumentation points also add their time to the phases of the
+request being served (upstream, XML, vCard parsing…), which the app sends
+back as a Server-Timing header. Phases live in a context variable, so they
+follow a request into the threads and event-loop tasks it starts.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+)
+from prometheus_client import multiprocess
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR', '')
+
+# Page views are dominated by upstream round trips: up to a minute
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_LATENCY = Histogram(
+    'guivcard_http_request_duration_seconds', 'Time to build a response, per route.',
+    ['route', 'method'], buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    'guivcard_http_requests', 'Responses sent, per route and status.',
+    ['route', 'method', 'status'],
+)
+UPSTREAM_LATENCY = Histogram(
+    'guivcard_upstream_request_duration_seconds',
+    'CardDAV round trips per method, up to the response headers for streamed bodies.',
+    ['method'], buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_REQUESTS = Counter(
+    'guivcard_upstream_requests', 'CardDAV requests per method and status ("error" when no response came).',
+    ['method', 'status'],
+)
+REPORT_BYTES = Histogram(
+    'guivcard_report_response_bytes', 'Size of REPORT response bodies, per kind of REPORT.',
+    ['kind'], buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8),
+)
+PARSE_SECONDS = Histogram(
+    'guivcard_vcard_parse_seconds', 'Time to parse one vCard.',
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1),
+)
+PARSED = Counter('guivcard_vcards_parsed', 'vCards parsed.')
+PARSE_FAILURES = Counter('guivcard_vcard_parse_failures', 'vCards that could not be parsed.')
+CONTACTS = Gauge(
+    'guivcard_synced_contacts',
+    'Contacts held in the synced address books of the workers (a user open in two workers counts twice).',
+    multiprocess_mode='livesum',
+)
+CACHE_LOOKUPS = Counter(
+    'guivcard_cache_lookups', 'Cache lookups per cache, by result ("hit" or "miss").',
+    ['cache', 'result'],
+)
+
+
+class Phases:
+    """Time spent per phase by one request, and how many times each ran.
+    Threads of the same request add to it concurrently."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.totals = {}  # phase -> [seconds, count]
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, count: int = 1) -> None:
+        with self._lock:
+            total = self.totals.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += count
+
+    def server_timing(self, last: str = 'total') -> str:
+        """Server-Timing header value, the phases in the order they first ran,
+        then the time elapsed so far as `last`. Phases run concurrently
+        (several address books, a batch) add up."""
+        with self._lock:
+            entries = [
+                f'{name};dur={seconds * 1000:.1f};desc="{count}"' if count > 1 else f'{name};dur={seconds * 1000:.1f}'
+                for name, (seconds, count) in self.totals.items()
+            ]
+        entries.append(f'{last};dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(entries)
+
+
+_phases: contextvars.ContextVar = contextvars.ContextVar('guivcard_phases', default=None)
+
+
+def start_phases() -> Phases:
+    phases = Phases()
+    _phases.set(phases)
+    return phases
+
+
+def current_phases():
+    """Phases of the request being served, or None outside of one."""
+    return _phases.get()
+
+
+def add_phase(name: str, seconds: float, count: int = 1) -> None:
+    phases = _phases.get()
+    if phases is not None:
+        phases.add(name, seconds, count)
+
+
+@contextmanager
+def phase(name: str, count: int = 1):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(name, time.perf_counter() - started, count)
+
+
+def observe_upstream(method: str, status, started: float) -> None:
+    """Record a CardDAV request that began at time.perf_counter() `started`."""
+    seconds = time.perf_counter() - started
+    UPSTREAM_LATENCY.labels(method).observe(seconds)
+    UPSTREAM_REQUESTS.labels(method, str(status)).inc()
+    add_phase('upstream', seconds)
+
+
+def cache_lookup(cache: str, hits: int = 0, misses: int = 0) -> None:
+    if hits:
+        CACHE_LOOKUPS.labels(cache, 'hit').inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache, 'miss').inc(misses)
+
+
+def metered(chunks, kind: str):
+    """Pass a REPORT body through, recording its size once it is consumed
+    and the time spent waiting for it as upstream time."""
+    size, waited = 0, 0.0
+    chunks = iter(chunks)
+    try:
+        while True:
+            started = time.perf_counter()
+            chunk = next(chunks, None)
+            waited += time.perf_counter() - started
+            if chunk is None:
+                break
+            size += len(chunk)
+            yield chunk
+    finally:
+        REPORT_BYTES.labels(kind).observe(size)
+        add_phase('upstream', waited, count=0)
+
+
+def render() -> tuple:
+    """(body, content type) of the current metrics, of all workers."""
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,183 @@
+"""
+On-demand sampling profiler for GUIVCard.
+
+An admin arms a job for one route and a number of requests. The job lives
+in a file under the profile directory, so every gunicorn worker sees it;
+each worker claims request slots with O_EXCL marker files until the job's
+count is used up. While a claimed request runs, a sampler thread reads the
+stack of the thread serving it every `interval` seconds, and when the
+request ends its stacks are appended, in the folded format of
+flamegraph.pl and speedscope ("frame;frame;frame count" per line), to a
+per-worker file. Reading the profile merges the files of all workers.
+
+Everything else pays one stat() of the job file per request.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+MAX_STACK_DEPTH = 128
+
+
+class SamplingProfiler:
+    """Profile jobs, slot claims and the sampler thread of one worker."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._job_path = os.path.join(directory, 'job.json')
+        self._job = None
+        self._job_mtime = None
+        self._used_up = None  # id of a job whose slots are all claimed
+        self._active = {}  # thread id -> Counter of folded stacks
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    # -- job control (admin) -------------------------------------------------
+
+    def arm(self, route: str, requests: int, interval: float) -> dict:
+        """Profile the next `requests` requests to `route`, replacing any
+        previous job and its output."""
+        self.clear()
+        job = {
+            'id': uuid.uuid4().hex, 'route': route, 'requests': requests,
+            'interval': interval, 'armed_at': time.time(),
+        }
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        tmp = f"{self._job_path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+        os.replace(tmp, self._job_path)
+        return job
+
+    def clear(self) -> None:
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name == 'job.json' or name.endswith(('.slot', '.folded')):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def status(self) -> dict:
+        """The armed job, how many of its requests have been profiled, and
+        the merged folded stacks collected so far."""
+        job = self._read_job()
+        if job is None:
+            return {'job': None, 'claimed': 0, 'samples': 0, 'folded': ''}
+        names = os.listdir(self.directory)
+        claimed = sum(1 for name in names if name.startswith(job['id']) and name.endswith('.slot'))
+        stacks = Counter()
+        for name in names:
+            if name.startswith(job['id']) and name.endswith('.folded'):
+                try:
+                    with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                        for line in f:
+                            stack, _, count = line.rstrip('\n').rpartition(' ')
+                            if stack:
+                                stacks[stack] += int(count)
+                except (OSError, ValueError):
+                    continue
+        folded = ''.join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+        return {'job': job, 'claimed': claimed, 'samples': sum(stacks.values()), 'folded': folded}
+
+    def _read_job(self):
+        """The job file, re-read only when its mtime changes."""
+        try:
+            mtime = os.stat(self._job_path).st_mtime_ns
+        except OSError:
+            self._job = self._job_mtime = None
+            return None
+        if mtime != self._job_mtime:
+            try:
+                with open(self._job_path, encoding='utf-8') as f:
+                    self._job = json.load(f)
+                self._job_mtime = mtime
+            except (OSError, ValueError):
+                return None
+        return self._job
+
+    # -- per request -----------------------------------------------------------
+
+    def begin(self, route: str):
+        """Start sampling the current thread if a job wants this request.
+        Returns a token for end(), or None."""
+        job = self._read_job()
+        if job is None or job['route'] != route or job['id'] == self._used_up:
+            return None
+        for slot in range(job['requests']):
+            try:
+                fd = os.open(os.path.join(self.directory, f"{job['id']}.{slot}.slot"),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+            except FileExistsError:
+                continue
+            except OSError:
+                return None
+            os.close(fd)
+            ident = threading.get_ident()
+            with self._lock:
+                self._active[ident] = Counter()
+            self._ensure_thread()
+            return job['id'], ident
+        self._used_up = job['id']
+        return None
+
+    def end(self, token) -> None:
+        if token is None:
+            return
+        job_id, ident = token
+        with self._lock:
+            stacks = self._active.pop(ident, None)
+        if not stacks:
+            return
+        try:
+            with open(os.path.join(self.directory, f"{job_id}.{os.getpid()}.folded"), 'a', encoding='utf-8') as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+        except OSError:
+            pass
+
+    # -- sampler ---------------------------------------------------------------
+
+    def _ensure_thread(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                targets = list(self._active)
+            job = self._job
+            if not targets:
+                time.sleep(0.05)
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for ident in targets:
+                    frame = frames.get(ident)
+                    stacks = self._active.get(ident)
+                    if frame is not None and stacks is not None:
+                        stacks[_fold(frame)] += 1
+            del frames
+            time.sleep(job['interval'] if job else 0.005)
+
+
+def _fold(frame) -> str:
+    """'outermost;…;innermost' for a frame, one 'function (file:line)' each."""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
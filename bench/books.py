@@ -0,0 +1,111 @@
+"""
+Synthetic address books for benchmarks.
+
+Cards are vCard 3.0 with the properties real books carry (accented names,
+several emails and phones, organization, address, birthday, notes, folded
+long lines) and, for a chosen share of them, a base64 PHOTO of a chosen
+size. The same seed always gives the same book.
+
+bench/corpus/ holds hand-written cards of the shapes real servers send
+(folded lines, QUOTED-PRINTABLE, CHARSET parameters, grouped properties,
+escapes, photos, vCard 2.1 and 4.0), on which the fast list-view parser
+is checked against vobject and timed.
+"""
+
+import base64
+import os
+import random
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+FIRST_NAMES = (
+    'Adèle', 'Agnès', 'Alice', 'Amélie', 'André', 'Anaïs', 'Benoît', 'Bob', 'Camille', 'Céline',
+    'Chloé', 'Clément', 'Daniel', 'Élodie', 'Émile', 'Éric', 'Françoise', 'Gaëlle', 'Hélène',
+    'Inès', 'Jérôme', 'Jörg', 'José', 'Léa', 'Lucas', 'Maëlle', 'Mathéo', 'Noémie', 'Olivier',
+    'Renée', 'Søren', 'Stéphane', 'Thérèse', 'Yannick', 'Zoé', 'Łukasz', 'Ángel', 'Çağan',
+)
+LAST_NAMES = (
+    'Martin', 'Bernard', 'Dubois', 'Thomas', 'Robert', 'Richard', 'Petit', 'Durand', 'Leroy',
+    'Moreau', 'Simon', 'Laurent', 'Lefèvre', 'Michel', 'García', 'Müller', 'Schröder', 'Nguyễn',
+    'O\'Brien', 'van der Berg', 'Østergaard', 'Kowalski', 'Rossi', 'Fernández', 'Öztürk',
+)
+ORGANIZATIONS = (
+    'Acme', 'Initech', 'Globex', 'Umbrella', 'Hooli', 'Stark Industries', 'Wayne Enterprises',
+    'Société Générale', 'Müller & Söhne', 'Café de Flore', '', '', '',
+)
+CITIES = ('Paris', 'Lyon', 'Marseille', 'Bordeaux', 'Lille', 'Genève', 'Bruxelles', 'Montréal')
+
+
+def _fold(line: str) -> str:
+    """RFC 6350 §3.2 line folding at 75 octets (approximated in characters)."""
+    if len(line) <= 75:
+        return line
+    parts = [line[:75]]
+    parts += [' ' + line[i:i + 74] for i in range(75, len(line), 74)]
+    return '\r\n'.join(parts)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace(',', '\\,').replace(';', '\\;').replace('\n', '\\n')
+
+
+def make_card(index: int, rng: random.Random, photo: bytes = b'') -> str:
+    """One card, with `photo` (raw bytes) embedded if given."""
+    first = rng.choice(FIRST_NAMES)
+    last = rng.choice(LAST_NAMES)
+    org = rng.choice(ORGANIZATIONS)
+    login = f"{first}.{last}".lower().encode('ascii', 'ignore').decode().replace(' ', '').replace("'", '')
+    lines = [
+        'BEGIN:VCARD',
+        'VERSION:3.0',
+        f"UID:bench-{index:06d}",
+        f"FN:{_escape(f'{first} {last}')}",
+        f"N:{_escape(last)};{_escape(first)};;;",
+        f"EMAIL;TYPE=INTERNET,HOME:{login}{index}@example.org",
+    ]
+    if rng.random() < 0.4:
+        lines.append(f"EMAIL;TYPE=INTERNET,WORK:{login}@{(org or 'work').lower().split()[0]}.example.com")
+    lines.append(f"TEL;TYPE=CELL:+33 6 {rng.randrange(10**8):08d}")
+    if rng.random() < 0.3:
+        lines.append(f"TEL;TYPE=WORK:+33 1 {rng.randrange(10**8):08d}")
+    if org:
+        lines.append(f"ORG:{_escape(org)}")
+    if rng.random() < 0.5:
+        city = rng.choice(CITIES)
+        lines.append(f"ADR;TYPE=HOME:;;{rng.randrange(1, 200)} rue de la Paix;{city};;{rng.randrange(10000, 99999)};France")
+    if rng.random() < 0.4:
+        lines.append(f"BDAY:{rng.randrange(1940, 2010)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}")
+    if rng.random() < 0.3:
+        lines.append(f"URL:https://{login}.example.net/")
+    if rng.random() < 0.25:
+        note = ' '.join(rng.choice(('met at', 'conference', 'café', 'rendez-vous', 'Lyon', 'call back',
+                                    'project', 'école', 'birthday', 'neighbour')) for _ in range(rng.randrange(5, 40)))
+        lines.append(f"NOTE:{_escape(note)}")
+    if photo:
+        lines.append('PHOTO;ENCODING=b;TYPE=JPEG:' + base64.b64encode(photo).decode('ascii'))
+    lines.append(f"REV:2024{rng.randrange(1, 13):02d}{rng.randrange(1, 29):02d}T120000Z")
+    lines.append('END:VCARD')
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
+
+
+def make_book(size: int, photo_ratio: float = 0.0, photo_size: int = 0, seed: int = 1):
+    """Yield (resource name, vCard text) for a book of `size` cards, of which
+    about `photo_ratio` carry a photo of `photo_size` bytes. Photos come
+    from their own random stream, so the rest of the book does not depend
+    on the photo settings."""
+    rng = random.Random(seed)
+    photo_rng = random.Random(seed + 1)
+    for index in range(size):
+        photo = b''
+        if photo_size and photo_rng.random() < photo_ratio:
+            # JPEG markers around noise: the size is right, the image is not
+            photo = b'\xff\xd8\xff\xe0' + photo_rng.randbytes(max(photo_size - 6, 0)) + b'\xff\xd9'
+        yield f"bench-{index:06d}.vcf", make_card(index, rng, photo)
+
+
+def corpus():
+    """(resource name, vCard text) of every card of bench/corpus/, as stored."""
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        if name.endswith('.vcf'):
+            with open(os.path.join(CORPUS_DIR, name), encoding='utf-8', newline='') as f:
+                yield name, f.read()
@@ -0,0 +1,331 @@
+"""
+In-process stand-in for a CardDAV server (Radicale), for benchmarks.
+
+It keeps address books in memory and answers what GUIVCard sends:
+PROPFIND (collection, principal and address-book home discovery), the
+sync-collection, addressbook-multiget and addressbook-query REPORTs
+(honouring partial address-data), GET, PUT (If-Match / If-None-Match) and
+DELETE (If-Match). Every request can be delayed by a fixed latency, and request and
+byte counts are kept per method. GET /__stats__ returns them as JSON and
+POST /__stats__ resets them, so a benchmark in another process can read
+them.
+
+Any username is accepted with the password given to FakeCardDAV.
+"""
+
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+from xml.etree import ElementTree as ET
+
+D = 'DAV:'
+C = 'urn:ietf:params:xml:ns:carddav'
+CS = 'http://calendarserver.org/ns/'
+
+# What the server does with a partial address-data request: honour it, ignore
+# it and send whole cards, or reject it with 400.
+PARTIAL_MODES = ('honour', 'ignore', 'reject')
+
+
+class Book:
+    """One address-book collection: cards, ETags and a change log for sync."""
+
+    def __init__(self, name: str = ''):
+        self.name = name
+        self.cards = {}  # resource name -> (etag, text)
+        self.rev = 0
+        self.log = []  # (rev, resource name), for sync-collection
+        self.lock = threading.Lock()
+
+    def put(self, name: str, text: str) -> str:
+        with self.lock:
+            self.rev += 1
+            etag = '"%s"' % hashlib.md5(f"{self.rev}:{text}".encode('utf-8')).hexdigest()
+            self.cards[name] = (etag, text)
+            self.log.append((self.rev, name))
+            return etag
+
+    def delete(self, name: str) -> bool:
+        with self.lock:
+            if self.cards.pop(name, None) is None:
+                return False
+            self.rev += 1
+            self.log.append((self.rev, name))
+            return True
+
+    def changes_since(self, rev: int) -> list:
+        with self.lock:
+            names = dict.fromkeys(name for r, name in self.log if r > rev)
+        return list(names)
+
+
+class FakeCardDAV:
+    """WSGI application serving `books`: {'/user/collection/': Book}."""
+
+    def __init__(self, books: dict, password: str = 'pw', latency: float = 0.0,
+                 sync: bool = True, partial: str = 'honour'):
+        if partial not in PARTIAL_MODES:
+            raise ValueError(f"partial must be one of {PARTIAL_MODES}")
+        self.books = books
+        self.password = password
+        self.latency = latency
+        self.sync = sync
+        self.partial = partial
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    # -- bookkeeping -------------------------------------------------------
+
+    def reset_stats(self) -> None:
+        with self.stats_lock:
+            self.stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'by_method': {}}
+
+    def _count(self, method: str, bytes_in: int, bytes_out: int) -> None:
+        with self.stats_lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_in'] += bytes_in
+            self.stats['bytes_out'] += bytes_out
+            m = self.stats['by_method'].setdefault(method, {'requests': 0, 'bytes_in': 0, 'bytes_out': 0})
+            m['requests'] += 1
+            m['bytes_in'] += bytes_in
+            m['bytes_out'] += bytes_out
+
+    def _locate(self, path: str) -> tuple:
+        """(collection path, Book, resource name) for a request path."""
+        for col, book in self.books.items():
+            if path == col.rstrip('/') or path.startswith(col):
+                return col, book, path[len(col):]
+        return None, None, None
+
+    # -- WSGI --------------------------------------------------------------
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ.get('PATH_INFO', '/')
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length) if length else b''
+
+        if path == '/__stats__':
+            if method == 'POST':
+                self.reset_stats()
+            with self.stats_lock:
+                data = json.dumps(self.stats).encode('utf-8')
+            start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(data)))])
+            return [data]
+
+        if self.latency:
+            time.sleep(self.latency)
+        status, headers, data = self._handle(environ, method, path, body)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._count(method, len(body), len(data))
+        start_response(status, [('Content-Length', str(len(data)))] + headers)
+        return [data]
+
+    def _handle(self, environ, method: str, path: str, body: bytes) -> tuple:
+        if not self._authorized(environ.get('HTTP_AUTHORIZATION', '')):
+            return '401 Unauthorized', [('WWW-Authenticate', 'Basic realm="fakedav"')], b''
+        if method == 'PROPFIND':
+            return self._propfind(path, environ.get('HTTP_DEPTH', '0'))
+        if method == 'REPORT':
+            return self._report(path, body)
+        col, book, name = self._locate(path)
+        if book is None or not name:
+            return '404 Not Found' if method != 'PUT' else '409 Conflict', [], b''
+        if method == 'GET':
+            if name not in book.cards:
+                return '404 Not Found', [], b''
+            etag, text = book.cards[name]
+            return '200 OK', [('ETag', etag), ('Content-Type', 'text/vcard; charset=utf-8')], text
+        if method == 'PUT':
+            current = book.cards.get(name)
+            if_match = environ.get('HTTP_IF_MATCH')
+            if if_match and (current is None or current[0] != if_match):
+                return '412 Precondition Failed', [], b''
+            if environ.get('HTTP_IF_NONE_MATCH') == '*' and current is not None:
+                return '412 Precondition Failed', [], b''
+            etag = book.put(name, body.decode('utf-8'))
+            return ('204 No Content' if current else '201 Created'), [('ETag', etag)], b''
+        if method == 'DELETE':
+            if_match = environ.get('HTTP_IF_MATCH')
+            if if_match and name in book.cards and book.cards[name][0] != if_match:
+                return '412 Precondition Failed', [], b''
+            return ('204 No Content' if book.delete(name) else '404 Not Found'), [], b''
+        return '405 Method Not Allowed', [], b''
+
+    def _authorized(self, header: str) -> bool:
+        if not header.startswith('Basic '):
+            return False
+        try:
+            _, _, password = base64.b64decode(header[6:]).decode('utf-8').partition(':')
+        except Exception:
+            return False
+        return password == self.password
+
+    # -- PROPFIND ----------------------------------------------------------
+
+    def _propfind(self, path: str, depth: str) -> tuple:
+        home = re.match(r'^/([^/]+)/?$', path)
+        if home:
+            return self._propfind_home(f"/{home.group(1)}/", depth)
+        col, book, name = self._locate(path)
+        if book is None or name:
+            return '404 Not Found', [], b''
+        user = col.split('/')[1]
+        top = _response(col, [
+            ('{DAV:}resourcetype', _resourcetype(addressbook=True)),
+            ('{DAV:}displayname', book.name),
+            ('{%s}getctag' % CS, str(book.rev)),
+            ('{DAV:}sync-token', f"tok-{book.rev}"),
+            ('{DAV:}current-user-principal', _href(f"/{user}/")),
+        ])
+        responses = [top]
+        if depth == '1':
+            for card, (etag, _) in list(book.cards.items()):
+                responses.append(_response(col + card, [('{DAV:}getetag', etag), ('{DAV:}resourcetype', None)]))
+        return _multistatus(responses)
+
+    def _propfind_home(self, home: str, depth: str) -> tuple:
+        responses = [_response(home, [
+            ('{DAV:}resourcetype', _resourcetype()),
+            ('{DAV:}current-user-principal', _href(home)),
+            ('{%s}addressbook-home-set' % C, _href(home)),
+        ])]
+        if depth == '1':
+            for col, book in self.books.items():
+                if col.startswith(home):
+                    responses.append(_response(col, [
+                        ('{DAV:}resourcetype', _resourcetype(addressbook=True)),
+                        ('{DAV:}displayname', book.name),
+                    ]))
+        return _multistatus(responses)
+
+    # -- REPORT ------------------------------------------------------------
+
+    def _report(self, path: str, body: bytes) -> tuple:
+        col, book, _ = self._locate(path)
+        if book is None:
+            return '404 Not Found', [], b''
+        try:
+            root = ET.fromstring(body)
+        except ET.ParseError:
+            return '400 Bad Request', [], b''
+        kind = root.tag.split('}')[-1]
+        address_data = root.find('.//{%s}address-data' % C)
+        wanted = {}
+        if address_data is not None:
+            wanted = {e.get('name', '').upper(): e.get('novalue') == 'yes'
+                      for e in address_data.findall('{%s}prop' % C)}
+        if wanted and self.partial == 'reject':
+            return '400 Bad Request', [], b''
+
+        def card_response(name: str):
+            etag, text = book.cards[name]
+            props = [('{DAV:}getetag', etag)]
+            if address_data is not None:
+                props.append(('{%s}address-data' % C, _trim(text, wanted) if wanted and self.partial == 'honour' else text))
+            return _response(col + name, props)
+
+        if kind == 'addressbook-query':
+            return _multistatus([card_response(n) for n in list(book.cards)])
+        if kind == 'addressbook-multiget':
+            responses = []
+            for h in root.findall('{DAV:}href'):
+                name = (h.text or '').rsplit('/', 1)[-1]
+                responses.append(card_response(name) if name in book.cards
+                                 else _response(h.text, status='HTTP/1.1 404 Not Found'))
+            return _multistatus(responses)
+        if kind == 'sync-collection':
+            return self._sync_collection(col, book, root, card_response)
+        return '400 Bad Request', [], b''
+
+    def _sync_collection(self, col: str, book: Book, root, card_response) -> tuple:
+        if not self.sync:
+            return '403 Forbidden', [], '<?xml version="1.0"?><D:error xmlns:D="DAV:"><D:supported-report/></D:error>'
+        token = (root.findtext('{DAV:}sync-token') or '').strip()
+        if token:
+            m = re.match(r'^tok-(\d+)$', token)
+            if not m or int(m.group(1)) > book.rev:
+                return '403 Forbidden', [], '<?xml version="1.0"?><D:error xmlns:D="DAV:"><D:valid-sync-token/></D:error>'
+            names = book.changes_since(int(m.group(1)))
+        else:
+            names = list(book.cards)
+        responses = [card_response(n) if n in book.cards else _response(col + n, status='HTTP/1.1 404 Not Found')
+                     for n in names]
+        return _multistatus(responses, sync_token=f"tok-{book.rev}")
+
+
+def _href(value: str):
+    el = ET.Element('{DAV:}href')
+    el.text = value
+    return el
+
+
+def _resourcetype(addressbook: bool = False):
+    el = ET.Element('{DAV:}resourcetype')
+    ET.SubElement(el, '{DAV:}collection')
+    if addressbook:
+        ET.SubElement(el, '{%s}addressbook' % C)
+    return el
+
+
+def _response(href: str, props=None, status: str = None):
+    r = ET.Element('{DAV:}response')
+    ET.SubElement(r, '{DAV:}href').text = href
+    if status:
+        ET.SubElement(r, '{DAV:}status').text = status
+    if props is not None:
+        propstat = ET.SubElement(r, '{DAV:}propstat')
+        prop = ET.SubElement(propstat, '{DAV:}prop')
+        for tag, value in props:
+            el = ET.SubElement(prop, tag)
+            if isinstance(value, ET.Element):
+                if value.tag == tag:
+                    el.extend(list(value))
+                else:
+                    el.append(value)
+            elif value is not None:
+                el.text = value
+        ET.SubElement(propstat, '{DAV:}status').text = 'HTTP/1.1 200 OK'
+    return r
+
+
+def _multistatus(responses: list, sync_token: str = None) -> tuple:
+    root = ET.Element('{DAV:}multistatus')
+    root.extend(responses)
+    if sync_token is not None:
+        ET.SubElement(root, '{DAV:}sync-token').text = sync_token
+    data = b'<?xml version="1.0" encoding="utf-8"?>\n' + ET.tostring(root)
+    return '207 Multi-Status', [('Content-Type', 'application/xml; charset=utf-8')], data
+
+
+def _trim(text: str, wanted: dict) -> str:
+    """A card reduced to the properties of a partial address-data request."""
+    kept = []
+    for line in text.replace('\r\n ', '').split('\r\n'):
+        name = re.split('[;:]', line, maxsplit=1)[0].split('.')[-1].upper()
+        if name in ('BEGIN', 'END') or name in wanted:
+            kept.append(line.split(':', 1)[0] + ':' if wanted.get(name) else line)
+    return '\r\n'.join(kept)
+
+
+class _ThreadingServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(app: FakeCardDAV, host: str = '127.0.0.1', port: int = 0):
+    """Serve `app` from a daemon thread. Returns the server; its port is
+    `server.server_port` and `server.shutdown()` stops it."""
+    server = make_server(host, port, app, server_class=_ThreadingServer, handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, name='fakedav', daemon=True).start()
+    return server
@@ -0,0 +1,328 @@
+"""
+GUIVCard benchmark harness.
+
+    python bench/run.py --sizes 100,1000,10000,50000 --photo-ratio 0.3 \
+        --photo-size 20000 --latency 0.005 --output bench_output.json
+
+For every book size, a fake CardDAV server (bench/fakedav.py) holding a
+synthetic book (bench/books.py) is started in its own process, and the app
+is imported fresh in another one and driven through Flask's test client,
+so the peak RSS reported is the app's alone. Per size, the report gives:
+
+- page latency: first /contacts after login (cold caches), a repeat view
+  (incremental sync), a 304 revalidation, a view from a fresh worker over
+  the warm SQLite cache, an /api/contacts page, two searches and the
+  duplicate finder;
+- throughput of parse_contacts_from_report (fast path and vobject),
+  and, per card of bench/corpus/, the time of both parsers and whether the
+  fast path agreed with vobject, declined, or differed; throughput
+  of building the sort orders, of find_duplicates and of generate_vcard;
+- peak RSS of the app process after the page steps and at the end;
+- upstream requests and bytes, per method, of every page step.
+
+Books, and so results, are reproducible for a given --seed. Runs need the
+app's requirements installed; nothing else.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'app')
+USERNAME = 'bench'
+PASSWORD = 'pw'
+
+
+# ---------------------------------------------------------------------------
+# Fake server process
+# ---------------------------------------------------------------------------
+
+def _server_main(ready, options: dict) -> None:
+    sys.path.insert(0, BENCH_DIR)
+    from books import make_book
+    from fakedav import Book, FakeCardDAV, serve
+
+    book = Book('Contacts')
+    for name, text in make_book(options['size'], options['photo_ratio'], options['photo_size'], options['seed']):
+        book.put(name, text)
+    app = FakeCardDAV({f'/{USERNAME}/contacts/': book}, password=PASSWORD,
+                      latency=options['latency'], partial=options['partial'])
+    server = serve(app)
+    ready.put(server.server_port)
+    threading.Event().wait()
+
+
+def _upstream(port: int, reset: bool = False) -> dict:
+    request = urllib.request.Request(f'http://127.0.0.1:{port}/__stats__', method='POST' if reset else 'GET')
+    with urllib.request.urlopen(request) as resp:
+        return json.loads(resp.read())
+
+
+# ---------------------------------------------------------------------------
+# App process
+# ---------------------------------------------------------------------------
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+def _compare_corpus(guivcard, rounds: int = 200) -> dict:
+    """Per corpus card: microseconds of the fast path and of vobject, and
+    `same`, `declined` (the fast path left it to vobject) or `differs`."""
+    from books import corpus
+
+    cards = {}
+    for name, text in corpus():
+        href = f'/{USERNAME}/contacts/{name}'
+        timed = {}
+        for label, parse in (('fast', guivcard.fast_parse_vcard), ('vobject', guivcard.parse_vcard_vobject)):
+            started = time.perf_counter()
+            for _ in range(rounds):
+                result = parse(href, text)
+            timed[label] = (round((time.perf_counter() - started) / rounds * 1e6, 1), result)
+        fast, vobj = timed['fast'][1], timed['vobject'][1]
+        cards[name] = {
+            'fast_us': timed['fast'][0], 'vobject_us': timed['vobject'][0],
+            'outcome': 'declined' if fast is None else 'same' if fast == vobj else 'differs',
+        }
+    return cards
+
+
+def _measure_main(results, port: int, options: dict) -> None:
+    try:
+        results.put(_measure(port, options))
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+
+
+def _measure(port: int, options: dict) -> dict:
+    cache_dir = tempfile.mkdtemp(prefix='guivcard-bench-')
+    os.environ.update({
+        'CARDDAV_URL': f'http://127.0.0.1:{port}/{{username}}/contacts/',
+        'SECRET_KEY': 'bench',
+        'CACHE_DIR': cache_dir,
+        'REFRESH_INTERVAL': '0',  # no background work skewing the timings
+    })
+    sys.path[:0] = [APP_DIR, BENCH_DIR]
+    import logging
+    logging.disable(logging.INFO)
+    import app as guivcard
+
+    client = guivcard.app.test_client()
+    repeat = options['repeat']
+    out = {'pages': {}}
+
+    def step(name: str, path: str, times: int = 1, headers: dict = None, expect: int = 200) -> object:
+        _upstream(port, reset=True)
+        samples = []
+        for _ in range(times):
+            started = time.perf_counter()
+            resp = client.get(path, headers=headers or {})
+            body = resp.get_data()  # a streamed page is only done once its body is read
+            samples.append(time.perf_counter() - started)
+            if resp.status_code != expect:
+                raise RuntimeError(f"{name}: {path} answered {resp.status_code}, expected {expect}")
+        upstream = _upstream(port)
+        out['pages'][name] = {
+            'ms': _ms(statistics.median(samples)),
+            'ms_min': _ms(min(samples)),
+            'response_bytes': len(body),
+            'upstream_requests': upstream['requests'],
+            'upstream_bytes': upstream['bytes_out'],
+            'upstream_by_method': upstream['by_method'],
+        }
+        return resp
+
+    started = time.perf_counter()
+    resp = client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+    if resp.status_code != 302:
+        raise RuntimeError(f"login answered {resp.status_code}")
+    out['login_ms'] = _ms(time.perf_counter() - started)
+
+    step('cold', '/contacts')
+    # The cold page streams before the books are synced, so only warm pages carry an ETag
+    page = step('warm', '/contacts', repeat)
+    step('revalidate_304', '/contacts', repeat, {'If-None-Match': page.headers.get('ETag', '')}, expect=304)
+    with guivcard._sync_states_lock:
+        guivcard._sync_states.clear()  # what another worker sees: the SQLite cache only
+    step('fresh_worker', '/contacts')
+    first = client.get('/api/contacts?limit=50').get_json()
+    cursor = first.get('next_cursor') or ''
+    step('api_page', f'/api/contacts?limit=50&cursor={cursor}', repeat)
+    step('search_prefix', '/api/contacts/search?q=mar', repeat)
+    step('search_fuzzy', '/api/contacts/search?q=muler', repeat)
+    step('duplicates', '/api/contacts/duplicates')
+    out['peak_rss_pages_mb'] = _peak_rss_mb()
+
+    # Throughput of the hot paths, on the whole book
+    import requests
+    report = requests.request(
+        'REPORT', f'http://127.0.0.1:{port}/{USERNAME}/contacts/', auth=(USERNAME, PASSWORD),
+        headers={'Depth': '1', 'Content-Type': 'application/xml; charset=utf-8'},
+        data=b'<?xml version="1.0" encoding="utf-8" ?><C:addressbook-query xmlns:D="DAV:" '
+             b'xmlns:C="urn:ietf:params:xml:ns:carddav"><D:prop><D:getetag/><C:address-data/>'
+             b'</D:prop></C:addressbook-query>',
+    ).content
+    out['report_bytes'] = len(report)
+
+    def throughput(name: str, fn, items: int, nbytes: int = 0) -> object:
+        samples, result = [], None
+        for _ in range(max(1, min(repeat, 3))):
+            started = time.perf_counter()
+            result = fn()
+            samples.append(time.perf_counter() - started)
+        best = min(samples)
+        out[name] = {'ms': _ms(best), 'items': items, 'items_per_s': round(items / best) if best else None}
+        if nbytes:
+            out[name]['mb_per_s'] = round(nbytes / best / 1e6, 1) if best else None
+        return result
+
+    contacts = throughput('parse_fast', lambda: guivcard.parse_contacts_from_report(report), options['size'], len(report))
+    # vobject is much slower: measured on at most 2000 cards
+    subset = list(itertools.islice(guivcard.iter_report_cards([report]), 2000))
+    throughput('parse_vobject', lambda: [guivcard.parse_vcard_vobject(h, t) for h, _, t in subset], len(subset))
+    out['corpus'] = _compare_corpus(guivcard)
+    for sort_by in guivcard.VALID_SORTS:
+        throughput(f'sort_{sort_by}', lambda: guivcard.SortOrder(sort_by, contacts), len(contacts))
+    throughput('search_index', lambda: guivcard.SearchIndex(contacts), len(contacts))
+    throughput('find_duplicates', lambda: guivcard.find_duplicates(contacts), len(contacts))
+    forms = [{
+        'FN': c['name'], 'N': f"{guivcard._as_str(c['last_name'])};{guivcard._as_str(c['first_name'])};;;",
+        'EMAIL': guivcard._as_str(c['email']), 'TEL': guivcard._as_str(c['phone']),
+        'ORG': c['org'], 'URL': c['url'], 'NOTE': c['note'], 'UID': c['uid'],
+    } for c in contacts]
+    throughput('generate_vcard', lambda: [guivcard.generate_vcard(f) for f in forms], len(forms))
+    out['peak_rss_mb'] = _peak_rss_mb()
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Driver
+# ---------------------------------------------------------------------------
+
+def run_size(size: int, args) -> dict:
+    ctx = multiprocessing.get_context('spawn')
+    options = {
+        'size': size, 'photo_ratio': args.photo_ratio, 'photo_size': args.photo_size,
+        'seed': args.seed, 'latency': args.latency, 'partial': args.partial, 'repeat': args.repeat,
+    }
+    ready = ctx.Queue()
+    server = ctx.Process(target=_server_main, args=(ready, options), daemon=True)
+    server.start()
+    try:
+        port = ready.get(timeout=600)
+        results = ctx.Queue()
+        worker = ctx.Process(target=_measure_main, args=(results, port, options))
+        worker.start()
+        result = results.get(timeout=args.timeout)
+        worker.join(30)
+    finally:
+        server.terminate()
+        server.join()
+    if 'error' in result:
+        raise RuntimeError(f"{size} cards:\n{result['error']}")
+    return {'size': size, **result}
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ''
+
+
+def print_table(runs: list) -> None:
+    columns = [
+        ('cards', lambda r: r['size']),
+        ('cold ms', lambda r: r['pages']['cold']['ms']),
+        ('warm ms', lambda r: r['pages']['warm']['ms']),
+        ('304 ms', lambda r: r['pages']['revalidate_304']['ms']),
+        ('worker ms', lambda r: r['pages']['fresh_worker']['ms']),
+        ('api ms', lambda r: r['pages']['api_page']['ms']),
+        ('search ms', lambda r: r['pages']['search_prefix']['ms']),
+        ('parse c/s', lambda r: r['parse_fast']['items_per_s']),
+        ('vobject c/s', lambda r: r['parse_vobject']['items_per_s']),
+        ('sort ms', lambda r: r['sort_first_name']['ms']),
+        ('dups ms', lambda r: r['find_duplicates']['ms']),
+        ('gen c/s', lambda r: r['generate_vcard']['items_per_s']),
+        ('cold up KB', lambda r: round(r['pages']['cold']['upstream_bytes'] / 1024)),
+        ('warm up KB', lambda r: round(r['pages']['warm']['upstream_bytes'] / 1024, 1)),
+        ('RSS MB', lambda r: r['peak_rss_mb']),
+    ]
+    rows = [[str(get(r)) for _, get in columns] for r in runs]
+    widths = [max(len(title), *(len(row[i]) for row in rows)) for i, (title, _) in enumerate(columns)]
+    print('  '.join(title.rjust(w) for (title, _), w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(value.rjust(w) for value, w in zip(row, widths)))
+
+
+def print_corpus(cards: dict) -> None:
+    width = max(len(name) for name in cards)
+    print(f"{'corpus card'.ljust(width)}  {'fast µs':>8}  {'vobject µs':>10}  outcome")
+    for name, r in cards.items():
+        print(f"{name.ljust(width)}  {r['fast_us']:>8}  {r['vobject_us']:>10}  {r['outcome']}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark GUIVCard against a fake CardDAV server.')
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='comma-separated book sizes, in cards (default: 100,1000,10000)')
+    parser.add_argument('--photo-ratio', type=float, default=0.3, help='share of cards with a photo (default: 0.3)')
+    parser.add_argument('--photo-size', type=int, default=20000, help='photo size in bytes (default: 20000)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every upstream request')
+    parser.add_argument('--partial', choices=('honour', 'ignore', 'reject'), default='honour',
+                        help='how the server treats partial address-data requests (default: honour)')
+    parser.add_argument('--repeat', type=int, default=5, help='samples per repeated step (default: 5)')
+    parser.add_argument('--seed', type=int, default=1, help='book generator seed (default: 1)')
+    parser.add_argument('--timeout', type=int, default=1800, help='seconds allowed per size (default: 1800)')
+    parser.add_argument('--output', help='also write the full report as JSON to this file')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    report = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'options': vars(args),
+        },
+        'runs': [],
+    }
+    for size in sizes:
+        print(f"Benchmarking {size} cards…", file=sys.stderr, flush=True)
+        report['runs'].append(run_size(size, args))
+
+    print_table(report['runs'])
+    print()
+    print_corpus(report['runs'][-1]['corpus'])
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Full report written to {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+Shared fixtures: one fake CardDAV server (bench/fakedav.py) for the whole
+session, the app imported against it, and per-test users with their own
+address book so tests do not see each other's cards.
+"""
+
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'app'), os.path.join(ROOT, 'bench')]
+
+from fakedav import Book, FakeCardDAV, serve  # noqa: E402
+
+PASSWORD = 'pw'
+DAV = FakeCardDAV({}, password=PASSWORD)
+_server = serve(DAV)
+
+# The app reads its settings at import time
+os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+os.environ.update({
+    'CARDDAV_URL': f'http://127.0.0.1:{_server.server_port}/{{username}}/contacts/',
+    'SECRET_KEY': 'test',
+    'CACHE_DIR': tempfile.mkdtemp(prefix='guivcard-tests-'),
+    'REFRESH_INTERVAL': '0',
+})
+
+import app as guivcard  # noqa: E402
+
+_users = itertools.count(1)
+
+
+@pytest.fixture
+def dav():
+    DAV.latency = 0.0
+    yield DAV
+    DAV.latency = 0.0
+
+
+@pytest.fixture
+def user(dav):
+    """(username, Book) of a new user with an empty address book."""
+    name = f"user{next(_users)}"
+    book = dav.books[f'/{name}/contacts/'] = Book('Contacts')
+    return name, book
+
+
+def login(username: str):
+    client = guivcard.app.test_client()
+    resp = client.post('/login', data={'username': username, 'password': PASSWORD})
+    assert resp.status_code == 302
+    return client
+
+
+@pytest.fixture
+def client(user):
+    return login(user[0])
+
+
+def csrf_headers(client) -> dict:
+    with client.session_transaction() as s:
+        if 'csrf_token' not in s:
+            s['csrf_token'] = 'test-token'
+        return {'X-CSRF-Token': s['csrf_token']}
+
+
+def card(uid: str, fn: str, *lines: str) -> str:
+    """A vCard 3.0 with UID and FN, plus `lines` as given."""
+    first, _, last = fn.rpartition(' ')
+    return '\r\n'.join(
+        ['BEGIN:VCARD', 'VERSION:3.0', f'UID:{uid}', f'FN:{fn}', f'N:{last};{first};;;', *lines, 'END:VCARD']
+    ) + '\r\n'
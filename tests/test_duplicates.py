@@ -0,0 +1,95 @@
+"""Finding duplicate contacts and merging them into one card."""
+
+import base64
+
+import vobject
+
+from conftest import card, csrf_headers
+
+PHOTO = base64.b64encode(b'\x89PNG not really').decode('ascii')
+
+
+def put_cards(user, *cards):
+    name, book = user
+    for uid, text in cards:
+        book.put(f'{uid}.vcf', text)
+    return [f'{name}/contacts/{uid}.vcf' for uid, _ in cards]
+
+
+def merge(client, ids, keep=None, preview=False):
+    return client.post('/contacts/merge', json={'ids': ids, 'keep': keep or ids[0], 'preview': preview},
+                       headers=csrf_headers(client))
+
+
+def test_duplicates_found_by_email_and_phone(client, user):
+    put_cards(user,
+              ('a', card('a', 'Jane Doe', 'EMAIL:jane@example.com')),
+              ('b', card('b', 'J. Doe', 'EMAIL:JANE@example.com')),
+              ('c', card('c', 'Bob Roe', 'TEL:+33 6 12 34 56 78')),
+              ('d', card('d', 'Robert Roe', 'TEL:06 12 34 56 78')),
+              ('e', card('e', 'Someone Else')))
+    groups = client.get('/api/contacts/duplicates').get_json()['groups']
+    assert sorted(sorted(c['id'].rsplit('/', 1)[1] for c in g['contacts']) for g in groups) == [
+        ['a.vcf', 'b.vcf'], ['c.vcf', 'd.vcf']]
+
+
+def test_merge_keeps_properties_the_form_does_not_show(client, user):
+    ids = put_cards(
+        user,
+        ('a', card('a', 'Jane Doe', 'EMAIL:jane@example.com', 'TITLE:CEO', 'ORG:Acme;Sales',
+                   'CATEGORIES:work', 'BDAY:1980-01-01', f'PHOTO;ENCODING=b;TYPE=PNG:{PHOTO}')),
+        ('b', card('b', 'Jane Doe', 'EMAIL:JANE@example.com', 'CATEGORIES:friends,work',
+                   'X-CUSTOM:kept', 'item1.EMAIL:jane@home.example', 'item1.X-ABLabel:Home',
+                   'ADR;TYPE=HOME:;;1 Main St;Springfield;;12345;', 'BDAY:1981-02-02',
+                   f"PHOTO;ENCODING=b;TYPE=PNG:{base64.b64encode(b'other').decode('ascii')}",
+                   'NOTE:met at the fair')),
+    )
+    resp = merge(client, ids)
+    assert resp.status_code == 200, resp.get_json()
+    data = resp.get_json()
+    assert data['deleted'] == 1 and data['dropped'] == [f'PHOTO of {ids[1]}']
+
+    _, book = user
+    assert 'b.vcf' not in book.cards
+    merged = vobject.readOne(book.cards['a.vcf'][1])
+    assert merged.uid.value == 'a'
+    assert merged.title.value == 'CEO'
+    assert merged.org.value == ['Acme', 'Sales']
+    assert merged.bday.value == '1980-01-01'
+    assert merged.photo.value == b'\x89PNG not really'
+    assert sorted(merged.categories.value) == ['friends', 'work']
+    assert merged.contents['x-custom'][0].value == 'kept'
+    assert len(merged.contents['email']) == 2
+    home = [e for e in merged.contents['email'] if e.value == 'jane@home.example'][0]
+    assert home.group and [p.value for p in merged.contents['x-ablabel'] if p.group == home.group] == ['Home']
+    assert merged.adr.value.street == '1 Main St'
+    assert sorted(merged.note.value.split('\n')) == ['BDAY: 1981-02-02', 'met at the fair']
+
+
+def test_merge_preview_writes_nothing(client, user):
+    ids = put_cards(user,
+                    ('a', card('a', 'Jane Doe', 'TITLE:CEO')),
+                    ('b', card('b', 'Jane Doe', 'TEL:555 0100', 'TEL:555 0101')))
+    _, book = user
+    before = dict(book.cards)
+    resp = merge(client, ids, preview=True)
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['preview'] is True and data['dropped'] == []
+    assert data['properties']['TITLE'] == 1 and data['properties']['TEL'] == 2
+    assert book.cards == before
+
+
+def test_merge_refuses_a_kept_card_changed_meanwhile(client, user, monkeypatch):
+    import app as guivcard
+    ids = put_cards(user, ('a', card('a', 'Jane Doe')), ('b', card('b', 'Jane Doe', 'TITLE:CEO')))
+    _, book = user
+    merge_vcards = guivcard.merge_vcards
+
+    def edited_meanwhile(texts):
+        book.put('a.vcf', card('a', 'Jane Doe', 'NOTE:edited'))
+        return merge_vcards(texts)
+
+    monkeypatch.setattr(guivcard, 'merge_vcards', edited_meanwhile)
+    assert merge(client, ids).status_code == 409
+    assert 'b.vcf' in book.cards and 'NOTE:edited' in book.cards['a.vcf'][1]
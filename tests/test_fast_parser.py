@@ -0,0 +1,23 @@
+"""The fast list-view parser against vobject, on bench/corpus/."""
+
+import pytest
+
+import app as guivcard
+from books import corpus
+
+CARDS = dict(corpus())
+# Cards the fast path must hand to vobject
+DECLINED = {'charset.vcf', 'quoted-printable.vcf', 'vcard-2.1.vcf'}
+
+
+@pytest.mark.parametrize('name', sorted(CARDS))
+def test_fast_parser_matches_vobject(name):
+    href = f'/user/contacts/{name}'
+    expected = guivcard.parse_vcard_vobject(href, CARDS[name])
+    assert expected is not None
+    fast = guivcard.fast_parse_vcard(href, CARDS[name])
+    if name in DECLINED:
+        assert fast is None
+    else:
+        assert fast == expected
+
@@ -0,0 +1,41 @@
+"""A logout served by one worker drops the user's state in every worker."""
+
+import app as guivcard
+
+from conftest import card, login
+from fakedav import Book
+
+
+def held(username: str) -> bool:
+    with guivcard._sync_states_lock:
+        synced = any(user == username for user, _ in guivcard._sync_states)
+    with guivcard._address_books_lock:
+        return synced or username in guivcard._address_books
+
+
+def test_logout_elsewhere_drops_the_state_on_the_next_request(client, user, dav):
+    username, book = user
+    book.put('a.vcf', card('a', 'Jane Doe'))
+    assert client.get('/api/contacts').status_code == 200
+    assert held(username)
+
+    # What the worker serving the logout writes; this one only sees the marker
+    guivcard.contact_cache.record_logout(username)
+    dav.books[f'/{username}-other/contacts/'] = Book('Contacts')
+    other = login(f'{username}-other')
+    other.get('/health')
+    assert not held(username)
+
+
+def test_logout_leaves_a_marker_and_a_new_login_keeps_its_state(client, user):
+    username, book = user
+    book.put('a.vcf', card('a', 'Jane Doe'))
+    _, seq = guivcard.contact_cache.logouts_after(0)
+    assert client.get('/logout').status_code == 302
+    assert guivcard.contact_cache.logouts_after(seq)[0] == [username]
+    assert not held(username)
+
+    again = login(username)
+    assert again.get('/api/contacts').get_json()['contacts'][0]['name'] == 'Jane Doe'
+    again.get('/health')
+    assert held(username)
@@ -0,0 +1,26 @@
+import app as guivcard
+from conftest import card
+
+
+def test_metrics_carry_no_usernames(user, client):
+    username, book = user
+    book.put('a.vcf', card('uid-a', 'Ada Lovelace'))
+    client.get('/api/contacts')
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'guivcard_synced_contacts' in body
+    assert username not in body
+
+
+def test_metrics_without_token_are_local_only(client, monkeypatch):
+    monkeypatch.setattr(guivcard, 'METRICS_TOKEN', '')
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '10.1.2.3'}).status_code == 403
+
+
+def test_metrics_token(client, monkeypatch):
+    monkeypatch.setattr(guivcard, 'METRICS_TOKEN', 's3cret')
+    remote = {'REMOTE_ADDR': '10.1.2.3'}
+    assert client.get('/metrics', environ_base=remote).status_code == 401
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 401
+    ok = client.get('/metrics', environ_base=remote, headers={'Authorization': 'Bearer s3cret'})
+    assert ok.status_code == 200
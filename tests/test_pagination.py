@@ -0,0 +1,40 @@
+"""Keyset pagination of /api/contacts."""
+
+import base64
+import json
+
+import pytest
+
+from conftest import card
+
+
+def cursor_of(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+
+def test_pages_follow_the_cursor(client, user):
+    _, book = user
+    for i in range(5):
+        book.put(f'{i}.vcf', card(str(i), f'Person {i}'))
+    first = client.get('/api/contacts?limit=3').get_json()
+    second = client.get(f"/api/contacts?limit=3&cursor={first['next_cursor']}").get_json()
+    names = [c['name'] for c in first['contacts'] + second['contacts']]
+    assert names == [f'Person {i}' for i in range(5)] and second['next_cursor'] is None
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!',
+    cursor_of({'a': 1}),
+    cursor_of([1, 2]),
+    cursor_of([[0, 'a', 'a'], [0, 'b', 'b']]),
+    cursor_of([[0, 'a', 'a'], [0, 'b', 'b'], 3]),
+    cursor_of([[0, 'a'], [0, 'b', 'b'], 'id']),
+    cursor_of([['0', 'a', 'a'], [0, 'b', 'b'], 'id']),
+    cursor_of([[0, 'a', 'a'], [True, 'b', 'b'], 'id']),
+    cursor_of([[0, 'a', None], [0, 'b', 'b'], 'id']),
+])
+def test_malformed_cursor_is_a_bad_request(client, user, cursor):
+    user[1].put('a.vcf', card('a', 'Jane Doe'))
+    resp = client.get(f'/api/contacts?cursor={cursor}')
+    assert resp.status_code == 400
+    assert resp.get_json()['error'].startswith('Invalid cursor')
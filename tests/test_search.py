@@ -0,0 +1,43 @@
+"""Search index and ranking, against a plain scan of the same contacts."""
+
+import heapq
+
+import pytest
+
+import app as guivcard
+from books import make_book
+from conftest import card
+
+CONTACTS = [guivcard.parse_vcard(f'/u/contacts/{name}', text) for name, text in make_book(400, seed=3)]
+BY_HREF = {c['href']: c for c in CONTACTS}
+
+
+def scan(q: str) -> dict:
+    """{href: score} of a search, without the shortcuts for short terms."""
+    index = guivcard.SearchIndex(CONTACTS)
+    result = None
+    for term in set(guivcard._TOKEN_RE.findall(guivcard.fold_text(q))):
+        scores = index._match_term(term)
+        result = scores if result is None else {h: s + scores[h] for h, s in result.items() if h in scores}
+    return result
+
+
+@pytest.mark.parametrize('q', ['e', 'a', 'ma', 'mar', 'martin', 'martin e', 'e m', 'a b c', 'muler', 'zz'])
+def test_search_and_ranking_match_a_plain_scan(q):
+    index = guivcard.SearchIndex(CONTACTS)
+    order = guivcard.SortOrder('first_name', CONTACTS)
+    scores = index.search(q)
+    assert scores == scan(q)
+    assert order.subset(scores) == sorted((order.key_of[h], h) for h in scores)
+    expected = heapq.nsmallest(20, scores, key=lambda h: (-scores[h], guivcard.contact_sort_key(BY_HREF[h])))
+    assert [href for _, href in order.best(scores, 20)] == expected
+
+
+def test_search_route_ranks_exact_matches_first(client, user):
+    _, book = user
+    book.put('a.vcf', card('a', 'Anna Bell'))
+    book.put('b.vcf', card('b', 'Al Bundy'))
+    book.put('c.vcf', card('c', 'A Zed'))
+    data = client.get('/api/contacts/search?q=a&limit=2').get_json()
+    assert data['total'] == 3
+    assert [c['name'] for c in data['contacts']] == ['A Zed', 'Al Bundy']
@@ -0,0 +1,59 @@
+import re
+
+from prometheus_client import REGISTRY
+
+from conftest import card
+
+
+def _latency(route: str) -> tuple:
+    labels = {'route': route, 'method': 'GET'}
+    return (REGISTRY.get_sample_value('guivcard_http_request_duration_seconds_sum', labels) or 0.0,
+            REGISTRY.get_sample_value('guivcard_http_request_duration_seconds_count', labels) or 0.0)
+
+
+def _timing(value: str) -> dict:
+    return {m.group(1): float(m.group(2)) for m in re.finditer(r'(\w+);dur=([\d.]+)', value)}
+
+
+def test_streamed_page_latency_covers_the_body(dav, user, client):
+    _, book = user
+    for i in range(5):
+        book.put(f'c{i}.vcf', card(f'uid-{i}', f'Person {i}', f'EMAIL:p{i}@example.org'))
+    dav.latency = 0.1
+    total_before, count_before = _latency('/contacts')
+
+    # Cold: the address books are synced while the body streams
+    resp = client.get('/contacts')
+    header = _timing(resp.headers['Server-Timing'])
+    body = resp.get_data(as_text=True)
+    resp.close()
+
+    assert 'total' not in header and 'headers' in header
+    total_after, count_after = _latency('/contacts')
+    assert count_after == count_before + 1
+    recorded = total_after - total_before
+    # At least the sync-collection and multiget round trips of the body
+    assert recorded >= header['headers'] / 1000 + 0.2
+
+    trailer = re.search(r'<!-- Server-Timing: (.*) -->\s*$', body)
+    assert trailer is not None
+    timing = _timing(trailer.group(1))
+    assert timing['total'] >= 200 and timing['upstream'] >= 200
+    assert timing['total'] <= recorded * 1000 + 1
+
+
+def test_warm_page_timing_keeps_its_phases(user, client):
+    _, book = user
+    book.put('a.vcf', card('uid-a', 'Ada Lovelace'))
+    client.get('/contacts').close()
+    resp = client.get('/contacts')
+    body = resp.get_data(as_text=True)
+    resp.close()
+    timing = _timing(re.search(r'<!-- Server-Timing: (.*) -->', body).group(1))
+    assert {'sort', 'render', 'total'} <= set(timing)
+
+
+def test_buffered_responses_keep_the_header(client):
+    resp = client.get('/api/contacts')
+    assert resp.status_code == 200
+    assert 'total' in _timing(resp.headers['Server-Timing'])
@@ -0,0 +1,88 @@
+"""Incremental sync of an address book against the fake server's change log."""
+
+import functools
+
+import app as guivcard
+from conftest import PASSWORD, card
+from fakedav import Book
+
+
+def sync(username: str) -> guivcard.AddressBookState:
+    url = guivcard.build_user_url(username)
+    guivcard.sync_address_book(guivcard.session_pool.get(username, PASSWORD), username, url)
+    return guivcard.get_sync_state(username, url)
+
+
+def names(state) -> dict:
+    return {href.rsplit('/', 1)[1]: c['name'] for href, c in state.contacts.items()}
+
+
+def reports(dav) -> dict:
+    return dav.stats['by_method'].get('REPORT', {}).get('requests', 0)
+
+
+def local_ctag(state) -> int:
+    return functools.reduce(lambda d, c: d ^ guivcard._card_digest(c), state.contacts.values(), 0)
+
+
+def test_changed_and_removed_cards_come_from_the_change_log(user, dav):
+    username, book = user
+    for uid in 'abc':
+        book.put(f'{uid}.vcf', card(uid, f'Person {uid.upper()}'))
+    state = sync(username)
+    assert names(state) == {'a.vcf': 'Person A', 'b.vcf': 'Person B', 'c.vcf': 'Person C'}
+    first_token, first_digest = state.sync_token, state.digest
+
+    book.put('b.vcf', card('b', 'Person Bee'))
+    book.delete('c.vcf')
+    book.put('d.vcf', card('d', 'Person D'))
+    dav.reset_stats()
+    state = sync(username)
+
+    assert names(state) == {'a.vcf': 'Person A', 'b.vcf': 'Person Bee', 'd.vcf': 'Person D'}
+    assert state.sync_token != first_token
+    # One sync-collection from the old token, one multiget of b and d
+    assert reports(dav) == 2
+    assert state.digest == local_ctag(state) != first_digest
+
+
+def test_nothing_changed_costs_one_report(user, dav):
+    username, book = user
+    book.put('a.vcf', card('a', 'Person A'))
+    digest = sync(username).digest
+    dav.reset_stats()
+    state = sync(username)
+    assert reports(dav) == 1 and state.digest == digest
+
+
+def test_rejected_sync_token_resyncs_from_scratch(user, dav):
+    username, book = user
+    for uid in 'ab':
+        book.put(f'{uid}.vcf', card(uid, f'Person {uid.upper()}'))
+    sync(username)
+
+    # The server lost its history: the old token is now ahead of it
+    fresh = dav.books[f'/{username}/contacts/'] = Book('Contacts')
+    fresh.put('b.vcf', card('b', 'Person Bee'))
+    state = sync(username)
+    assert names(state) == {'b.vcf': 'Person Bee'}
+    assert state.supports_sync and state.sync_token == f'tok-{fresh.rev}'
+    assert state.digest == local_ctag(state)
+
+
+def test_server_without_sync_collection_falls_back_to_propfind(user, dav, monkeypatch):
+    username, book = user
+    for uid in 'abc':
+        book.put(f'{uid}.vcf', card(uid, f'Person {uid.upper()}'))
+    monkeypatch.setattr(dav, 'sync', False)
+    state = sync(username)
+    assert not state.supports_sync
+    assert len(state.contacts) == 3
+
+    book.delete('a.vcf')
+    book.put('c.vcf', card('c', 'Person Sea'))
+    dav.reset_stats()
+    state = sync(username)
+    assert names(state) == {'b.vcf': 'Person B', 'c.vcf': 'Person Sea'}
+    assert dav.stats['by_method']['PROPFIND']['requests'] == 1 and reports(dav) == 1
+    assert state.digest == local_ctag(state)
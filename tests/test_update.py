@@ -0,0 +1,69 @@
+"""Editing a contact: the conditional PUT, its conflict path and the photo."""
+
+import base64
+
+import vobject
+
+import app as guivcard
+from conftest import card, csrf_headers
+
+PHOTO = b'\x89PNG\r\n\x1a\n kept photo'
+
+
+def open_form(client, user, *lines):
+    """Sync the book and return the form fields of card a as the list shows it."""
+    _, book = user
+    book.put('a.vcf', card('a', 'Jane Doe', 'EMAIL:jane@example.com', *lines))
+    contact = client.get('/api/contacts').get_json()['contacts'][0]
+    return {
+        'csrf_token': csrf_headers(client)['X-CSRF-Token'],
+        'contact_id': contact['id'], 'etag': contact['etag'], 'uid': contact['uid'],
+        'first_name': 'Jane', 'last_name': 'Doe', 'email': 'jane@work.example',
+        'has_photo': '1' if contact['photo_url'] else '',
+    }
+
+
+def puts(dav) -> int:
+    return dav.stats['by_method'].get('PUT', {}).get('requests', 0)
+
+
+def test_stale_edit_of_a_changed_card_is_a_conflict(client, user, dav):
+    _, book = user
+    form = open_form(client, user)
+    book.put('a.vcf', card('a', 'Jane Doe', 'EMAIL:jane@elsewhere.example'))
+    dav.reset_stats()
+
+    resp = client.post('/contacts/update', data=form, follow_redirects=True)
+    assert b'changed elsewhere' in resp.data
+    assert puts(dav) == 1
+    assert vobject.readOne(book.cards['a.vcf'][1]).email.value == 'jane@elsewhere.example'
+
+
+def test_stale_edit_of_an_unchanged_card_is_retried_once(client, user, dav):
+    _, book = user
+    form = open_form(client, user)
+    # A new ETag for what the form shows unchanged (the server bumped REV)
+    book.put('a.vcf', card('a', 'Jane Doe', 'EMAIL:jane@example.com', 'REV:20260101T000000Z'))
+    dav.reset_stats()
+
+    resp = client.post('/contacts/update', data=form, follow_redirects=True)
+    assert b'Contact updated successfully' in resp.data
+    assert puts(dav) == 2
+    assert vobject.readOne(book.cards['a.vcf'][1]).email.value == 'jane@work.example'
+
+
+def test_photo_not_in_the_cache_under_the_etag_is_read_from_the_server(client, user, dav):
+    username, book = user
+    form = open_form(client, user, f"PHOTO;ENCODING=b;TYPE=PNG:{base64.b64encode(PHOTO).decode('ascii')}")
+    assert form['has_photo'] == '1'
+    # A photo cached for another version of the card must not be written back
+    href = '/' + form['contact_id']
+    guivcard.contact_cache.put_photo(username, href, 'stale-tag', b'old photo', 'image/png')
+    dav.reset_stats()
+
+    resp = client.post('/contacts/update', data=form, follow_redirects=True)
+    assert b'Contact updated successfully' in resp.data
+    assert dav.stats['by_method']['GET']['requests'] == 1 and puts(dav) == 1
+    saved = vobject.readOne(book.cards['a.vcf'][1])
+    assert saved.email.value == 'jane@work.example'
+    assert saved.photo.value == PHOTO